@@ -0,0 +1,620 @@
+"""
+Замеры производительности импорта ГАР/ФИАС.
+
+Все замеры можно выполнить как на реальном архиве, так и на синтетическом,
+который генерируется с той же структурой файлов и атрибутов, что и у ФНС:
+
+    python bench.py xml [--archive 20220707_gar_xml.zip] [--file AS_HOUSES]
+    python bench.py parse [--workers 1 4 16] [--regions 1 2 3 4]
+    python bench.py sqlite
+    python bench.py rows [--file AS_HOUSES]
+    python bench.py pipeline [--streets 50]
+    python bench.py indexes
+    python bench.py filter [--file AS_ADDR_OBJ_PARAMS]
+    python bench.py cache [--file AS_HOUSES]
+    python bench.py hierarchy [--streets 50]
+    python bench.py find [--streets 20000 --houses 2 --apartments 1]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import sqlalchemy
+
+from core.database import database, get_connection_url, metadata, replace_database
+from core.settings import settings
+from fns import gar_rows
+from fns.download import get_str_file_size
+from fns.gar_cache import MemberCache
+from fns.gar_reader import ArchiveReader, cached_batches, read_batches
+from fns.gar_xml import rows_from_xml
+from fns.import_gar import GarImport
+from gar.models import AddressObject, AddressObjectParam, AdministrationHierarchy, Apartment, House, MunHierarchy
+from gar.query import sql_find_child
+from gar.tools import Hierarchy, get_address_object
+
+DATE = '2022-07-07'
+
+
+def _xml(root: str, tag: str, rows: Iterable[Dict]) -> Iterator[bytes]:
+    yield f'<?xml version="1.0" encoding="utf-8"?><{root}>'.encode('utf-8')
+    for row in rows:
+        attrs = ' '.join(f'{key}="{value}"' for key, value in row.items())
+        yield f'<{tag} {attrs} />'.encode('utf-8')
+    yield f'</{root}>'.encode('utf-8')
+
+
+def _write(archive: zipfile.ZipFile, name: str, root: str, tag: str, rows: Iterable[Dict]) -> None:
+    with archive.open(name, 'w', force_zip64=True) as file:
+        for data in _xml(root, tag, rows):
+            file.write(data)
+
+
+def _dates(**kwargs) -> Dict:
+    kwargs.update(UPDATEDATE=DATE, STARTDATE=DATE, ENDDATE='2079-06-06')
+    return kwargs
+
+
+def make_archive(path: str, regions: Iterable[int] = (77, ), streets: int = 50, houses: int = 20,
+                 apartments: int = 10, history: float = 0.3, seed: int = 1) -> str:
+    """
+    Сгенерировать синтетический архив ГАР. Имя файла должно начинаться с версии (YYYYMMDD).
+    history - доля исторических (неактуальных) записей, которые импорт должен отбрасывать
+    """
+    rnd = random.Random(seed)
+    suffix = f'{DATE.replace("-", "")}_{uuid.UUID(int=seed)}.XML'
+
+    def guid() -> str:
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    def with_history(rows: Iterable[Dict]) -> Iterator[Dict]:
+        for row in rows:
+            if rnd.random() < history:
+                old = dict(row, ID=row['ID'] + 500_000_000, NEXTID=row['ID'], ISACTUAL='0')
+                yield old
+            yield row
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        _write(archive, f'AS_OBJECT_LEVELS_{suffix}', 'OBJECTLEVELS', 'OBJECTLEVEL', [
+            _dates(LEVEL=i, NAME=f'Уровень {i}', ISACTIVE='true') for i in range(1, 18)
+        ])
+        _write(archive, f'AS_ADDR_OBJ_TYPES_{suffix}', 'ADDRESSOBJECTTYPES', 'ADDRESSOBJECTTYPE', [
+            _dates(ID=i, LEVEL=i % 17 + 1, SHORTNAME=f'т{i}', NAME=f'Тип {i}', DESC=f'Тип {i}', ISACTIVE='true')
+            for i in range(1, 50)
+        ])
+        _write(archive, f'AS_PARAM_TYPES_{suffix}', 'PARAMTYPES', 'PARAMTYPE', [
+            _dates(ID=i, NAME=f'Параметр {i}', CODE=f'P{i}', DESC='', ISACTIVE='true') for i in range(1, 21)
+        ])
+        for name, root, tag in (('AS_HOUSE_TYPES', 'HOUSETYPES', 'HOUSETYPE'),
+                                ('AS_APARTMENT_TYPES', 'APARTMENTTYPES', 'APARTMENTTYPE')):
+            _write(archive, f'{name}_{suffix}', root, tag, [
+                _dates(ID=i, NAME=f'Тип {i}', SHORTNAME=f'т{i}', DESC=f'Тип {i}', ISACTIVE='true')
+                for i in range(1, 15)
+            ])
+
+        for region in regions:
+            base = region * 10_000_000
+            region_id = base + 1
+            street_ids = [base + 10 + i for i in range(streets)]
+            house_ids = [base + 1_000_000 + i for i in range(streets * houses)]
+            apartment_ids = [base + 3_000_000 + i for i in range(streets * houses * apartments)]
+
+            def address_objects() -> Iterator[Dict]:
+                yield _dates(ID=region_id, OBJECTID=region_id, OBJECTGUID=guid(), CHANGEID=1,
+                             NAME=f'Регион {region}', TYPENAME='обл', LEVEL=1, OPERTYPEID=1,
+                             PREVID=0, NEXTID=0, ISACTUAL=1, ISACTIVE=1)
+                for i in street_ids:
+                    yield _dates(ID=i, OBJECTID=i, OBJECTGUID=guid(), CHANGEID=1, NAME=f'Улица {i}',
+                                 TYPENAME='ул', LEVEL=8, OPERTYPEID=1, PREVID=0, NEXTID=0, ISACTUAL=1, ISACTIVE=1)
+
+            def house_rows() -> Iterator[Dict]:
+                for i in house_ids:
+                    yield _dates(ID=i, OBJECTID=i, OBJECTGUID=guid(), CHANGEID=1, HOUSENUM=str(i % 300),
+                                 ADDNUM1=str(i % 7), HOUSETYPE=rnd.randint(1, 14), ADDTYPE1=rnd.randint(1, 14),
+                                 OPERTYPEID=1, PREVID=0, NEXTID=0, ISACTUAL=1, ISACTIVE=1)
+
+            def apartment_rows() -> Iterator[Dict]:
+                for i in apartment_ids:
+                    yield _dates(ID=i, OBJECTID=i, OBJECTGUID=guid(), CHANGEID=1, NUMBER=str(i % 500),
+                                 APARTTYPE=rnd.randint(1, 14), OPERTYPEID=1, PREVID=0, NEXTID=0,
+                                 ISACTUAL=1, ISACTIVE=1)
+
+            def parents() -> Iterator[tuple]:
+                yield region_id, 0, str(region_id)
+                for i in street_ids:
+                    yield i, region_id, f'{region_id}.{i}'
+                for idx, i in enumerate(house_ids):
+                    street = street_ids[idx // houses]
+                    yield i, street, f'{region_id}.{street}.{i}'
+                for idx, i in enumerate(apartment_ids):
+                    house = house_ids[idx // apartments]
+                    yield i, house, f'{region_id}.{street_ids[idx // apartments // houses]}.{house}.{i}'
+
+            def adm_rows() -> Iterator[Dict]:
+                for idx, (object_id, parent, path) in enumerate(parents()):
+                    yield _dates(ID=base + 5_000_000 + idx, OBJECTID=object_id, PARENTOBJID=parent, CHANGEID=1,
+                                 REGIONCODE=region, AREACODE=0, CITYCODE=0, PLACECODE=0, PLANCODE=0,
+                                 STREETCODE=0, PREVID=0, NEXTID=0, ISACTIVE=1, PATH=path)
+
+            def mun_rows() -> Iterator[Dict]:
+                for idx, (object_id, parent, path) in enumerate(parents()):
+                    yield _dates(ID=base + 7_000_000 + idx, OBJECTID=object_id, PARENTOBJID=parent, CHANGEID=1,
+                                 OKTMO=f'{region}000000', PREVID=0, NEXTID=0, ISACTIVE=1, PATH=path)
+
+            def param_rows() -> Iterator[Dict]:
+                idx = base + 8_000_000
+                for object_id in [region_id] + street_ids:
+                    for type_id in range(1, 17):
+                        idx += 1
+                        value = f'{region:0=2}{object_id % 10 ** 11:0=11}00' if type_id == 10 else f'{object_id}'
+                        yield _dates(ID=idx, OBJECTID=object_id, CHANGEID=1, CHANGEIDEND=0, TYPEID=type_id,
+                                     VALUE=value)
+                        # Параметры с истекшим сроком действия
+                        for _ in range(int(history * 10)):
+                            idx += 1
+                            yield _dates(ID=idx, OBJECTID=object_id, CHANGEID=1, CHANGEIDEND=idx,
+                                         TYPEID=type_id, VALUE=value)
+
+            folder = f'{region:0=2}'
+            _write(archive, f'{folder}/AS_ADDR_OBJ_{suffix}', 'ADDRESSOBJECTS', 'OBJECT',
+                   with_history(address_objects()))
+            _write(archive, f'{folder}/AS_HOUSES_{suffix}', 'HOUSES', 'HOUSE', with_history(house_rows()))
+            _write(archive, f'{folder}/AS_APARTMENTS_{suffix}', 'APARTMENTS', 'APARTMENT',
+                   with_history(apartment_rows()))
+            _write(archive, f'{folder}/AS_ADM_HIERARCHY_{suffix}', 'ITEMS', 'ITEM', adm_rows())
+            _write(archive, f'{folder}/AS_MUN_HIERARCHY_{suffix}', 'ITEMS', 'ITEM', mun_rows())
+            _write(archive, f'{folder}/AS_ADDR_OBJ_PARAMS_{suffix}', 'PARAMS', 'PARAM', param_rows())
+    return path
+
+
+def legacy_rows_from_xml(archive: zipfile.ZipFile, file_name: str) -> Iterator[Dict]:
+    """
+    Прежняя реализация чтения XML (регулярные выражения + xmltodict) - база для сравнения
+    """
+    import xmltodict
+
+    file = archive.open(file_name)
+    tags = ''
+    while True:
+        data = file.read(10000)
+        if not data:
+            break
+        try:
+            str_data = data.decode(encoding='utf-8')
+        except UnicodeDecodeError:
+            data += file.read(1)
+            str_data = data.decode(encoding='utf-8')
+        tags += str_data
+        result = re.compile(r"(?:<).*?(?:>)").findall(tags)
+        tags = re.sub(r'\<[^>]*\>', '', tags)
+
+        for i in result:
+            if re.compile(r'<(.*?)"(.*?)/>').findall(i):
+                obj = xmltodict.parse(i, dict_constructor=dict)
+                yield obj[list(obj.keys())[0]]
+
+
+def report(title: str, rows: int, size: int, seconds: float) -> None:
+    seconds = max(seconds, 1e-9)
+    print(f'{title:<40} {rows:>12} строк {seconds:>9.2f} с {rows / seconds:>12.0f} строк/с '
+          f'{size / seconds / 1024 / 1024:>9.2f} МБ/с')
+
+
+def _measure(reader: Callable, archive: zipfile.ZipFile, file_name: str) -> None:
+    size = archive.getinfo(file_name).file_size
+    start = time.perf_counter()
+    rows = sum(1 for _ in reader(archive, file_name))
+    report(f'{reader.__name__} {os.path.basename(file_name)[:28]}', rows, size, time.perf_counter() - start)
+
+
+def bench_xml(archive_name: str, masks: List[str]) -> None:
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        for mask in masks:
+            for file_name in [x for x in sorted(archive.namelist()) if f'{mask}_202' in x][:1]:
+                print(f'{file_name}: {get_str_file_size(archive.getinfo(file_name).file_size)}')
+                _measure(legacy_rows_from_xml, archive, file_name)
+                _measure(rows_from_xml, archive, file_name)
+
+
+# Описания таблиц и модели для файлов регионов
+MEMBERS = {
+    'AS_ADDR_OBJ': (gar_rows.ADDRESS_OBJECT, AddressObject),
+    'AS_HOUSES': (gar_rows.HOUSE, House),
+    'AS_APARTMENTS': (gar_rows.APARTMENT, Apartment),
+    'AS_ADM_HIERARCHY': (gar_rows.ADMINISTRATION_HIERARCHY, AdministrationHierarchy),
+    'AS_ADDR_OBJ_PARAMS': (gar_rows.ADDRESS_OBJECT_PARAM, AddressObjectParam),
+}
+
+
+def bench_rows(archive_name: str, masks: List[str]) -> None:
+    """
+    Преобразование записей XML в кортежи колонок и, для сравнения, с созданием моделей ormar
+    (так записи передавались в bulk_create раньше). Разбор XML в замер не входит
+    """
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        for mask in masks:
+            mapping, model = MEMBERS[mask]
+            for file_name in [x for x in sorted(archive.namelist()) if f'/{mask}_202' in x][:1]:
+                items = list(rows_from_xml(archive, file_name))
+                size = archive.getinfo(file_name).file_size
+
+                start = time.perf_counter()
+                rows = [x for x in map(mapping, items) if x]
+                report(f'{mask} кортежи', len(rows), size, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                names = mapping.names
+                models = [model(**dict(zip(names, x))) for x in map(mapping, items) if x]
+                report(f'{mask} модели ormar', len(models), size, time.perf_counter() - start)
+
+
+def bench_filter(archive_name: str, masks: List[str]) -> None:
+    """
+    Разбор XML с преобразованием записей: отбор актуальных записей после создания словаря записи
+    и при разборе XML (XmlFilter описания таблицы). Результаты должны совпадать
+    """
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        for mask in masks:
+            mapping, _ = MEMBERS[mask]
+            for file_name in [x for x in sorted(archive.namelist()) if f'/{mask}_202' in x][:1]:
+                size = archive.getinfo(file_name).file_size
+                print(f'{file_name}: {get_str_file_size(size)}')
+
+                start = time.perf_counter()
+                expected = [x for x in map(mapping, rows_from_xml(archive, file_name)) if x]
+                report(f'{mask} без отбора в XML', len(expected), size, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                rows = [mapping(x) for x in rows_from_xml(archive, file_name, select=mapping.select) if x]
+                rows = [x for x in rows if x]
+                report(f'{mask} с отбором в XML', len(rows), size, time.perf_counter() - start)
+                assert rows == expected, f'{mask}: результаты отбора не совпадают'
+
+
+def bench_cache(archive_name: str, work_dir: str, masks: List[str]) -> None:
+    """
+    Чтение разобранных записей файла: разбор XML, разбор XML с записью кэша и чтение из кэша
+    """
+    cache = MemberCache(os.path.join(work_dir, 'cache'), 20220707)
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        for mask in masks:
+            mapping, _ = MEMBERS[mask]
+            for file_name in [x for x in sorted(archive.namelist()) if f'/{mask}_202' in x][:1]:
+                size = archive.getinfo(file_name).file_size
+                print(f'{file_name}: {get_str_file_size(size)}')
+
+                start = time.perf_counter()
+                expected = [x for batch in read_batches(archive, file_name, mapping) for x in batch.rows]
+                report(f'{mask} XML', len(expected), size, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                rows = sum(len(x.rows) for x in read_batches(archive, file_name, mapping, cache=cache))
+                report(f'{mask} XML с записью кэша', rows, size, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                rows = [x for batch in cached_batches(cache.reader(file_name, mapping), size) for x in batch.rows]
+                report(f'{mask} кэш', len(rows), size, time.perf_counter() - start)
+                assert rows == expected, f'{mask}: записи кэша не совпадают с XML'
+                print(f'Размер кэша: {get_str_file_size(_dir_size(cache.reader(file_name, mapping).path))}')
+
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+
+
+async def _parse_members(archive_name: str, workers: int) -> int:
+    parsers = {
+        'AS_ADDR_OBJ_2': gar_rows.ADDRESS_OBJECT,
+        'AS_HOUSES_2': gar_rows.HOUSE,
+        'AS_APARTMENTS_2': gar_rows.APARTMENT,
+        'AS_ADM_HIERARCHY_2': gar_rows.ADMINISTRATION_HIERARCHY,
+        'AS_ADDR_OBJ_PARAMS_2': gar_rows.ADDRESS_OBJECT_PARAM,
+    }
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        reader = ArchiveReader(archive, workers)
+        members = [(x, parser) for x in archive.namelist() for mask, parser in parsers.items() if mask in x]
+
+        async def read(file_name: str, parser: Callable) -> int:
+            return sum([len(x.rows) async for x in reader.batches(file_name, parser)])
+
+        try:
+            return sum(await asyncio.gather(*[read(file_name, parser) for file_name, parser in members]))
+        finally:
+            await reader.close()
+
+
+def bench_parse(archive_name: str, workers: List[int]) -> None:
+    """
+    Масштабирование разбора файлов регионов в зависимости от количества процессов пула
+    """
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        size = sum(x.file_size for x in archive.infolist() if '/' in x.filename)
+    for count in workers:
+        start = time.perf_counter()
+        rows = asyncio.run(_parse_members(archive_name, count))
+        report(f'workers={count}', rows, size, time.perf_counter() - start)
+
+
+async def use_sqlite(file_name: str) -> None:
+    """
+    Переключиться на новую пустую базу SQLite (настройки в файле не меняются)
+    """
+    settings.database.driver_name = settings.database.DriverName.sqlite
+    settings.database.base = file_name
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    metadata.create_all(sqlalchemy.create_engine(get_connection_url()))
+    await replace_database(get_connection_url())
+    await database.connect()
+
+
+async def count_rows() -> int:
+    return sum([await database.fetch_val(f'select count(*) from {x.name}') for x in metadata.sorted_tables])
+
+
+async def _import_sqlite(archive_name: str, file_name: str) -> int:
+    await use_sqlite(file_name)
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        await GarImport(archive).import_all()
+    rows = await count_rows()
+    await database.disconnect()
+    return rows
+
+
+def bench_sqlite(archive_name: str, work_dir: str) -> None:
+    """
+    Импорт в пустую базу SQLite: через ormar блоками по 50 записей и в быстром режиме
+    """
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        size = sum(x.file_size for x in archive.infolist())
+    for fast_import in (False, True):
+        settings.database.fast_import = fast_import
+        start = time.perf_counter()
+        rows = asyncio.run(_import_sqlite(archive_name, os.path.join(work_dir, 'bench.sqlite')))
+        report(f'fast_import={fast_import}', rows, size, time.perf_counter() - start)
+
+
+def bench_indexes(archive_name: str, work_dir: str) -> None:
+    """
+    Импорт в пустую базу SQLite с индексами из миграции и с созданием индексов после загрузки
+    """
+    with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+        size = sum(x.file_size for x in archive.infolist())
+    for defer_indexes in (False, True):
+        settings.update.defer_indexes = defer_indexes
+        start = time.perf_counter()
+        rows = asyncio.run(_import_sqlite(archive_name, os.path.join(work_dir, 'bench.sqlite')))
+        report(f'defer_indexes={defer_indexes}', rows, size, time.perf_counter() - start)
+
+
+def _import_rss(archive_name: str, file_name: str) -> Tuple[int, int]:
+    rows = asyncio.run(_import_sqlite(archive_name, file_name))
+    # ru_maxrss в Linux - в КБ
+    return rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_pipeline(work_dir: str, args) -> None:
+    """
+    Пиковая память импорта в SQLite при росте архива. Каждый импорт - в отдельном процессе
+    """
+    for scale in (1, 2, 4):
+        archive_name = make_archive(os.path.join(work_dir, f'2022070{scale}_gar_xml.zip'), regions=args.regions,
+                                    streets=args.streets * scale, houses=args.houses, apartments=args.apartments)
+        size = sum(x.file_size for x in zipfile.ZipFile(archive_name).infolist())
+        start = time.perf_counter()
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            rows, rss = executor.submit(_import_rss, archive_name, os.path.join(work_dir, 'bench.sqlite')).result()
+        report(f'x{scale} {get_str_file_size(size)}, RSS {get_str_file_size(rss)}', rows, size,
+               time.perf_counter() - start)
+
+
+class _Hierarchy(Hierarchy):
+    """ Только цепочка иерархии, без чтения объектов """
+    async def __ainit__(self, model, object_id: int) -> None:
+        self.model = model
+
+
+async def _legacy_hierarchy(hierarchy: Hierarchy, object_id: int) -> List:
+    """ Прежний обход иерархии: запрос на каждого родителя """
+    obj = await hierarchy.get_hierarchy_object(object_id)
+    result = [obj] if obj else []
+    while obj and obj.parent_object_id:
+        obj = await hierarchy.get_hierarchy_object(obj.parent_object_id)
+        if obj:
+            result.insert(0, obj)
+    return result
+
+
+async def _cte_hierarchy(hierarchy: Hierarchy, object_id: int) -> List:
+    return await hierarchy.get_hierarchy(object_id, False)
+
+
+async def _full_hierarchy(hierarchy: Hierarchy, object_id: int) -> List:
+    return (await Hierarchy(hierarchy.model, object_id)).hierarchy
+
+
+async def _lookup(_hierarchy: Hierarchy, object_id: int) -> List:
+    return [await get_address_object(object_id=object_id)]
+
+
+async def _bench_hierarchy(archive_name: str, file_name: str) -> None:
+    await _import_sqlite(archive_name, file_name)
+    await database.connect()
+    object_ids = [x['object_id'] for x in await database.fetch_all('select object_id from apartments')]
+    object_ids = random.Random(0).sample(object_ids, min(len(object_ids), 500))
+    # Считаем запросы к БД
+    queries = 0
+    fetch_all = database.fetch_all
+
+    async def counted(*args, **kwargs):
+        nonlocal queries
+        queries += 1
+        return await fetch_all(*args, **kwargs)
+
+    async def measure(title: str, method: Callable, hierarchy: Hierarchy) -> List[List[int]]:
+        nonlocal queries
+        queries = 0
+        start = time.perf_counter()
+        result = [[y.id for y in await method(hierarchy, x)] for x in object_ids]
+        seconds = time.perf_counter() - start
+        print(f'{hierarchy.model.Meta.tablename} {title:>14}: {queries / len(object_ids):.1f} запросов на объект, '
+              f'{seconds / len(object_ids) * 1000:.3f} мс на объект')
+        return result
+
+    database.fetch_all = counted
+    try:
+        for model in (AdministrationHierarchy, MunHierarchy):
+            hierarchy = await _Hierarchy(model, 0)
+            # Только цепочка иерархии: запрос на каждого родителя и рекурсивный запрос
+            walk = await measure('walk', _legacy_hierarchy, hierarchy)
+            assert walk == await measure('cte', _cte_hierarchy, hierarchy)
+            # Объект Hierarchy целиком: с материализованным путем и без него
+            assert walk == await measure('Hierarchy+path', _full_hierarchy, hierarchy)
+            await database.execute(f'update {model.Meta.tablename} set path = null')
+            assert walk == await measure('Hierarchy', _full_hierarchy, hierarchy)
+        # Адресный объект по object_id: одна таблица по object_routes и все таблицы
+        hierarchy = await _Hierarchy(AdministrationHierarchy, 0)
+        routed = await measure('object', _lookup, hierarchy)
+        await database.execute('delete from object_routes')
+        assert routed == await measure('object/all', _lookup, hierarchy)
+    finally:
+        database.fetch_all = fetch_all
+    await database.disconnect()
+
+
+def bench_hierarchy(archive_name: str, work_dir: str) -> None:
+    """
+    Чтение цепочки иерархии квартир: запрос на каждого родителя и один рекурсивный запрос,
+    объект Hierarchy с материализованным путем и без него, адресный объект через object_routes и без него
+    """
+    asyncio.run(_bench_hierarchy(archive_name, os.path.join(work_dir, 'bench.sqlite')))
+
+
+# Прежний поиск дочерних объектов: все таблицы объектов через left join, общий отбор и сортировка
+LEGACY_FIND_CHILD = """
+select
+    o1.object_id as address_objects,
+    o2.object_id as houses,
+    o3.object_id as apartments
+from hierarchy_adm h
+    left join address_objects o1 on o1.object_id = h.object_id
+    left join houses o2 on o2.object_id = h.object_id and (:add_num1 is null or o2.add_num1 = :add_num1)
+        and (:add_num2 is null or o2.add_num2 = :add_num2)
+    left join apartments o3 on o3.object_id = h.object_id
+where (h.parent_object_id = :object_id or (:object_id is null and h.parent_object_id is null))
+    and (o1.name like :text or o2.house_num like :text or o3.number like :text)
+order by h.is_active desc,
+    o1.name, o2.house_num, o3.number,
+    h.start_date desc,
+    o1.is_active desc, o1.start_date desc,
+    o2.is_active desc, o2.start_date desc,
+    o3.is_active desc, o3.start_date desc
+limit :limit;
+"""
+
+
+def _found(rows: List) -> List[int]:
+    """ Объекты, которые выберет Hierarchy.find: адресные объекты, иначе дома, иначе помещения """
+    for column in ('address_objects', 'houses', 'apartments'):
+        object_ids = sorted(x[column] for x in rows if x[column])
+        if object_ids:
+            return object_ids
+    return []
+
+
+async def _bench_find(archive_name: str, file_name: str, repeat: int = 20) -> None:
+    await _import_sqlite(archive_name, file_name)
+    await database.connect()
+    # Родитель с наибольшим числом потомков (регион) и улица с домами
+    region = await database.fetch_val('select parent_object_id from hierarchy_adm where parent_object_id is not null '
+                                      'group by parent_object_id order by count(*) desc limit 1')
+    street = await database.fetch_val('select h.parent_object_id from hierarchy_adm h '
+                                      'join houses o on o.object_id = h.object_id limit 1')
+    query = sql_find_child.format(hierarchy_table='hierarchy_adm', parent_condition='h.parent_object_id = :object_id')
+    for parent, sample in ((region, 'select o.name from hierarchy_adm h join address_objects o '
+                                    'on o.object_id = h.object_id where h.parent_object_id = :object_id limit 1'),
+                           (street, 'select o.house_num from hierarchy_adm h join houses o '
+                                    'on o.object_id = h.object_id where h.parent_object_id = :object_id limit 1')):
+        children = await database.fetch_val('select count(*) from hierarchy_adm where parent_object_id = :object_id',
+                                            {'object_id': parent})
+        value = await database.fetch_val(sample, {'object_id': parent})
+        for text in ('', value[:3], value, 'Нет такого'):
+            params = {'object_id': parent, 'text': f'{text}%', 'add_num1': None, 'add_num2': None, 'limit': 5}
+            times = {}
+            found = {}
+            for title, sql in (('legacy', LEGACY_FIND_CHILD), ('union', query)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    rows = await database.fetch_all(sql, params)
+                times[title] = (time.perf_counter() - start) / repeat * 1000
+                found[title] = _found(rows)
+            print(f'потомков {children:>7} {text!r:>20}: было {times["legacy"]:8.2f} мс, '
+                  f'стало {times["union"]:8.2f} мс, найдено {len(found["union"])}'
+                  f'{"" if found["legacy"] == found["union"] else " (отличается)"}')
+    await database.disconnect()
+
+
+def bench_find(archive_name: str, work_dir: str) -> None:
+    """
+    Поиск дочерних объектов (Hierarchy.find) у родителя с наибольшим числом потомков и у улицы:
+    прежний запрос и запрос с ветками по таблицам объектов
+    """
+    asyncio.run(_bench_find(archive_name, os.path.join(work_dir, 'bench.sqlite')))
+
+
+def _archive(args, work_dir: str) -> str:
+    if args.archive:
+        return args.archive
+    return make_archive(os.path.join(work_dir, '20220707_gar_xml.zip'), regions=args.regions,
+                        streets=args.streets, houses=args.houses, apartments=args.apartments)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('bench', choices=['xml', 'parse', 'sqlite', 'rows', 'pipeline', 'indexes', 'filter',
+                                          'cache', 'hierarchy', 'find'])
+    parser.add_argument('--archive', help='Архив ГАР. Если не указан - генерируется синтетический')
+    parser.add_argument('--file', action='append', help='Маска файла архива (AS_HOUSES, AS_ADDR_OBJ_PARAMS, ...)')
+    parser.add_argument('--regions', type=int, nargs='+', default=[77])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 4, 16])
+    parser.add_argument('--streets', type=int, default=50)
+    parser.add_argument('--houses', type=int, default=20)
+    parser.add_argument('--apartments', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.bench == 'pipeline':
+            return bench_pipeline(work_dir, args)
+        archive = _archive(args, work_dir)
+        if args.bench == 'xml':
+            bench_xml(archive, args.file or ['AS_HOUSES', 'AS_ADDR_OBJ_PARAMS'])
+        elif args.bench == 'parse':
+            bench_parse(archive, args.workers)
+        elif args.bench == 'sqlite':
+            bench_sqlite(archive, work_dir)
+        elif args.bench == 'indexes':
+            bench_indexes(archive, work_dir)
+        elif args.bench == 'rows':
+            bench_rows(archive, args.file or list(MEMBERS))
+        elif args.bench == 'filter':
+            bench_filter(archive, args.file or ['AS_ADDR_OBJ_PARAMS', 'AS_HOUSES'])
+        elif args.bench == 'cache':
+            bench_cache(archive, work_dir, args.file or list(MEMBERS))
+        elif args.bench == 'hierarchy':
+            bench_hierarchy(archive, work_dir)
+        elif args.bench == 'find':
+            bench_find(archive, work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
+import asyncio
+import contextvars
+from typing import Coroutine
+
 import databases
 import ormar
 import sqlalchemy
@@ -27,28 +31,20 @@ class BaseMeta(ormar.ModelMeta):
     database = database
 
 
-def replace_database():
-    pass
-    # from core.database import metadata, database
-    # s = await models.Item.objects.all()
-    #
-    # DATABASE_URL = "sqlite:///test2.db"
-    # # engine = sqlalchemy.create_engine(DATABASE_URL)
-    # # # just to be sure we clear the db before
-    # # metadata.drop_all(engine)
-    # # # yield
-    # # metadata.create_all(engine)
-    #
-    # # database.disconnect()
-    # # database.url = DATABASE_URL
-    # import databases
-    # database = databases.Database(DATABASE_URL)
-    # await database.connect()
-    #
-    # # models.Item.Meta.database = database
-    #
-    # for i in metadata.sorted_tables:
-    #     print(i)
-    #     # i.Meta.database = database
-    #
-    # return s
+async def replace_database(url: str, **options) -> None:
+    """
+    Переключить подключение на другую базу данных. options передаются драйверу (например, server_settings asyncpg).
+    Объект database остается тем же, поэтому модели и импортированные ссылки на него продолжают работать
+    """
+    if database.is_connected:
+        await database.disconnect()
+    database.__init__(url, **options)
+
+
+def create_task(coro: Coroutine) -> asyncio.Task:
+    """
+    Задача с собственным подключением к БД.
+    databases хранит подключение в contextvars, поэтому обычная дочерняя задача получает подключение родителя
+    и ее запросы выполняются по очереди с его запросами
+    """
+    return contextvars.Context().run(asyncio.create_task, coro)
@@ -1,6 +1,6 @@
 import datetime
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Union
 
 from pydantic import BaseModel, validator
 
@@ -20,6 +20,8 @@ class Settings(BaseSettings):
         user: Optional[str]
         password: Optional[str]
         port: Optional[int]
+        # Быстрый режим импорта в SQLite (WAL, synchronous=OFF, запись блоков через executemany)
+        fast_import: bool = True
 
     class Update(BaseModel):
         class Level(str, Enum):
@@ -37,7 +39,37 @@ class Settings(BaseSettings):
         time: str = '00:00'
         level: Level = Level.apartment
         hierarchy: Hierarchy = Hierarchy.all
-        region: Optional[int] = None
+        # Регион или список регионов, например [77, 50] (None - все регионы)
+        region: Union[int, List[int], None] = None
+        # Загрузка архива: количество одновременно загружаемых частей файла (если сервер поддерживает Range)
+        # и количество повторов после ошибки соединения
+        download_segments: int = 4
+        download_retries: int = 5
+        # Количество архивов обновлений, загружаемых заранее во время импорта (0 - без предварительной загрузки),
+        # и место на диске для загруженных, но не импортированных архивов (МБ, None - без ограничения)
+        prefetch: int = 1
+        prefetch_budget: Optional[int] = None
+        # Количество обновлений, объединяемых в один импорт (1 - каждое обновление импортируется отдельно).
+        # Записи, измененные в нескольких обновлениях, записываются один раз - из последнего
+        coalesce: int = 1
+        # Количество процессов для разбора XML (0 - разбор в основном процессе)
+        workers: int = 0
+        # Конвейер импорта: количество одновременно читаемых файлов, задач записи в БД (для SQLite всегда 1)
+        # и размер очереди блоков между ними. При разборе в пуле readers ограничивает и количество
+        # одновременно разбираемых файлов (в каждом шаге импорта)
+        readers: int = 2
+        writers: int = 2
+        queue_size: int = 8
+        # Количество одновременно импортируемых таблиц (для SQLite без fast_import всегда 1)
+        steps: int = 2
+        # Индексы пустых таблиц создавать после загрузки (SQLite и PostgreSQL)
+        defer_indexes: bool = True
+        # Полный архив загружать в теневую БД (SQLite - соседний файл, PostgreSQL - схема gar_shadow)
+        # и заменять ей рабочую после проверки
+        shadow: bool = False
+        # Каталог кэша разобранных файлов архивов (None - без кэша). Повторный импорт того же архива
+        # читает записи из кэша без разбора XML
+        cache_dir: Optional[str] = None
 
         @classmethod
         @validator('time')
@@ -1,8 +1,14 @@
+import asyncio
 import copy
+import json
 import os
-from typing import Dict, List
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
 
 import requests as requests
 
@@ -24,6 +30,294 @@ def get_str_file_size(size: int):
     return f'{size} Б'
 
 
+# Размер блока, записываемого в файл за один раз
+CHUNK_SIZE = 1024 * 1024
+# Минимальный размер части файла, загружаемой отдельным потоком
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+# Состояние загрузки сохраняется после каждых STATE_BYTES байт, ход загрузки логируется раз в LOG_SECONDS секунд
+STATE_BYTES = 16 * 1024 * 1024
+LOG_SECONDS = 30
+# Размер конца архива, читаемого за один запрос при загрузке отдельных файлов архива (оглавление и его конец)
+DIRECTORY_SIZE = 1024 * 1024
+
+
+class DownloadStats:
+    """ Ход загрузки: размер файла, загружено байт (вместе с загруженными до прерывания), скорость """
+    def __init__(self, size: int = 0, done: int = 0) -> None:
+        self.size = size
+        self.done = done
+        self.received = 0
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def speed(self) -> float:
+        """ Байт в секунду в этом запуске """
+        return self.received / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        percent = f' ({self.done / self.size:.0%})' if self.size else ''
+        return f'{get_str_file_size(self.done)} из {get_str_file_size(self.size)}{percent}, ' \
+               f'{get_str_file_size(int(self.speed))}/с'
+
+
+class Downloader:
+    """
+    Потоковая загрузка файла по HTTP во временный файл {file_name}.part.
+    Если сервер поддерживает Range, файл загружается частями в segments потоков, а загрузка, прерванная
+    ошибкой или остановкой сервиса, продолжается с сохраненного места: части и загруженные байты хранятся
+    в {file_name}.part.json вместе с ETag и Last-Modified файла. Ошибка соединения повторяется retries раз
+    с продолжения части. Загруженный размер сверяется с Content-Length. Установленный cancel прерывает загрузку
+    """
+    def __init__(self, url: str, file_name: str, segments: int = 1, retries: int = 5, timeout: float = 60,
+                 chunk_size: int = CHUNK_SIZE, min_segment_size: int = MIN_SEGMENT_SIZE,
+                 cancel: Optional[threading.Event] = None) -> None:
+        assert segments > 0, 'Не корректно задано количество частей загрузки'
+        self.url = url
+        self.file_name = file_name
+        self.part = f'{file_name}.part'
+        self.state_file = f'{file_name}.part.json'
+        self.segments = segments
+        self.retries = retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.min_segment_size = min_segment_size
+        self.cancel = cancel or threading.Event()
+        self.stats = DownloadStats()
+        self._info: Dict = {}
+        # Загружаемые диапазоны и части файла: [начало, конец (включительно), загружено байт]
+        self._ranges: List[List[int]] = []
+        self._parts: List[List[int]] = []
+        self._lock = threading.Lock()
+        self._saved = 0
+        self._logged = 0.0
+
+    def _head(self) -> Dict:
+        """ Размер файла, поддержка Range и признаки изменения файла на сервере """
+        try:
+            response = requests.head(self.url, allow_redirects=True, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            import_log.warning(f'Не удалось получить размер файла {self.url}: {e}')
+            return {'size': 0, 'ranges': False, 'etag': None, 'modified': None}
+        return {
+            'size': int(response.headers.get('Content-Length', 0)),
+            'ranges': response.headers.get('Accept-Ranges') == 'bytes',
+            'etag': response.headers.get('ETag'),
+            'modified': response.headers.get('Last-Modified'),
+        }
+
+    def _load_parts(self, ranges: List[List[int]]) -> List[List[int]]:
+        """
+        Части прерванной загрузки тех же диапазонов файла или части новой загрузки: диапазоны ranges
+        [начало, конец (включительно)], разделенные не более чем на segments частей
+        """
+        size = self._info['size']
+        try:
+            with open(self.state_file) as file:
+                state = json.load(file)
+            if all(state.get(x) == self._info[x] for x in ('size', 'etag', 'modified')) \
+                    and state['ranges'] == ranges and os.path.getsize(self.part) == size:
+                return state['parts']
+        except (OSError, ValueError, KeyError):
+            pass
+        total = sum(y - x + 1 for x, y in ranges)
+        count = max(1, min(self.segments, total // self.min_segment_size))
+        step = max(-(-total // count), 1)
+        if not os.path.isfile(self.part) or os.path.getsize(self.part) != size:
+            with open(self.part, 'wb') as file:
+                file.truncate(size)
+        return [[x, min(x + step - 1, end), 0] for start, end in ranges for x in range(start, end + 1, step)]
+
+    def _save_parts(self) -> None:
+        state = dict(self._info, ranges=self._ranges, parts=self._parts)
+        with open(f'{self.state_file}.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(f'{self.state_file}.tmp', self.state_file)
+
+    def _received(self, part: Optional[List[int]], length: int) -> None:
+        if self.cancel.is_set():
+            raise RuntimeError(f'Загрузка {self.file_name} отменена')
+        with self._lock:
+            if part is not None:
+                part[2] += length
+            self.stats.done += length
+            self.stats.received += length
+            if part is not None and self.stats.received - self._saved >= STATE_BYTES:
+                self._saved = self.stats.received
+                self._save_parts()
+            if time.perf_counter() - self._logged >= LOG_SECONDS:
+                self._logged = time.perf_counter()
+                import_log.info(f'Загрузка {self.file_name}: {self.stats}')
+
+    def _retry(self, attempt: int, e: Exception) -> None:
+        if attempt >= self.retries:
+            raise e
+        import_log.warning(f'Ошибка загрузки {self.url}, повтор {attempt + 1} из {self.retries}: {e}')
+        time.sleep(min(2 ** attempt, 30))
+
+    def _download_part(self, part: List[int]) -> None:
+        attempt = 0
+        while part[0] + part[2] <= part[1]:
+            start = part[0] + part[2]
+            try:
+                headers = {'Range': f'bytes={start}-{part[1]}'}
+                with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code != 206:
+                        raise requests.HTTPError(f'Сервер не вернул часть файла: {response.status_code}')
+                    # Без буфера: записанное в файл не теряется при остановке процесса
+                    with open(self.part, 'r+b', buffering=0) as file:
+                        file.seek(start)
+                        for chunk in response.iter_content(self.chunk_size):
+                            chunk = chunk[:part[1] + 1 - part[0] - part[2]]
+                            file.write(chunk)
+                            self._received(part, len(chunk))
+                if part[0] + part[2] <= part[1]:
+                    raise requests.ConnectionError('Соединение закрыто до конца части файла')
+            except (requests.RequestException, OSError) as e:
+                # Попытки считаются подряд без загруженных данных: обрыв после загрузки части данных начинает их заново
+                if part[0] + part[2] > start:
+                    attempt = 0
+                self._retry(attempt, e)
+                attempt += 1
+
+    def _download_stream(self) -> None:
+        """ Загрузка одним запросом, если сервер не поддерживает Range. Ошибка начинает загрузку заново """
+        attempt = 0
+        while True:
+            self.stats.done = 0
+            try:
+                with requests.get(self.url, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    with open(self.part, 'wb') as file:
+                        for chunk in response.iter_content(self.chunk_size):
+                            file.write(chunk)
+                            self._received(None, len(chunk))
+                if self._info['size'] and self.stats.done != self._info['size']:
+                    raise requests.ConnectionError(f'Загружено {self.stats.done} байт из {self._info["size"]}')
+                return
+            except (requests.RequestException, OSError) as e:
+                self._retry(attempt, e)
+                attempt += 1
+
+    def _get(self, start: int, end: int) -> bytes:
+        """ Прочитать диапазон файла [start, end] """
+        attempt = 0
+        while True:
+            try:
+                response = requests.get(self.url, headers={'Range': f'bytes={start}-{end}'}, timeout=self.timeout)
+                if response.status_code != 206 or len(response.content) != end - start + 1:
+                    raise requests.HTTPError(f'Сервер не вернул часть файла: {response.status_code}')
+                return response.content
+            except requests.RequestException as e:
+                self._retry(attempt, e)
+                attempt += 1
+
+    def _member_ranges(self, select: Callable[[str], bool], directory_size: int) -> List[List[int]]:
+        """
+        Прочитать оглавление zip архива с конца файла и записать его на свое место во временный файл.
+        Возвращает диапазоны файлов архива, для которых select(имя) истинно (от локального заголовка
+        до заголовка следующего файла)
+        """
+        size = self._info['size']
+        start = max(size - directory_size, 0)
+        data = self._get(start, size - 1)
+        position = data.rfind(b'PK\x05\x06')
+        if position < 0 or position + 22 > len(data):
+            raise zipfile.BadZipFile('Не найден конец оглавления архива')
+        directory_offset = struct.unpack('<L', data[position + 16:position + 20])[0]
+        if directory_offset == 0xFFFFFFFF:
+            # ZIP64: запись конца оглавления перед локатором (20 байт перед концом оглавления)
+            record = struct.unpack('<Q', data[position - 12:position - 4])[0] - start
+            if data[position - 20:position - 16] != b'PK\x06\x07' or not 0 <= record < len(data):
+                raise zipfile.BadZipFile('Не найдено оглавление ZIP64')
+            directory_offset = struct.unpack('<Q', data[record + 48:record + 56])[0]
+        if directory_offset < start:
+            data = self._get(directory_offset, start - 1) + data
+            start = directory_offset
+        if not os.path.isfile(self.part) or os.path.getsize(self.part) != size:
+            with open(self.part, 'wb') as file:
+                file.truncate(size)
+        with open(self.part, 'r+b') as file:
+            file.seek(start)
+            file.write(data)
+
+        with zipfile.ZipFile(self.part) as archive:
+            members = sorted(archive.infolist(), key=lambda x: x.header_offset)
+        ends = [x.header_offset for x in members[1:]] + [directory_offset]
+        ranges: List[List[int]] = []
+        for member, end in zip(members, ends):
+            # Конец архива с оглавлением уже прочитан
+            end = min(end, start)
+            if not select(member.filename) or member.header_offset >= end:
+                continue
+            if ranges and ranges[-1][1] + 1 == member.header_offset:
+                ranges[-1][1] = end - 1
+            else:
+                ranges.append([member.header_offset, end - 1])
+        return ranges
+
+    def download(self, ranges: Optional[List[List[int]]] = None) -> DownloadStats:
+        """ Загрузить файл или только диапазоны ranges (если сервер поддерживает Range). Возвращает ход загрузки """
+        self._info = self._head()
+        size = self._info['size']
+        if size and os.path.isfile(self.file_name) and os.path.getsize(self.file_name) == size:
+            # Загружен заранее, но не импортирован
+            import_log.info(f'Файл {self.file_name} загружен ранее')
+            self.stats = DownloadStats(size, size)
+            return self.stats
+        if self._info['ranges'] and size:
+            self._ranges = ranges if ranges is not None else [[0, size - 1]]
+            self._parts = self._load_parts(self._ranges)
+            size = sum(x[1] - x[0] + 1 for x in self._parts)
+            self.stats = DownloadStats(size, sum(x[2] for x in self._parts))
+            if self.stats.done:
+                import_log.info(f'Продолжение загрузки {self.file_name}: загружено '
+                                f'{get_str_file_size(self.stats.done)} из {get_str_file_size(size)}')
+            parts = [x for x in self._parts if x[0] + x[2] <= x[1]]
+            try:
+                with ThreadPoolExecutor(max(min(len(parts), self.segments), 1)) as pool:
+                    list(pool.map(self._download_part, parts))
+            finally:
+                with self._lock:
+                    self._save_parts()
+            done = sum(x[2] for x in self._parts)
+        else:
+            self.stats = DownloadStats(size)
+            self._download_stream()
+            done = os.path.getsize(self.part)
+        if size and done != size:
+            raise RuntimeError(f'Размер файла {self.file_name} {done} не совпадает с Content-Length {size}')
+        self.stats.size = done
+        os.replace(self.part, self.file_name)
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return self.stats
+
+    def download_members(self, select: Callable[[str], bool],
+                         directory_size: int = DIRECTORY_SIZE) -> DownloadStats:
+        """
+        Загрузить из zip архива только файлы, для которых select(имя) истинно. Оглавление и выбранные файлы
+        записываются на свои места в разреженный файл размера архива: zipfile открывает его как обычный архив,
+        а не загруженные байты не занимают места на диске. Если сервер не поддерживает Range или
+        оглавление не прочитано - загружается весь архив
+        """
+        self._info = self._head()
+        if os.path.isfile(self.file_name) or not (self._info['ranges'] and self._info['size']):
+            return self.download()
+        try:
+            ranges = self._member_ranges(select, directory_size)
+        except (zipfile.BadZipFile, struct.error, requests.RequestException) as e:
+            import_log.warning(f'Не удалось прочитать оглавление {self.url}, загружается весь архив: {e}')
+            return self.download()
+        import_log.info(f'Загрузка {self.file_name}: {get_str_file_size(sum(y - x + 1 for x, y in ranges))} '
+                        f'из {get_str_file_size(self._info["size"])} (выбранные файлы архива)')
+        return self.download(ranges)
+
+
 def get_updates_file_list(version: int = None) -> List[Dict]:
     """
     Получить список обновлений, который нужен именно нам
@@ -57,34 +351,48 @@ def get_updates_file_list(version: int = None) -> List[Dict]:
     return data
 
 
-def download_update(file_obj: Dict, delta: bool = True) -> Dict:
+def disk_size(file_name: str) -> int:
+    """ Место, занятое файлом на диске (меньше размера у разреженных файлов) """
+    stat = os.stat(file_name)
+    blocks = getattr(stat, 'st_blocks', None)
+    return min(stat.st_size, blocks * 512) if blocks is not None else stat.st_size
+
+
+def download_update(file_obj: Dict, delta: bool = True, cancel: Optional[threading.Event] = None) -> Dict:
     """
     Скачать файлы обновлений или изначальный файл, если delta = False
     """
     file_info = dict()
     try:
         url = file_obj['GarXMLDeltaURL'] if delta else file_obj['GarXMLFullURL']
-        local_filename = f"{file_obj['VersionId']}_{os.path.basename(urlparse(url).path)}"
+        # Для выбранных регионов загружаются только справочники и файлы регионов. Имя архива включает регионы -
+        # архив других регионов не будет принят за загруженный ранее
+        region = settings.update.region
+        regions = [f'{x:0=2}' for x in ([region] if isinstance(region, int) else region or [])]
+        str_regions = f"{'-'.join(regions)}_" if regions else ''
+        local_filename = f"{file_obj['VersionId']}_{str_regions}{os.path.basename(urlparse(url).path)}"
         try:
-            headers = {'Content-Length': 0}
-            for _ in range(5):
-                try:
-                    import_log.info(f'Загрузка {url} > {local_filename}')
-                    _, headers = urlretrieve(url, local_filename)
-                    break
-                except Exception as e:
-                    import_log.error(f'Не удалось скачать файл {url}\n{e}')
-
-            size = int(headers.get('Content-Length', 0))
+            import_log.info(f'Загрузка {url} > {local_filename}')
+            downloader = Downloader(url, local_filename, settings.update.download_segments,
+                                    settings.update.download_retries, cancel=cancel)
+            if regions:
+                stats = downloader.download_members(lambda x: '/' not in x or x.split('/')[0] in regions)
+            else:
+                stats = downloader.download()
+            if not zipfile.is_zipfile(local_filename):
+                raise RuntimeError(f'Файл {local_filename} не является zip архивом')
+
             file_info = copy.deepcopy(file_obj)
             file_info['File'] = local_filename
-            import_log.info(f'Загрузка файла завершена. Размер файла: {get_str_file_size(size)}')
+            import_log.info(f'Загрузка файла завершена. Размер файла: {get_str_file_size(stats.size)}, '
+                            f'{stats.seconds:.0f} с, {get_str_file_size(int(stats.speed))}/с')
         except Exception as e:
             # Если какой-то файл не скачали - попробуем это сделать в следующий раз.
-            # Работаем с тем что смогли скачать
+            # Недокачанный файл (.part) остается - следующая загрузка продолжит его
             import_log.error(f'{e}')
             try:
-                os.remove(local_filename)
+                if os.path.exists(local_filename):
+                    os.remove(local_filename)
             except OSError as e:
                 import_log.error(f'{e}')
                 raise e
@@ -93,3 +401,72 @@ def download_update(file_obj: Dict, delta: bool = True) -> Dict:
         import_log.error(f'{e}')
 
     return file_info
+
+
+class UpdateDownloads:
+    """
+    Загрузка архивов обновлений в порядке версий во время импорта. Архив, нужный импорту, загружается сразу,
+    а следующие prefetch архивов - заранее, пока загруженные и не удаленные архивы занимают меньше budget байт
+    (None - без ограничения). Архивы загружаются по одному в отдельном потоке
+    """
+    def __init__(self, update_list: List[Dict], delta: bool = True, prefetch: int = 1, budget: Optional[int] = None,
+                 download: Callable[..., Dict] = download_update) -> None:
+        self.update_list = update_list
+        self.delta = delta
+        self.prefetch = prefetch
+        self.budget = budget
+        self.download = download
+        # Загруженные архивы, количество архивов, запрошенных импортом, и размер архивов на диске
+        self.files: asyncio.Queue = asyncio.Queue()
+        self.requested = 0
+        self.size = 0
+        self._changed = asyncio.Condition()
+        self._cancel = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _allowed(self, index: int) -> bool:
+        if index < self.requested:
+            return True
+        return index < self.requested + self.prefetch and (self.budget is None or self.size < self.budget)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for index, file_obj in enumerate(self.update_list):
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._allowed(index))
+            file_info = await loop.run_in_executor(None, self.download, file_obj, self.delta, self._cancel)
+            if file_info:
+                async with self._changed:
+                    self.size += disk_size(file_info['File'])
+            await self.files.put(file_info)
+            if not file_info:
+                # Следующие версии без этой не импортируются
+                return
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def next(self) -> Dict:
+        """ Следующий архив по порядку версий. Пустой словарь - архив не загружен """
+        async with self._changed:
+            self.requested += 1
+            self._changed.notify_all()
+        return await self.files.get()
+
+    async def remove(self, file_info: Dict) -> None:
+        """ Удалить импортированный архив - освобождается место для следующих """
+        try:
+            size = disk_size(file_info['File'])
+            os.remove(file_info['File'])
+        except OSError:
+            size = 0
+        async with self._changed:
+            self.size -= size
+            self._changed.notify_all()
+
+    async def stop(self) -> None:
+        """ Прервать загрузку заранее. Недокачанный архив продолжится при следующем обновлении """
+        self._cancel.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
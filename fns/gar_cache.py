@@ -0,0 +1,303 @@
+"""
+Кэш разобранных файлов архива в колоночном формате.
+
+Записи файла, прошедшие отбор описания таблицы, сохраняются в каталог {cache_dir}/{версия}/{файл архива}/:
+по файлу на колонку с типизированным массивом значений (int64, bool, дата - порядковый номер дня,
+строки - UTF-8 с завершающим нулем и массив смещений) и признаками пустых значений. Файлы читаются через mmap,
+поэтому повторный импорт того же архива (новый регион, изменение схемы, восстановление БД) не разбирает XML.
+Кэш создается при первом полном чтении файла и проверяется по описанию таблицы, которым он создан.
+Каталог кэша можно удалить в любой момент
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import types
+from array import array
+from bisect import bisect_right
+from datetime import date
+from itertools import accumulate
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Sequence, Set
+
+from fns.gar_rows import Row, TableMapping
+
+# Версия формата кэша
+FORMAT = 1
+META = 'meta.json'
+
+# Типы колонок: целые, логические, даты, строки, колонка без значений
+INT, BOOL, DATE, STR, NONE = 'q', 'b', 'd', 's', 'n'
+
+
+def _kind(value) -> str:
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, int):
+        return INT
+    if isinstance(value, date):
+        return DATE
+    if isinstance(value, str):
+        return STR
+    raise TypeError(f'Тип {type(value).__name__} не поддерживается кэшем')
+
+
+def _constant(value) -> Any:
+    """ Константа байт-кода в виде, не зависящем от процесса (адресов объектов и порядка элементов множеств) """
+    if isinstance(value, types.CodeType):
+        return value.co_code, value.co_names, tuple(_constant(x) for x in value.co_consts)
+    if isinstance(value, frozenset):
+        return sorted(repr(x) for x in value)
+    if isinstance(value, tuple):
+        return tuple(_constant(x) for x in value)
+    return value
+
+
+def _function(function: Optional[Callable], seen: Optional[Set[Callable]] = None) -> Any:
+    """
+    Отпечаток функции разбора: имя, байт-код с константами и именами, а также функции модуля, которые она
+    вызывает. Изменение тела функции меняет отпечаток. У встроенных функций (int, str) - только имя
+    """
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return getattr(function, '__qualname__', None)
+    seen = seen if seen is not None else set()
+    seen.add(function)
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(const.co_names)
+    called = [function.__globals__.get(x) for x in sorted(names)]
+    return (function.__qualname__, _constant(code),
+            [_function(x, seen) for x in called if isinstance(x, types.FunctionType) and x not in seen])
+
+
+def signature(mapping: TableMapping) -> str:
+    """
+    Отпечаток описания таблицы и функций разбора: кэш, созданный другим описанием или до изменения функций,
+    не используется
+    """
+    select = mapping.select
+    description = (
+        mapping.table,
+        [(x.name, x.attr, _function(x.convert), x.default) for x in mapping.columns],
+        _function(mapping.row_filter),
+        sorted((x, sorted(y, key=str)) for x, y in select.values.items()) if select else None,
+        sorted(select.attrs) if select and select.attrs is not None else None,
+    )
+    return hashlib.md5(repr(description).encode()).hexdigest()
+
+
+class _ColumnWriter:
+    """
+    Запись колонки. Тип определяется по первому непустому значению, до него пишутся пустые значения
+    """
+    def __init__(self, path: str, index: int) -> None:
+        self.path = os.path.join(path, f'c{index}')
+        self.kind: Optional[str] = None
+        self.count = 0
+        self.has_nulls = False
+        self._files: Dict[str, BinaryIO] = {}
+        self._size = 0
+
+    def _open(self, kind: str) -> None:
+        self.kind = kind
+        self._files = {x: open(f'{self.path}.{x}', 'wb') for x in ('data', 'nulls')}
+        if kind == STR:
+            self._files['offsets'] = open(f'{self.path}.offsets', 'wb')
+            array(INT, [0]).tofile(self._files['offsets'])
+        # Значения до первого непустого
+        count, self.count = self.count, 0
+        if count:
+            self.write([None] * count)
+
+    def write(self, values: Sequence) -> None:
+        if self.kind is None:
+            kind = next((_kind(x) for x in values if x is not None), None)
+            if kind is None:
+                self.count += len(values)
+                self.has_nulls = True
+                return
+            self._open(kind)
+
+        nulls = bytes(x is None for x in values)
+        if not self.has_nulls and any(nulls):
+            self.has_nulls = True
+        self._files['nulls'].write(nulls)
+        if self.kind == STR:
+            # Значения с завершающим нулем (в XML его быть не может) и смещения конца каждого значения
+            data = [x.encode('utf-8') + b'\0' if x else b'\0' for x in values]
+            offsets = array(INT, accumulate((len(x) for x in data), initial=self._size))
+            self._size = offsets[-1]
+            self._files['data'].write(b''.join(data))
+            array(INT, offsets[1:]).tofile(self._files['offsets'])
+        elif self.kind == DATE:
+            array('i', [x.toordinal() if x is not None else 0 for x in values]).tofile(self._files['data'])
+        else:
+            array(self.kind, [x if x is not None else 0 for x in values]).tofile(self._files['data'])
+        self.count += len(values)
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
+
+
+class CacheWriter:
+    """
+    Запись кэша файла во временный каталог. Каталог кэша появляется только после commit
+    """
+    def __init__(self, path: str, mapping: TableMapping) -> None:
+        self.path = path
+        self.temp = f'{path}.tmp'
+        self.signature = signature(mapping)
+        shutil.rmtree(self.temp, ignore_errors=True)
+        os.makedirs(self.temp)
+        self.columns = [_ColumnWriter(self.temp, i) for i in range(len(mapping.columns))]
+        self.ordinals = open(os.path.join(self.temp, 'ordinals'), 'wb')
+        self.rows = 0
+        self.committed = False
+
+    def write(self, rows: List[Row], ordinals: List[int]) -> None:
+        """ Записать пакет записей и номера их записей XML в файле """
+        if not rows:
+            return
+        for column, values in zip(self.columns, zip(*rows)):
+            column.write(values)
+        array(INT, ordinals).tofile(self.ordinals)
+        self.rows += len(rows)
+
+    def commit(self, items: int) -> None:
+        """ items - количество записей XML в файле """
+        self.close()
+        meta = {
+            'format': FORMAT,
+            'signature': self.signature,
+            'rows': self.rows,
+            'items': items,
+            'columns': [{'kind': x.kind or NONE, 'nulls': x.has_nulls} for x in self.columns],
+        }
+        with open(os.path.join(self.temp, META), 'w') as file:
+            json.dump(meta, file)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.temp, self.path)
+        self.committed = True
+
+    def close(self) -> None:
+        self.ordinals.close()
+        for column in self.columns:
+            column.close()
+
+    def discard(self) -> None:
+        if not self.committed:
+            self.close()
+            shutil.rmtree(self.temp, ignore_errors=True)
+
+
+class CacheReader:
+    """
+    Чтение кэша файла. Файлы колонок отображаются в память, записи собираются пакетами
+    """
+    def __init__(self, path: str, meta: Dict) -> None:
+        self.path = path
+        self.rows: int = meta['rows']
+        self.items: int = meta['items']
+        self.kinds: List[str] = [x['kind'] for x in meta['columns']]
+        self.nulls: List[bool] = [x['nulls'] for x in meta['columns']]
+        self._maps: List[mmap.mmap] = []
+
+    def _view(self, name: str, kind: str) -> Sequence:
+        file_name = os.path.join(self.path, name)
+        if not os.path.getsize(file_name):
+            return memoryview(b'').cast(kind)
+        with open(file_name, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(data)
+        return memoryview(data).cast(kind)
+
+    def batches(self, batch_length: int, skip: int = 0) -> Iterator:
+        """
+        Пакеты записей с номерами записей XML после пакета (как у read_batches): (смещение, записи).
+        skip - количество уже сохраненных записей XML
+        """
+        ordinals = self._view('ordinals', INT)
+        columns = []
+        for i, kind in enumerate(self.kinds):
+            column = {'kind': kind}
+            if kind != NONE:
+                column['data'] = self._view(f'c{i}.data', 'B' if kind == STR else 'i' if kind == DATE else kind)
+                column['nulls'] = self._view(f'c{i}.nulls', 'B') if self.nulls[i] else None
+            if kind == STR:
+                column['offsets'] = self._view(f'c{i}.offsets', INT)
+            columns.append(column)
+        try:
+            start = bisect_right(ordinals, skip)
+            if start >= self.rows:
+                yield self.items, []
+            while start < self.rows:
+                end = min(start + batch_length, self.rows)
+                values = [self._values(x, start, end) for x in columns]
+                yield ordinals[end - 1] if end < self.rows else self.items, list(zip(*values))
+                start = end
+        finally:
+            del ordinals, columns
+            self.close()
+
+    @staticmethod
+    def _values(column: Dict, start: int, end: int) -> List:
+        kind = column['kind']
+        if kind == NONE:
+            return [None] * (end - start)
+        data = column['data']
+        if kind == STR:
+            offsets = column['offsets']
+            values = bytes(data[offsets[start]:offsets[end]]).decode('utf-8').split('\0')[:-1]
+        elif kind == DATE:
+            ordinals = data[start:end].tolist()
+            dates = {x: date.fromordinal(x) for x in set(ordinals) if x}
+            values = [dates.get(x) for x in ordinals]
+        elif kind == BOOL:
+            values = [bool(x) for x in data[start:end].tolist()]
+        else:
+            values = data[start:end].tolist()
+        nulls = column['nulls']
+        if nulls is not None:
+            flags = nulls[start:end]
+            if any(flags):
+                values = [None if flag else value for flag, value in zip(flags, values)]
+        return values
+
+    def close(self) -> None:
+        for data in self._maps:
+            try:
+                data.close()
+            except BufferError:
+                # Остались ссылки на память файла - закроется сборщиком мусора
+                pass
+        self._maps = []
+
+
+class MemberCache:
+    """
+    Кэш файлов архива одной версии
+    """
+    def __init__(self, cache_dir: str, version: int) -> None:
+        self.path = os.path.join(cache_dir, str(version))
+
+    def _member_path(self, file_name: str) -> str:
+        return os.path.join(self.path, *file_name.split('/'))
+
+    def reader(self, file_name: str, mapping: TableMapping) -> Optional[CacheReader]:
+        path = self._member_path(file_name)
+        try:
+            with open(os.path.join(path, META)) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if meta.get('format') != FORMAT or meta.get('signature') != signature(mapping):
+            return None
+        return CacheReader(path, meta)
+
+    def writer(self, file_name: str, mapping: TableMapping) -> CacheWriter:
+        path = self._member_path(file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return CacheWriter(path, mapping)
@@ -0,0 +1,43 @@
+"""
+Индекс object_id объектов, загруженных при импорте
+"""
+from typing import Dict, Iterable
+
+# Количество object_id на страницу битовой карты (страница - 8 КБ)
+PAGE_BITS = 1 << 16
+
+
+class ObjectIdIndex:
+    """
+    Множество object_id в виде битовой карты: бит с номером object_id.
+    Карта выделяется страницами только для занятых диапазонов идентификаторов.
+    Идентификаторы ГАР плотные, порядка 10^8, поэтому на всю Россию карта занимает десятки МБ
+    против нескольких ГБ для set из int
+    """
+    def __init__(self) -> None:
+        self._pages: Dict[int, bytearray] = {}
+        self.count = 0
+
+    def add(self, object_ids: Iterable[int]) -> None:
+        pages = self._pages
+        for object_id in object_ids:
+            page = pages.get(object_id >> 16)
+            if page is None:
+                page = pages[object_id >> 16] = bytearray(PAGE_BITS >> 3)
+            pos = (object_id & 0xFFFF) >> 3
+            mask = 1 << (object_id & 7)
+            if not page[pos] & mask:
+                page[pos] |= mask
+                self.count += 1
+
+    def __contains__(self, object_id: int) -> bool:
+        page = self._pages.get(object_id >> 16)
+        return page is not None and bool(page[(object_id & 0xFFFF) >> 3] & (1 << (object_id & 7)))
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def memory(self) -> int:
+        """ Размер карты в байтах """
+        return len(self._pages) * (PAGE_BITS >> 3)
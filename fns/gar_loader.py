@@ -0,0 +1,446 @@
+"""
+Запись разобранных записей ГАР в базу данных
+"""
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiosqlite
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+
+from core.database import create_task, database
+from core.log import import_log
+from core.settings import settings
+from fns.gar_reader import BATCH_LENGTH
+from fns.gar_rows import Row
+
+# Количество добавленных и измененных записей
+Counts = Tuple[int, int]
+
+
+def primary_key(table: sqlalchemy.Table) -> str:
+    """ Колонка первичного ключа (id у всех таблиц ГАР, object_id у object_routes) """
+    return table.primary_key.columns.values()[0].name
+
+
+def upsert_query(table: sqlalchemy.Table, rows: List[Row], changed: bool = False):
+    """
+    Запрос добавления записей с обновлением уже существующих (по первичному ключу) для текущей БД.
+    changed - обновлять только измененные записи (MySQL не перезаписывает строки с теми же значениями сам),
+    в PostgreSQL запрос при этом возвращает признак inserted для каждой записанной строки
+    """
+    pk = primary_key(table)
+    columns = [x for x in table.columns.keys() if x != pk]
+    if settings.database.driver_name == settings.database.DriverName.mysql:
+        query = mysql.insert(table).values(rows)
+        return query.on_duplicate_key_update({x: query.inserted[x] for x in columns})
+
+    is_postgresql = settings.database.driver_name == settings.database.DriverName.postgresql
+    query = (postgresql if is_postgresql else sqlite).insert(table).values(rows)
+    query = query.on_conflict_do_update(index_elements=[pk], set_={x: query.excluded[x] for x in columns},
+                                        where=sqlalchemy.text(changed_condition(table)) if changed else None)
+    if changed and is_postgresql:
+        # xmax = 0 только у вставленных строк
+        query = query.returning(sqlalchemy.literal_column('xmax = 0').label('inserted'))
+    return query
+
+
+def insert_new_query(table: sqlalchemy.Table, rows: List[Row]):
+    """ Запрос добавления только новых записей: существующие (по первичному ключу) не изменяются """
+    pk = primary_key(table)
+    if settings.database.driver_name == settings.database.DriverName.mysql:
+        # Присваивание ключа самому себе не меняет строку и не учитывается в rowcount
+        query = mysql.insert(table).values(rows)
+        return query.on_duplicate_key_update({pk: query.inserted[pk]})
+    dialect = postgresql if settings.database.driver_name == settings.database.DriverName.postgresql else sqlite
+    return dialect.insert(table).values(rows).on_conflict_do_nothing(index_elements=[pk])
+
+
+def changed_condition(table: sqlalchemy.Table) -> str:
+    """
+    Условие обновления существующей записи в upsert: значения колонок отличаются.
+    Неизмененные записи не перезаписываются - нет новой версии строки, журнала и обновления индексов
+    """
+    pk = primary_key(table)
+    columns = [x for x in table.columns.keys() if x != pk]
+    operator = 'is distinct from' if settings.database.driver_name == settings.database.DriverName.postgresql \
+        else 'is not'
+    return f'({", ".join(f"{table.name}.{x}" for x in columns)}) {operator} ' \
+           f'({", ".join(f"excluded.{x}" for x in columns)})'
+
+
+def create_index_query(index: sqlalchemy.Index) -> str:
+    """ CREATE INDEX IF NOT EXISTS для SQLite и PostgreSQL (в SQLAlchemy 1.4 нет if_not_exists) """
+    dialect = postgresql if settings.database.driver_name == settings.database.DriverName.postgresql else sqlite
+    query = str(CreateIndex(index).compile(dialect=dialect.dialect()))
+    return query.replace('CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS ', 1) \
+        .replace('CREATE UNIQUE INDEX ', 'CREATE UNIQUE INDEX IF NOT EXISTS ', 1)
+
+
+class OrmarLoader:
+    """
+    Запись блоками через подключение ormar (databases) запросом INSERT с несколькими VALUES.
+    Подходит для любой БД
+    """
+    def __init__(self) -> None:
+        self.log = import_log
+        is_sqlite = settings.database.driver_name == settings.database.DriverName.sqlite
+        # Для sqlite размер загружаемого блока - 50, для остальных 1000
+        self.block_length = 50 if is_sqlite else 1000
+        # Количество одновременных задач записи. SQLite не поддерживает параллельную запись
+        self.writers = 1 if is_sqlite else max(settings.update.writers, 1)
+        # Количество одновременно импортируемых таблиц. Параллельные транзакции разных подключений к SQLite
+        # приводят к ошибкам блокировки БД
+        self.steps = 1 if is_sqlite else max(settings.update.steps, 1)
+        # Индексы пустых таблиц удаляются на время загрузки и создаются после нее
+        self.defer_indexes = settings.update.defer_indexes and settings.database.driver_name in (
+            settings.database.DriverName.sqlite, settings.database.DriverName.postgresql
+        )
+
+    async def open(self) -> None:
+        """ Подготовка к импорту архива """
+
+    async def close(self) -> None:
+        """ Завершение импорта архива """
+
+    @asynccontextmanager
+    async def transaction(self, file: str) -> AsyncIterator[None]:
+        """
+        Запись блока файла архива одной транзакцией подключения задачи.
+        Ошибочный блок откатывается до точки сохранения (вложенная транзакция), поэтому запись по одной
+        записи продолжается в той же транзакции
+        """
+        async with database.transaction():
+            yield
+
+    async def _ddl(self, query: str) -> None:
+        await database.execute(query)
+
+    async def drop_indexes(self, table: sqlalchemy.Table) -> None:
+        """ Удалить индексы таблицы перед загрузкой """
+        for index in table.indexes:
+            await self._ddl(f'drop index if exists {index.name}')
+
+    async def create_indexes(self, table: sqlalchemy.Table) -> None:
+        """ Создать индексы таблицы, которых нет """
+        for index in table.indexes:
+            await self._ddl(create_index_query(index))
+
+    async def rebuild_indexes(self, table: sqlalchemy.Table) -> None:
+        """ Создать индексы после загрузки с замером времени """
+        start = time.perf_counter()
+        await self.create_indexes(table)
+        self.log.info(f'{table.name}: создано индексов {len(table.indexes)} за {time.perf_counter() - start:.2f} с')
+
+    async def checkpoint(self, table: sqlalchemy.Table, row: Row) -> None:
+        """ Сохранить запись состояния импорта (добавить или обновить по id) """
+        await database.execute(upsert_query(table, [row]))
+
+    async def create(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        """
+        Добавить записи в таблицу, которая изначально была пустой
+        """
+        await self._bulk_create(file, model.Meta.table, rows)
+        return len(rows), 0
+
+    async def merge(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        """
+        Добавить новые и обновить измененные записи без чтения существующих, записи без изменений
+        не перезаписываются
+        """
+        return await self._upsert(file, model.Meta.table, rows)
+
+    @classmethod
+    async def _execute_upsert(cls, table: sqlalchemy.Table, rows: List[Row]) -> Counts:
+        """
+        PostgreSQL - один upsert, добавленные строки отличает RETURNING. В остальных БД первый запрос
+        добавляет новые записи, второй обновляет измененные: количество строк, записанных каждым из них, -
+        точное количество добавленных и обновленных
+        """
+        if settings.database.driver_name == settings.database.DriverName.postgresql:
+            written = await database.fetch_all(upsert_query(table, rows, True))
+            inserted = sum(1 for x in written if x['inserted'])
+            return inserted, len(written) - inserted
+        inserted = await cls._changes(insert_new_query(table, rows))
+        updated = await cls._changes(upsert_query(table, rows, True))
+        if settings.database.driver_name == settings.database.DriverName.mysql:
+            # ON DUPLICATE KEY UPDATE учитывает обновленную строку в rowcount дважды
+            updated //= 2
+        return inserted, updated
+
+    @staticmethod
+    async def _changes(query) -> int:
+        """ Выполнить запрос, возвращает количество измененных им строк """
+        if settings.database.driver_name == settings.database.DriverName.sqlite:
+            async with database.connection() as connection:
+                raw = connection.raw_connection
+                changes = raw.total_changes
+                await connection.execute(query)
+                return raw.total_changes - changes
+        # MySQL: у таблиц ГАР нет автоинкремента, поэтому databases возвращает rowcount, а не lastrowid
+        return await database.execute(query)
+
+    async def _upsert(self, file: str, table: sqlalchemy.Table, rows: List[Row]) -> Counts:
+        try:
+            async with database.transaction():
+                return await self._execute_upsert(table, rows)
+        except Exception as block_except:
+            # Ошибка при записи блока. Пробуем записывать по одной записи
+            self.log.warning(f'Ошибка при записи блока. {file}. Записываем по одной записи: {block_except}')
+            inserted = updated = 0
+            for row in rows:
+                try:
+                    async with database.transaction():
+                        counts = await self._execute_upsert(table, [row])
+                    inserted, updated = inserted + counts[0], updated + counts[1]
+                except Exception as e:
+                    self.log.error(f'File {file}.\n\tItem: {row}\n{e}')
+            return inserted, updated
+
+    async def _bulk_create(self, file: str, table: sqlalchemy.Table, rows: List[Row]) -> None:
+        try:
+            async with database.transaction():
+                await database.execute(table.insert().values(rows))
+        except Exception as block_except:
+            # Ошибка при добавлении блока. Пробуем добавлять по одной записи
+            self.log.warning(f'Ошибка при добавлении блока. {file}. Добавляем по одной записи: {block_except}')
+            for row in rows:
+                try:
+                    async with database.transaction():
+                        await database.execute(table.insert().values([row]))
+                except Exception as e:
+                    self.log.error(f'File {file}.\n\tItem: {row}\n{e}')
+
+
+class PostgresLoader(OrmarLoader):
+    """
+    Запись через бинарный COPY asyncpg.
+    В пустую таблицу записи копируются напрямую, для обновлений - через временную таблицу
+    с последующим INSERT ... ON CONFLICT. При ошибке блок записывается обычным INSERT
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.block_length = 5000
+
+    async def create(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        table = model.Meta.table
+        columns = list(table.columns.keys())
+        try:
+            async with database.connection() as connection:
+                # Внутри транзакции блока - точка сохранения, ошибка COPY не прерывает транзакцию
+                async with connection.raw_connection.transaction():
+                    await connection.raw_connection.copy_records_to_table(
+                        table.name, records=rows, columns=columns
+                    )
+        except Exception as e:
+            self.log.warning(f'Ошибка COPY. {file}. Добавляем через INSERT: {e}')
+            return await super().create(file, model, rows)
+        return len(rows), 0
+
+    @staticmethod
+    def _merge_query(table: sqlalchemy.Table, temp_table: str) -> str:
+        """
+        Перенос записей из временной таблицы. xmax = 0 только у вставленных строк,
+        записи без изменений не обновляются и не возвращаются
+        """
+        columns = list(table.columns.keys())
+        str_columns = ', '.join(columns)
+        pk = primary_key(table)
+        str_update = ', '.join(f'{x} = excluded.{x}' for x in columns if x != pk)
+        return (f'insert into {table.name} ({str_columns}) select {str_columns} from {temp_table} '
+                f'on conflict ({pk}) do update set {str_update} where {changed_condition(table)} '
+                f'returning (xmax = 0) as inserted')
+
+    async def merge(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        table = model.Meta.table
+        columns = list(table.columns.keys())
+        temp_table = f'_gar_{table.name}'
+        try:
+            async with database.connection() as connection:
+                raw = connection.raw_connection
+                async with raw.transaction():
+                    # Таблица удаляется при фиксации транзакции блока, а не точки сохранения
+                    await raw.execute(f'drop table if exists {temp_table}')
+                    await raw.execute(f'create temp table {temp_table} (like {table.name}) on commit drop')
+                    await raw.copy_records_to_table(
+                        temp_table, records=rows, columns=columns
+                    )
+                    inserted = await raw.fetch(self._merge_query(table, temp_table))
+        except Exception as e:
+            self.log.warning(f'Ошибка COPY. {file}. Записываем через upsert: {e}')
+            return await super().merge(file, model, rows)
+        count = sum(1 for x in inserted if x['inserted'])
+        return count, len(inserted) - count
+
+    async def create_indexes(self, table: sqlalchemy.Table) -> None:
+        # Индексы создаются параллельно, каждый в своем подключении
+        await asyncio.gather(*[create_task(self._ddl(create_index_query(x))) for x in table.indexes])
+
+
+class SqliteLoader(OrmarLoader):
+    """
+    Быстрый режим импорта в SQLite.
+    Отдельное подключение к файлу БД с WAL, отключенной синхронизацией и большим кэшем.
+    Каждый блок записывается одной транзакцией через executemany,
+    транзакции выполняются по очереди. После импорта безопасные настройки восстанавливаются
+    """
+    # Настройки подключения на время импорта. Кроме journal_mode все они действуют только для этого подключения
+    import_pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -1024 * 1024,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self) -> None:
+        super().__init__()
+        # executemany передает параметры построчно, ограничения на количество переменных нет.
+        # Блок - одна транзакция, поэтому пакет читателя записывается целиком
+        self.block_length = BATCH_LENGTH
+        # Запись идет через одно подключение, транзакции блоков выполняются по очереди
+        self.steps = max(settings.update.steps, 1)
+        self._connection: Optional[aiosqlite.Connection] = None
+        # Прежние значения настроек, которые восстанавливаются после импорта
+        self._pragmas: Dict[str, Any] = {}
+        self._lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        self._connection = await aiosqlite.connect(settings.database.base, isolation_level=None)
+        for name in ('journal_mode', 'synchronous'):
+            async with self._connection.execute(f'pragma {name}') as cursor:
+                self._pragmas[name] = (await cursor.fetchone())[0]
+        for name, value in self.import_pragmas.items():
+            await self._execute(f'pragma {name} = {value}')
+
+    async def close(self) -> None:
+        if not self._connection:
+            return
+        try:
+            # После ошибки импорта транзакция может остаться открытой - в ней режим журнала не меняется
+            if self._connection.in_transaction:
+                await self._execute('rollback')
+            try:
+                await self._execute('pragma wal_checkpoint(TRUNCATE)')
+            finally:
+                await self._restore_pragmas()
+        finally:
+            await self._connection.close()
+            self._connection = None
+
+    async def _restore_pragmas(self) -> None:
+        """ Режим журнала сохраняется в файле БД, synchronous - в подключении: возвращаем прежние """
+        for name, value in self._pragmas.items():
+            try:
+                await self._execute(f'pragma {name} = {value}')
+            except sqlite3.OperationalError as e:
+                self.log.warning(f'Не удалось восстановить {name}={value}: {e}')
+        self._pragmas = {}
+
+    @asynccontextmanager
+    async def transaction(self, file: str) -> AsyncIterator[None]:
+        async with self._lock:
+            await self._execute('begin')
+            try:
+                yield
+            except BaseException:
+                await self._execute('rollback')
+                raise
+            await self._execute('commit')
+
+    async def _ddl(self, query: str) -> None:
+        # Через то же подключение, что и запись блоков, чтобы не ждать блокировку БД
+        async with self._lock:
+            await self._execute(query)
+
+    async def _execute(self, query: str, parameters: Tuple = ()) -> None:
+        # Курсор закрываем сразу, незавершенный запрос не дает сменить режим журнала
+        async with self._connection.execute(query, parameters):
+            pass
+
+    @staticmethod
+    def _records(table: sqlalchemy.Table, rows: List[Row]) -> List[Row]:
+        """ Даты храним строками в том же формате, что и SQLAlchemy """
+        converters = [
+            (i, date.isoformat if isinstance(x.type, sqlalchemy.Date) else
+             lambda value: value.strftime('%Y-%m-%d %H:%M:%S.%f'))
+            for i, x in enumerate(table.columns) if isinstance(x.type, (sqlalchemy.Date, sqlalchemy.DateTime))
+        ]
+        if not converters:
+            return rows
+        records = []
+        for row in rows:
+            record = list(row)
+            for i, convert in converters:
+                if record[i] is not None:
+                    record[i] = convert(record[i])
+            records.append(tuple(record))
+        return records
+
+    @staticmethod
+    def _insert_query(table: sqlalchemy.Table, upsert: bool, changed: bool = False, new: bool = False) -> str:
+        """ changed - обновлять только измененные записи, new - добавлять только новые """
+        columns = list(table.columns.keys())
+        query = f'insert into {table.name} ({", ".join(columns)}) values ({", ".join("?" * len(columns))})'
+        if new:
+            query += f' on conflict ({primary_key(table)}) do nothing'
+        elif upsert:
+            pk = primary_key(table)
+            update = ', '.join(f'{x} = excluded.{x}' for x in columns if x != pk)
+            query += f' on conflict ({pk}) do update set {update}'
+            if changed:
+                query += f' where {changed_condition(table)}'
+        return query
+
+    async def _execute_many(self, file: str, table: sqlalchemy.Table, rows: List[Row], query: str,
+                            row_query: str) -> int:
+        """ Записать блок запросом query, при ошибке - по одной записи row_query. Возвращает количество изменений """
+        records = self._records(table, rows)
+        changes = self._connection.total_changes
+        try:
+            async with self._connection.executemany(query, records):
+                pass
+        except Exception as block_except:
+            # Ошибка при записи блока. Пробуем записывать по одной записи
+            self.log.warning(f'Ошибка при записи блока. {file}. Записываем по одной записи: {block_except}')
+            for row, record in zip(rows, records):
+                try:
+                    await self._execute(row_query, record)
+                except Exception as e:
+                    self.log.error(f'File {file}.\n\tItem: {row}\n{e}')
+        return self._connection.total_changes - changes
+
+    async def checkpoint(self, table: sqlalchemy.Table, row: Row) -> None:
+        await self._execute(self._insert_query(table, True), self._records(table, [row])[0])
+
+    async def create(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        table = model.Meta.table
+        await self._execute_many(file, table, rows, self._insert_query(table, False), self._insert_query(table, True))
+        return len(rows), 0
+
+    async def merge(self, file: str, model: Any, rows: List[Row]) -> Counts:
+        """
+        Первый запрос добавляет новые записи, второй обновляет измененные: их изменения (total_changes) -
+        количество добавленных и обновленных. Записи без изменений не перезаписываются
+        """
+        table = model.Meta.table
+        new = self._insert_query(table, True, new=True)
+        changed = self._insert_query(table, True, True)
+        inserted = await self._execute_many(file, table, rows, new, new)
+        return inserted, await self._execute_many(file, table, rows, changed, changed)
+
+
+def get_loader() -> OrmarLoader:
+    """
+    Получить загрузчик для текущей БД
+    """
+    if settings.database.driver_name == settings.database.DriverName.postgresql:
+        return PostgresLoader()
+    if settings.database.driver_name == settings.database.DriverName.sqlite and settings.database.fast_import:
+        return SqliteLoader()
+    return OrmarLoader()
@@ -0,0 +1,200 @@
+"""
+Конвейер импорта файлов архива: чтение -> преобразование -> запись в БД.
+
+Файлы читаются не более чем readers одновременно (разбор XML и преобразование записей выполняет
+ArchiveReader - в текущем процессе или в пуле), блоки записей передаются писателям через общую
+ограниченную очередь. Когда запись не успевает, читатели ждут освобождения очереди, поэтому
+объем памяти не зависит от размера архива и количества файлов
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.database import create_task
+from core.log import import_log
+from fns.download import get_str_file_size
+from fns.gar_reader import ArchiveReader, Batch, RowParser
+from fns.gar_rows import Row
+
+Counts = Tuple[int, int]
+Writer = Callable[[str, List[Row]], Awaitable[Counts]]
+# Сохранение состояния файла
+Progress = Callable[[str, 'FileState'], Awaitable]
+
+
+class FileState:
+    """
+    Состояние записи файла архива.
+    Блоки записываются несколькими писателями в произвольном порядке, поэтому сохраненной считается
+    только непрерывная последовательность записанных блоков от начала файла
+    """
+    def __init__(self, offset: int = 0, size: int = 0) -> None:
+        self.inserted = 0
+        self.updated = 0
+        # Показатели чтения: размер файла, распаковано байт, прочитано записей XML, осталось после отбора,
+        # время разбора XML, преобразования записей и записи в БД (сумма по писателям)
+        self.size = size
+        self.read_bytes = 0
+        self.read_rows = 0
+        self.kept_rows = 0
+        self.parse_time = 0.0
+        self.convert_time = 0.0
+        self.write_time = 0.0
+        # Блоки в очереди и в записи
+        self.pending = 0
+        self.read = False
+        # Количество записей XML, сохраненных в БД (с учетом пропущенных при продолжении импорта)
+        self.offset = offset
+        # Номер следующего блока, номер первого не записанного блока и смещения записанных блоков
+        self.blocks = 0
+        self._next = 0
+        self._written: Dict[int, int] = {}
+
+    @property
+    def done(self) -> bool:
+        return self.read and not self.pending
+
+    def add_block(self) -> int:
+        self.pending += 1
+        self.blocks += 1
+        return self.blocks - 1
+
+    def block_written(self, block: int, offset: int) -> bool:
+        """ Отметить записанный блок. Возвращает True, если сохраненное смещение увеличилось """
+        self.pending -= 1
+        self._written[block] = offset
+        offset = self.offset
+        while self._next in self._written:
+            self.offset = self._written.pop(self._next)
+            self._next += 1
+        return self.offset != offset
+
+    def add_batch(self, batch: Batch) -> None:
+        self.read_bytes += batch.size
+        self.read_rows = batch.offset
+        self.kept_rows += len(batch.rows)
+        self.parse_time += batch.parse
+        self.convert_time += batch.convert
+
+    def __str__(self) -> str:
+        return (f'добавлено {self.inserted}, обновлено {self.updated}; прочитано записей {self.read_rows}, '
+                f'отобрано {self.kept_rows}, распаковано {get_str_file_size(self.read_bytes)}; '
+                f'разбор XML {self.parse_time:.2f} с, преобразование {self.convert_time:.2f} с, '
+                f'запись {self.write_time:.2f} с')
+
+
+class QueueStats:
+    """ Глубина очереди и время ожидания читателей и писателей """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        # Читатели ждут места в очереди - не успевает запись, писатели ждут блоки - не успевает чтение
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+
+    def sample(self, depth: int) -> None:
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    def __str__(self) -> str:
+        mean = self.total / self.samples if self.samples else 0
+        return (f'очередь в среднем {mean:.1f}, максимум {self.max} из {self.size}; '
+                f'ожидание чтения {self.write_wait:.1f} с, ожидание записи {self.read_wait:.1f} с')
+
+
+class ImportPipeline:
+    def __init__(self, reader: ArchiveReader, readers: int, writers: int, queue_size: int,
+                 block_length: int) -> None:
+        assert readers > 0 and writers > 0 and queue_size > 0, 'Не корректно заданы параметры конвейера'
+        self.log = import_log
+        self.reader = reader
+        self.readers = readers
+        self.writers = writers
+        self.queue_size = queue_size
+        self.block_length = block_length
+
+    async def run(self, files: List[str], parser: RowParser, write: Writer, skip: Optional[Dict[str, int]] = None,
+                  progress: Optional[Progress] = None) -> Dict[str, Counts]:
+        """
+        Импортировать файлы. write записывает блок файла и возвращает количество добавленных и обновленных.
+        skip - количество уже сохраненных записей XML по файлам, progress - сохранение состояния файла.
+        Возвращает количество добавленных и обновленных записей по файлам
+        """
+        skip = skip or {}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        semaphore = asyncio.Semaphore(self.readers)
+        states = {x: FileState(skip.get(x, 0), self.reader.archive.getinfo(x).file_size) for x in files}
+        stats = QueueStats(self.queue_size)
+
+        async def file_progress(file_name: str) -> None:
+            state = states[file_name]
+            if state.done:
+                self.log.info(f'{file_name}: {state}')
+            if progress:
+                await progress(file_name, state)
+
+        async def read(file_name: str) -> None:
+            state = states[file_name]
+            async with semaphore:
+                offset = state.offset
+                async for batch in self.reader.batches(file_name, parser, offset):
+                    state.add_batch(batch)
+                    rows = batch.rows
+                    # Передаем на запись блоками по block_length записей. Смещение пакета сохраняется
+                    # с его последним блоком, остальные блоки смещение не меняют
+                    for i in range(0, len(rows), self.block_length):
+                        block = state.add_block()
+                        end = batch.offset if i + self.block_length >= len(rows) else offset
+                        start = time.perf_counter()
+                        await queue.put((file_name, block, end, rows[i:i + self.block_length]))
+                        stats.read_wait += time.perf_counter() - start
+                        stats.sample(queue.qsize())
+                    offset = batch.offset
+            state.read = True
+            if state.done:
+                await file_progress(file_name)
+
+        async def write_blocks() -> None:
+            while True:
+                start = time.perf_counter()
+                item = await queue.get()
+                stats.write_wait += time.perf_counter() - start
+                if item is None:
+                    break
+                file_name, block, offset, rows = item
+                state = states[file_name]
+                start = time.perf_counter()
+                inserted, updated = await write(file_name, rows)
+                state.write_time += time.perf_counter() - start
+                state.inserted += inserted
+                state.updated += updated
+                if state.block_written(block, offset) or state.done:
+                    await file_progress(file_name)
+
+        # Чтение сохраняет состояние файлов (file_progress), поэтому тоже со своим подключением
+        read_tasks = [create_task(read(x)) for x in files]
+
+        async def close_queue() -> None:
+            await asyncio.gather(*read_tasks)
+            # Признак окончания для каждого писателя
+            for _ in range(self.writers):
+                await queue.put(None)
+
+        # У каждого писателя свое подключение к БД
+        tasks = read_tasks + [create_task(write_blocks()) for _ in range(self.writers)]
+        tasks.append(asyncio.create_task(close_queue()))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                # Ошибка чтения или записи останавливает весь конвейер
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.log.info(f'Конвейер: файлов {len(files)}, {stats}')
+        return {x: (y.inserted, y.updated) for x, y in states.items()}
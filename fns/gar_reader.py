@@ -0,0 +1,253 @@
+import asyncio
+import functools
+import multiprocessing
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+from fns.gar_cache import CacheReader, MemberCache
+from fns.gar_rows import Row, TableMapping
+from fns.gar_xml import XmlStats, rows_from_xml
+
+# Количество записей в пакете, который передается из процесса чтения
+BATCH_LENGTH = 5000
+
+RowParser = Callable[[Dict[str, str]], Optional[Row]]
+
+
+class Batch:
+    """
+    Пакет разобранных записей файла: количество прочитанных записей XML файла после пакета, записи пакета,
+    объем распакованных для пакета данных и время разбора XML и преобразования записей
+    """
+    def __init__(self, offset: int, rows: List[Row], size: int = 0, parse: float = 0.0,
+                 convert: float = 0.0) -> None:
+        self.offset = offset
+        self.rows = rows
+        self.size = size
+        self.parse = parse
+        self.convert = convert
+
+
+# Очередь результатов процесса пула (задается при запуске процесса)
+_results: Optional[multiprocessing.Queue] = None
+
+
+def read_batches(archive: zipfile.ZipFile, file_name: str, parser: RowParser,
+                 batch_length: int = BATCH_LENGTH, skip: int = 0,
+                 cache: Optional[MemberCache] = None) -> Iterator[Batch]:
+    """
+    Прочитать файл архива пакетами разобранных записей. Отброшенные парсером записи пропускаются.
+    skip - сколько первых записей XML пропустить без разбора (продолжение прерванного импорта).
+    Последний пакет передается всегда, даже пустой, - с ним приходит время разбора конца файла.
+    cache - при полном чтении файла сохранить разобранные записи в кэш
+    """
+    xml = XmlStats()
+    batch = []
+    offset = 0
+    # Время пакета считаем без ожидания его получателя
+    start, parsed, size = time.perf_counter(), 0.0, 0
+    # Номера записей XML для кэша
+    writer = cache.writer(file_name, parser) if cache and not skip and isinstance(parser, TableMapping) else None
+    ordinals: List[int] = []
+
+    def complete() -> Batch:
+        nonlocal batch, parsed, size
+        if writer:
+            writer.write(batch, ordinals)
+            ordinals.clear()
+        parse = xml.seconds - parsed
+        result = Batch(offset, batch, xml.bytes - size, parse, time.perf_counter() - start - parse)
+        batch, parsed, size = [], xml.seconds, xml.bytes
+        return result
+
+    # Отбор по значениям атрибутов и выбор атрибутов описания таблицы выполняются при разборе XML
+    select = parser.select if isinstance(parser, TableMapping) else None
+    try:
+        for offset, item in enumerate(rows_from_xml(archive, file_name, xml, select), 1):
+            if offset <= skip or item is None:
+                continue
+            row = parser(item)
+            if row:
+                batch.append(row)
+                if writer:
+                    ordinals.append(offset)
+                if len(batch) >= batch_length:
+                    yield complete()
+                    start = time.perf_counter()
+        last = complete()
+        if writer:
+            writer.commit(offset)
+        yield last
+    finally:
+        if writer:
+            writer.discard()
+
+
+def cached_batches(cache: CacheReader, size: int, batch_length: int = BATCH_LENGTH,
+                   skip: int = 0) -> Iterator[Batch]:
+    """
+    Прочитать разобранные записи файла из кэша. Объем распакованных данных считается пропорционально
+    номеру записи XML (size - размер файла в архиве), чтобы показатели импорта не зависели от источника записей
+    """
+    read = skip
+    start = time.perf_counter()
+    for offset, rows in cache.batches(batch_length, skip):
+        yield Batch(offset, rows, size * (offset - read) // max(cache.items, 1), time.perf_counter() - start)
+        read = offset
+        start = time.perf_counter()
+
+
+def _init_worker(results: multiprocessing.Queue) -> None:
+    global _results
+    _results = results
+
+
+def _read_member(archive_name: str, file_name: str, parser: RowParser, skip: int,
+                 cache: Optional[MemberCache]) -> None:
+    """
+    Прочитать файл архива в процессе пула. Архив открывается в каждом процессе отдельно,
+    пакеты записей передаются через общую очередь результатов, None - признак окончания файла
+    """
+    try:
+        with zipfile.ZipFile(archive_name, mode='r', allowZip64=True) as archive:
+            for batch in read_batches(archive, file_name, parser, skip=skip, cache=cache):
+                _results.put((file_name, batch))
+    except Exception as e:
+        _results.put((file_name, RuntimeError(f'{file_name}: {e}')))
+    else:
+        _results.put((file_name, None))
+
+
+class ArchiveSet:
+    """
+    Несколько архивов обновлений как один архив (для объединения обновлений в один импорт).
+    Имена файлов ГАР содержат дату выгрузки, поэтому в разных архивах не повторяются.
+    filename - имя самого нового архива
+    """
+    def __init__(self, archives: List[zipfile.ZipFile]) -> None:
+        assert archives, 'Не заданы архивы'
+        self.archives = archives
+        self.filename = archives[-1].filename
+        self._members: Dict[str, zipfile.ZipFile] = {x: archive for archive in archives for x in archive.namelist()}
+
+    def namelist(self) -> List[str]:
+        return list(self._members)
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        return self._members[name].getinfo(name)
+
+    def open(self, name: str, mode: str = 'r'):
+        return self._members[name].open(name, mode)
+
+    def archive_name(self, name: str) -> str:
+        """ Имя архива, в котором находится файл """
+        return self._members[name].filename
+
+
+class ArchiveReader:
+    """
+    Чтение файлов архива ГАР.
+    Если workers > 0 - разбор XML выполняется в пуле из workers процессов, иначе в текущем процессе.
+    Если задан cache - файлы, которые уже есть в кэше, читаются из него в текущем процессе без разбора XML.
+    Ограничения пула: пакеты всех файлов раздает читающим задачам один поток в порядке поступления, поэтому
+    пока задача одного файла не забирает пакеты (не успевает запись), ждут и пакеты остальных файлов.
+    Одновременно разбирается не больше файлов, чем читает конвейер (settings.update.readers в каждом шаге
+    импорта), процессы сверх этого количества не ускоряют импорт
+    """
+    def __init__(self, archive: Union[zipfile.ZipFile, ArchiveSet], workers: int = 0,
+                 cache: Optional[MemberCache] = None) -> None:
+        self.archive = archive
+        self.workers = workers
+        self.cache = cache
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._results: Optional[multiprocessing.Queue] = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queues: Dict[str, asyncio.Queue] = {}
+
+    def _start(self) -> None:
+        if self._executor:
+            return
+        context = multiprocessing.get_context('spawn')
+        self._loop = asyncio.get_running_loop()
+        self._results = context.Queue(maxsize=self.workers * 2)
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=context,
+                                             initializer=_init_worker, initargs=(self._results, ))
+        self._dispatcher = threading.Thread(target=self._dispatch, name='gar-reader', daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self) -> None:
+        """
+        Раскладываем пакеты из очереди результатов по очередям читающих задач
+        """
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            file_name, batch = message
+            queue = self._queues.get(file_name)
+            if queue is not None:
+                asyncio.run_coroutine_threadsafe(queue.put(batch), self._loop).result()
+
+    def _failed(self, file_name: str, queue: asyncio.Queue, future: Future) -> None:
+        """
+        Ошибка задачи пула вне _read_member (parser не передается в процесс, ошибка инициализации,
+        процесс пула завершился) в очередь результатов не попадает - передаем ее читающей задаче
+        """
+        if future.cancelled() or future.exception() is None or self._loop.is_closed():
+            return
+        error = RuntimeError(f'{file_name}: {future.exception()!r}')
+        self._loop.call_soon_threadsafe(lambda: self._loop.create_task(queue.put(error)))
+
+    async def batches(self, file_name: str, parser: RowParser, skip: int = 0) -> AsyncIterator[Batch]:
+        """
+        Получить пакеты разобранных записей файла архива
+        """
+        cached = self.cache.reader(file_name, parser) if self.cache and isinstance(parser, TableMapping) else None
+        if cached:
+            for batch in cached_batches(cached, self.archive.getinfo(file_name).file_size, skip=skip):
+                yield batch
+            return
+
+        if not self.workers:
+            for batch in read_batches(self.archive, file_name, parser, skip=skip, cache=self.cache):
+                yield batch
+            return
+
+        self._start()
+        queue = asyncio.Queue(maxsize=2)
+        self._queues[file_name] = queue
+        archive_name = self.archive.archive_name(file_name) if isinstance(self.archive, ArchiveSet) \
+            else self.archive.filename
+        future = self._executor.submit(_read_member, archive_name, file_name, parser, skip, self.cache)
+        future.add_done_callback(functools.partial(self._failed, file_name, queue))
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # Освобождаем очередь, чтобы не блокировать раздачу пакетов других файлов
+            self._queues.pop(file_name, None)
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def close(self) -> None:
+        """
+        Остановить пул. Завершения процессов и потока раздачи ждем в отдельном потоке: раздача передает
+        пакеты через цикл событий и не завершится, если его заблокировать
+        """
+        if self._executor:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, self._shutdown, executor)
+
+    def _shutdown(self, executor: ProcessPoolExecutor) -> None:
+        executor.shutdown(wait=True, cancel_futures=True)
+        self._results.put(None)
+        self._dispatcher.join()
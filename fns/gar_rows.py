@@ -0,0 +1,272 @@
+"""
+Разбор записей XML файлов ГАР в значения колонок таблиц.
+
+Для каждой таблицы описывается соответствие колонок атрибутам XML и функции преобразования.
+Из описания один раз собирается функция, которая превращает запись XML в кортеж значений
+в порядке колонок таблицы (модели ormar остаются источником схемы, порядок с ними сверяется).
+Описания и функции преобразования - уровня модуля, чтобы их можно было передавать в процессы пула чтения.
+Отбор актуальных записей по значениям атрибутов выполняется еще при разборе XML (XmlFilter),
+туда же передается список нужных атрибутов
+"""
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from fns.gar_xml import XmlFilter
+
+Row = Tuple[Any, ...]
+Item = Dict[str, str]
+
+
+def to_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def to_bool(value: Optional[str]) -> bool:
+    return value in ('1', 'true')
+
+
+def to_int_or_none(value: Optional[str]) -> Optional[int]:
+    return int(value) if value else None
+
+
+def to_str_or_none(value: Optional[str]) -> Optional[str]:
+    return value if value else None
+
+
+def to_code(value: Optional[str]) -> Optional[int]:
+    """ Коды и ссылки, где '0' означает отсутствие значения """
+    return None if value is None or value == '0' else int(value)
+
+
+def to_abs_int(value: str) -> int:
+    return abs(int(value))
+
+
+def param_type(item: Item) -> int:
+    # КЛАДР с признаком актуальности (10) сохраняем как КЛАДР без признака (11)
+    type_id = int(item.get('@TYPEID'))
+    return 11 if type_id == 10 else type_id
+
+
+def param_value(item: Item) -> str:
+    # У КЛАДР с признаком актуальности отрезаем этот признак
+    value = item.get('@VALUE')
+    return value[:-2] if item.get('@TYPEID') == '10' else value[:128]
+
+
+def is_actual(item: Item) -> bool:
+    return int(item.get('@NEXTID', 0)) == 0
+
+
+def is_actual_address_object(item: Item) -> bool:
+    return is_actual(item) and bool(item.get('@NAME'))
+
+
+def is_actual_house(item: Item) -> bool:
+    # Пропускаем записи, нарушающие ограничения внешнего ключа
+    return is_actual(item) and int(item.get('@HOUSETYPE', 0)) >= 0
+
+
+def is_actual_param(item: Item) -> bool:
+    # Читаем КЛАДР из списка с признаком актуальности и убираем этот признак.
+    # Можно было бы брать сразу из списка с TYPEID == 11, но он у них давно не обновлялся
+    return item.get('@TYPEID') in ('5', '10', '16') and int(item.get('@CHANGEIDEND', 0)) == 0
+
+
+# Актуальные записи: нет следующей версии записи / не закончилось действие параметра
+ACTUAL = XmlFilter({'NEXTID': (None, '0')})
+ACTUAL_PARAM = XmlFilter({'TYPEID': ('5', '10', '16'), 'CHANGEIDEND': (None, '0')}, ('TYPEID', 'VALUE'))
+
+
+class Column:
+    """
+    Колонка таблицы: имя, атрибут XML и функция преобразования его значения.
+    Если атрибут не указан - функция получает всю запись XML
+    """
+    def __init__(self, name: str, attr: Optional[str], convert: Optional[Callable] = None,
+                 default: Optional[str] = None) -> None:
+        self.name = name
+        self.attr = attr
+        self.convert = convert
+        self.default = default
+
+
+class TableMapping:
+    """
+    Соответствие колонок таблицы атрибутам записи XML.
+    Вызов возвращает кортеж значений колонок или None, если запись не проходит фильтр.
+    xml_filter - отбор при разборе XML: допустимые значения атрибутов и атрибуты, которые читают row_filter
+    и функции, получающие всю запись. В запись копируются только они и атрибуты колонок
+    """
+    def __init__(self, table: str, columns: Sequence[Column], row_filter: Optional[Callable[[Item], bool]] = None,
+                 xml_filter: Optional[XmlFilter] = None):
+        self.table = table
+        self.columns: Tuple[Column, ...] = tuple(columns)
+        self.row_filter = row_filter
+        self.select: Optional[XmlFilter] = None
+        if xml_filter:
+            attrs = {x.attr[1:] for x in self.columns if x.attr} | set(xml_filter.values) | (xml_filter.attrs or set())
+            self.select = XmlFilter(xml_filter.values, attrs)
+        self._convert: Optional[Callable[[Item], Optional[Row]]] = None
+
+    @property
+    def names(self) -> Tuple[str, ...]:
+        return tuple(x.name for x in self.columns)
+
+    def index(self, name: str) -> int:
+        return self.names.index(name)
+
+    def compile(self) -> Callable[[Item], Optional[Row]]:
+        """
+        Собрать функцию преобразования: одно выражение-кортеж без циклов по колонкам
+        """
+        env: Dict[str, Any] = {'row_filter': self.row_filter}
+        values = []
+        for idx, column in enumerate(self.columns):
+            if column.attr is None:
+                env[f'c{idx}'] = column.convert
+                values.append(f'c{idx}(item)')
+                continue
+            value = f'get({column.attr!r}, {column.default!r})' if column.default is not None \
+                else f'get({column.attr!r})'
+            if column.convert:
+                env[f'c{idx}'] = column.convert
+                value = f'c{idx}({value})'
+            values.append(value)
+
+        source = ['def convert(item):']
+        if self.row_filter:
+            source.append('    if not row_filter(item):')
+            source.append('        return None')
+        source.append('    get = item.get')
+        source.append(f'    return ({", ".join(values)}, )')
+        exec('\n'.join(source), env)
+        return env['convert']
+
+    def __call__(self, item: Item) -> Optional[Row]:
+        if self._convert is None:
+            self._convert = self.compile()
+        return self._convert(item)
+
+    def __getstate__(self) -> Dict:
+        # Собранная функция не сериализуется, в процессе пула она собирается заново
+        state = self.__dict__.copy()
+        state['_convert'] = None
+        return state
+
+
+def _dates(*columns: Column) -> Tuple[Column, ...]:
+    return (
+        Column('update_date', '@UPDATEDATE', to_date),
+        Column('start_date', '@STARTDATE', to_date),
+        Column('end_date', '@ENDDATE', to_date),
+    ) + columns
+
+
+def _directory(*columns: Column) -> Tuple[Column, ...]:
+    """ Колонки справочников типов """
+    return _dates(
+        Column('is_active', '@ISACTIVE', to_bool),
+        Column('id', '@ID', int),
+        Column('name', '@NAME'),
+        Column('short_name', '@SHORTNAME'),
+        *columns,
+    )
+
+
+LEVEL = TableMapping('levels', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@LEVEL', int),
+    Column('name', '@NAME'),
+))
+
+ADDRESS_TYPE = TableMapping('address_types', _directory(
+    Column('description', '@DESC'),
+    Column('level_id', '@LEVEL', int),
+))
+
+PARAM_TYPE = TableMapping('param_types', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('name', '@NAME'),
+    # У типов параметров нет краткого наименования
+    Column('short_name', '@SHORTNAME'),
+    Column('description', '@DESC', to_str_or_none),
+    Column('code', '@CODE'),
+))
+
+HOUSE_TYPE = TableMapping('house_types', _directory(
+    Column('description', '@DESC', to_str_or_none),
+))
+
+APARTMENT_TYPE = TableMapping('apartment_type', _directory(
+    Column('description', '@DESC', to_str_or_none),
+))
+
+ADDRESS_OBJECT = TableMapping('address_objects', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('object_guid', '@OBJECTGUID'),
+    Column('name', '@NAME'),
+    Column('type_name', '@TYPENAME'),
+    Column('level_id', '@LEVEL', int),
+    Column('is_actual', '@ISACTUAL', to_bool),
+), is_actual_address_object, ACTUAL)
+
+HOUSE = TableMapping('houses', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('object_guid', '@OBJECTGUID'),
+    Column('house_num', '@HOUSENUM'),
+    Column('add_num1', '@ADDNUM1'),
+    Column('add_num2', '@ADDNUM2'),
+    Column('house_type', '@HOUSETYPE', to_int_or_none),
+    Column('add_type1', '@ADDTYPE1', to_int_or_none),
+    Column('add_type2', '@ADDTYPE2', to_int_or_none),
+    Column('is_actual', '@ISACTUAL', to_bool),
+), is_actual_house, ACTUAL)
+
+APARTMENT = TableMapping('apartments', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('object_guid', '@OBJECTGUID'),
+    Column('number', '@NUMBER'),
+    Column('apartment_type_id', '@APARTTYPE', to_abs_int),
+    Column('is_actual', '@ISACTUAL', to_bool),
+), is_actual, ACTUAL)
+
+ADMINISTRATION_HIERARCHY = TableMapping('hierarchy_adm', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('parent_object_id', '@PARENTOBJID', to_code, default='0'),
+    Column('region_code', '@REGIONCODE', to_code),
+    Column('area_code', '@AREACODE', to_code),
+    Column('city_code', '@CITYCODE', to_code),
+    Column('place_code', '@PLACECODE', to_code),
+    Column('plan_code', '@PLANCODE', to_code),
+    Column('street_code', '@STREETCODE', to_code),
+    Column('path', '@PATH'),
+), is_actual, ACTUAL)
+
+MUN_HIERARCHY = TableMapping('hierarchy_mun', _dates(
+    Column('is_active', '@ISACTIVE', to_bool),
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('parent_object_id', '@PARENTOBJID', to_code, default='0'),
+    Column('oktmo', '@OBJECTID'),
+    Column('path', '@PATH'),
+), is_actual, ACTUAL)
+
+ADDRESS_OBJECT_PARAM = TableMapping('address_object_params', (
+    Column('id', '@ID', int),
+    Column('object_id', '@OBJECTID', int),
+    Column('param_type_id', None, param_type),
+    Column('value', None, param_value),
+    Column('update_date', '@UPDATEDATE', to_date),
+    Column('start_date', '@STARTDATE', to_date),
+    Column('end_date', '@ENDDATE', to_date),
+), is_actual_param, ACTUAL_PARAM)
@@ -0,0 +1,97 @@
+"""
+Выполнение шагов импорта с учетом зависимостей между ними
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.database import create_task
+from core.log import import_log
+
+
+class Step:
+    def __init__(self, name: str, run: Callable[[], Awaitable], depends: Tuple[str, ...]) -> None:
+        self.name = name
+        self.run = run
+        self.depends = depends
+        self.done = asyncio.Event()
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+
+class StepScheduler:
+    """
+    Шаги выполняются, как только завершены шаги, от которых они зависят,
+    но не более limit шагов одновременно. Зависимости от не добавленных шагов не учитываются
+    (например, при settings.update.level = street нет шагов домов и помещений)
+    """
+    def __init__(self, limit: int = 1) -> None:
+        assert limit > 0, 'Не корректно задано количество одновременных шагов'
+        self.log = import_log
+        self.limit = limit
+        self.steps: Dict[str, Step] = {}
+
+    def add(self, name: str, run: Callable[[], Awaitable], *depends: str) -> None:
+        assert name not in self.steps, f'Шаг {name} уже добавлен'
+        self.steps[name] = Step(name, run, depends)
+
+    def _depends(self, step: Step) -> List[Step]:
+        return [self.steps[x] for x in step.depends if x in self.steps]
+
+    async def run(self) -> None:
+        semaphore = asyncio.Semaphore(self.limit)
+        started = time.perf_counter()
+
+        async def run_step(step: Step) -> None:
+            for depend in self._depends(step):
+                await depend.done.wait()
+            async with semaphore:
+                step.start = time.perf_counter() - started
+                await step.run()
+                step.end = time.perf_counter() - started
+            step.done.set()
+
+        # Шаги добавляются после своих зависимостей, поэтому циклов быть не может
+        for step in self.steps.values():
+            assert all(list(self.steps).index(x.name) < list(self.steps).index(step.name)
+                       for x in self._depends(step)), f'Шаг {step.name} добавлен раньше своих зависимостей'
+
+        # У каждого шага свое подключение к БД: транзакции одновременных шагов не пересекаются
+        tasks = [create_task(run_step(x)) for x in self.steps.values()]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                # Ошибка шага останавливает импорт
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._log_timeline()
+
+    def critical_path(self) -> List[Step]:
+        """
+        Цепочка шагов, определившая время импорта: от последнего завершенного шага к шагу,
+        после завершения которого он начался (зависимость или шаг, освободивший место из limit)
+        """
+        finished = [x for x in self.steps.values() if x.end is not None]
+        path = []
+        step = max(finished, key=lambda x: x.end, default=None)
+        while step:
+            path.append(step)
+            step = max([x for x in finished if x.end <= step.start + 0.001 and x not in path],
+                       key=lambda x: x.end, default=None)
+        return path[::-1]
+
+    def _log_timeline(self) -> None:
+        for step in sorted(self.steps.values(), key=lambda x: (x.start is None, x.start)):
+            if step.start is None:
+                self.log.info(f'Шаг {step.name}: не выполнялся')
+            elif step.end is None:
+                self.log.info(f'Шаг {step.name}: начало {step.start:.2f} с, не завершен')
+            else:
+                self.log.info(f'Шаг {step.name}: начало {step.start:.2f} с, окончание {step.end:.2f} с, '
+                              f'длительность {step.end - step.start:.2f} с')
+        path = self.critical_path()
+        if path:
+            self.log.info(f'Критический путь: {" -> ".join(x.name for x in path)} ({path[-1].end:.2f} с)')
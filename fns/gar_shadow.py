@@ -0,0 +1,214 @@
+"""
+Полный импорт в теневую БД с заменой рабочей после проверки.
+
+SQLite: импорт в соседний файл <base>.shadow, замена - переименованием файла. Прежний файл остается
+жесткой ссылкой <base>.backup. Подключения databases к SQLite открываются на каждый запрос,
+поэтому API сразу начинает читать новый файл.
+PostgreSQL: импорт в схему gar_shadow (через search_path), замена - переносом таблиц между схемами
+в одной транзакции, прежние таблицы остаются в схеме gar_backup.
+Откат - обратная замена из резервной копии
+"""
+import os
+import shutil
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from core.database import database, get_connection_url, metadata, replace_database
+from core.log import import_log
+from core.settings import settings
+from fns.gar_loader import create_index_query
+from gar.models import AlembicVersion, Updates
+
+
+class ShadowDatabase(ABC):
+    """
+    Теневая БД. open - создать пустую теневую БД (или продолжить импорт в оставшуюся после прерывания)
+    и переключить на нее подключение, swap - заменить рабочую БД теневой,
+    discard - удалить теневую БД и вернуть подключение к рабочей
+    """
+    def __init__(self) -> None:
+        self.log = import_log
+
+    async def _service_rows(self) -> List:
+        """ Служебные таблицы переносятся в теневую БД: версия миграции и история обновлений """
+        return [*await AlembicVersion.objects.all(), *await Updates.objects.all()]
+
+    @staticmethod
+    async def _copy_service_rows(rows: List) -> None:
+        for row in rows:
+            await row.__class__.objects.create(**row.dict())
+
+    async def counts(self) -> Dict[str, int]:
+        """ Количество записей в таблицах текущей БД """
+        return {x.name: await database.fetch_val(f'select count(*) from {x.name}') for x in metadata.sorted_tables}
+
+    @abstractmethod
+    async def exists(self) -> bool:
+        """ Осталась ли теневая БД прерванного импорта """
+
+    @abstractmethod
+    async def open(self, resume: bool = False) -> None:
+        """ Создать пустую теневую БД (resume - продолжить в существующей) и переключить на нее подключение """
+
+    @abstractmethod
+    async def swap(self) -> None:
+        """ Заменить рабочую БД теневой, прежнюю сохранить резервной копией """
+
+    @abstractmethod
+    async def discard(self) -> None:
+        """ Удалить теневую БД и вернуть подключение к рабочей """
+
+    @abstractmethod
+    async def rollback(self) -> None:
+        """ Вернуть рабочую БД из резервной копии """
+
+
+class SqliteShadow(ShadowDatabase):
+    def __init__(self) -> None:
+        super().__init__()
+        self.base = settings.database.base
+        self.shadow = f'{self.base}.shadow'
+        self.backup = f'{self.base}.backup'
+
+    @staticmethod
+    def _remove(file_name: str) -> None:
+        for name in (file_name, f'{file_name}-wal', f'{file_name}-shm', f'{file_name}-journal'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    async def _use(self, file_name: str) -> None:
+        # Настройки в файле не меняются, только адрес БД в памяти (по нему подключается и SqliteLoader)
+        settings.database.base = file_name
+        await replace_database(get_connection_url())
+        await database.connect()
+
+    async def exists(self) -> bool:
+        return os.path.exists(self.shadow)
+
+    async def open(self, resume: bool = False) -> None:
+        if resume:
+            await self._use(self.shadow)
+            self.log.info(f'Продолжение импорта в теневую БД {self.shadow}')
+            return
+        rows = await self._service_rows()
+        self._remove(self.shadow)
+        metadata.create_all(sqlalchemy.create_engine(f'sqlite:///{self.shadow}'))
+        await self._use(self.shadow)
+        await self._copy_service_rows(rows)
+        self.log.info(f'Импорт в теневую БД {self.shadow}')
+
+    async def swap(self) -> None:
+        await database.disconnect()
+        try:
+            # Прежний файл сохраняем жесткой ссылкой, затем атомарно заменяем рабочий файл теневым
+            self._remove(self.backup)
+            if os.path.exists(self.base):
+                try:
+                    os.link(self.base, self.backup)
+                except OSError as e:
+                    self.log.warning(f'Не удалось создать жесткую ссылку {self.backup}, копируем файл: {e}')
+                    shutil.copyfile(self.base, self.backup)
+            os.replace(self.shadow, self.base)
+        finally:
+            # И при ошибке замены подключение возвращается к рабочей БД, а не остается на теневой
+            await self._use(self.base)
+        self.log.info(f'Рабочая БД заменена теневой. Прежняя БД: {self.backup}')
+
+    async def discard(self) -> None:
+        await database.disconnect()
+        try:
+            self._remove(self.shadow)
+        finally:
+            await self._use(self.base)
+
+    async def rollback(self) -> None:
+        assert os.path.exists(self.backup), f'Нет резервной копии {self.backup}'
+        await database.disconnect()
+        try:
+            os.replace(self.backup, self.base)
+        finally:
+            await self._use(self.base)
+        self.log.info(f'Рабочая БД восстановлена из {self.backup}')
+
+
+class PostgresShadow(ShadowDatabase):
+    shadow = 'gar_shadow'
+    backup = 'gar_backup'
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._schema: Optional[str] = None
+
+    async def _move_tables(self, source: str, target: str) -> None:
+        for table in metadata.sorted_tables:
+            await database.execute(f'alter table if exists {source}.{table.name} set schema {target}')
+
+    async def exists(self) -> bool:
+        return await database.fetch_val('select exists(select 1 from information_schema.schemata '
+                                        'where schema_name = :name)', {'name': self.shadow})
+
+    async def open(self, resume: bool = False) -> None:
+        # Схема рабочих таблиц (обычно public)
+        self._schema = await database.fetch_val('select current_schema()')
+        if resume:
+            await replace_database(get_connection_url(), server_settings={'search_path': self.shadow})
+            await database.connect()
+            self.log.info(f'Продолжение импорта в теневую схему {self.shadow}')
+            return
+        rows = await self._service_rows()
+        await database.execute(f'drop schema if exists {self.shadow} cascade')
+        await database.execute(f'create schema {self.shadow}')
+        # Все запросы импорта без указания схемы, поэтому достаточно search_path
+        await replace_database(get_connection_url(), server_settings={'search_path': self.shadow})
+        await database.connect()
+        dialect = postgresql.dialect()
+        for table in metadata.sorted_tables:
+            await database.execute(str(CreateTable(table).compile(dialect=dialect)))
+            for index in table.indexes:
+                await database.execute(create_index_query(index))
+        await self._copy_service_rows(rows)
+        self.log.info(f'Импорт в теневую схему {self.shadow}')
+
+    async def _use_live(self) -> None:
+        await replace_database(get_connection_url())
+        await database.connect()
+
+    async def swap(self) -> None:
+        await self._use_live()
+        async with database.transaction():
+            await database.execute(f'drop schema if exists {self.backup} cascade')
+            await database.execute(f'create schema {self.backup}')
+            await self._move_tables(self._schema, self.backup)
+            await self._move_tables(self.shadow, self._schema)
+            await database.execute(f'drop schema {self.shadow}')
+        self.log.info(f'Рабочие таблицы заменены теневыми. Прежние таблицы: схема {self.backup}')
+
+    async def discard(self) -> None:
+        await self._use_live()
+        await database.execute(f'drop schema if exists {self.shadow} cascade')
+
+    async def rollback(self) -> None:
+        schema = await database.fetch_val('select current_schema()')
+        async with database.transaction():
+            await database.execute(f'drop schema if exists {self.shadow} cascade')
+            await database.execute(f'create schema {self.shadow}')
+            await self._move_tables(schema, self.shadow)
+            await self._move_tables(self.backup, schema)
+            await database.execute(f'drop schema {self.backup}')
+            await database.execute(f'alter schema {self.shadow} rename to {self.backup}')
+        self.log.info(f'Рабочие таблицы восстановлены из схемы {self.backup}')
+
+
+def get_shadow() -> Optional[ShadowDatabase]:
+    """
+    Теневая БД для текущего драйвера (для MySQL не поддерживается)
+    """
+    if settings.database.driver_name == settings.database.DriverName.sqlite:
+        return SqliteShadow()
+    if settings.database.driver_name == settings.database.DriverName.postgresql:
+        return PostgresShadow()
+    return None
@@ -1,31 +1,72 @@
-import re
+import time
 import zipfile
+from typing import Collection, Dict, Iterable, Iterator, List, Optional
+from xml.parsers import expat
 
-import xmltodict
-
-
-def rows_from_xml(archive: zipfile.ZipFile, file_name: str):
-    file = archive.open(file_name)
-    tags = ''
-    while True:
-        data = file.read(10000)
-        if not data:
-            break
-        try:
-            str_data = data.decode(encoding='utf-8')
-        except UnicodeDecodeError:
-            data += file.read(1)
-            str_data = data.decode(encoding='utf-8')
-        # Читаем блоками, поэтому пытаемся воссоздать изначальную последовательность
-        tags += str_data
-        # Находим все теги "<...>"
-        result = re.compile(r"(?:<).*?(?:>)").findall(tags)
-        # Удаляем все найденные теги
-        tags = re.sub(r'\<[^>]*\>', '', tags)
-
-        for i in result:
-            # Нас интересуют только одиночные теги с атрибутами (<.../>)
-            # if re.compile(r"<(.*?)/>").findall(i):
-            if re.compile(r'<(.*?)"(.*?)/>').findall(i):
-                obj = xmltodict.parse(i, dict_constructor=dict)
-                yield obj[list(obj.keys())[0]]
+# Размер блока, читаемого из архива за один раз
+CHUNK_SIZE = 1024 * 1024
+
+
+class XmlStats:
+    """ Объем распакованных данных и время распаковки и разбора XML """
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.seconds = 0.0
+
+
+class XmlFilter:
+    """
+    Отбор записей при разборе XML, до создания словаря записи.
+    values - допустимые значения атрибутов (None - атрибута нет), attrs - атрибуты, которые копируются
+    в запись (None - все). Атрибуты указываются без префикса '@'
+    """
+    def __init__(self, values: Optional[Dict[str, Collection[Optional[str]]]] = None,
+                 attrs: Optional[Iterable[str]] = None) -> None:
+        self.values = {x: frozenset(y) for x, y in (values or {}).items()}
+        self.attrs = None if attrs is None else frozenset(attrs)
+
+
+def rows_from_xml(archive: zipfile.ZipFile, file_name: str, stats: Optional[XmlStats] = None,
+                  select: Optional[XmlFilter] = None) -> Iterator[Optional[Dict[str, str]]]:
+    """
+    Потоково прочитать записи (теги с атрибутами) из XML файла архива.
+    Файл разбирается за один проход, в памяти держится только текущий блок.
+    Атрибуты возвращаются с префиксом '@' (как у xmltodict).
+    Вместо записей, не прошедших select, возвращается None - так сохраняется нумерация записей файла
+    """
+    stats = stats or XmlStats()
+    rows: List[Optional[Dict[str, str]]] = []
+    values = list(select.values.items()) if select else []
+    names = [(x, f'@{x}') for x in select.attrs] if select and select.attrs is not None else None
+
+    def start_element(_name: str, attrs: Dict[str, str]) -> None:
+        # Нас интересуют только теги с атрибутами, корневой тег их не имеет
+        if not attrs:
+            return
+        for key, allowed in values:
+            if attrs.get(key) not in allowed:
+                rows.append(None)
+                return
+        if names is None:
+            rows.append({f'@{key}': value for key, value in attrs.items()})
+        else:
+            rows.append({prefixed: attrs[key] for key, prefixed in names if key in attrs})
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+
+    with archive.open(file_name) as file:
+        while True:
+            # Время считаем без ожидания получателя записей
+            start = time.perf_counter()
+            data = file.read(CHUNK_SIZE)
+            if not data:
+                break
+            parser.Parse(data, False)
+            stats.bytes += len(data)
+            stats.seconds += time.perf_counter() - start
+            yield from rows
+            rows.clear()
+    parser.Parse(b'', True)
+    stats.seconds += time.perf_counter() - start
+    yield from rows
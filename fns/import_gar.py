@@ -1,29 +1,93 @@
 import asyncio
-import collections
 import os
+import uuid
 import zipfile
 from datetime import datetime
-from typing import List, Any, Optional
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
+import databases
+import sqlalchemy
+
+from core.database import get_connection_url
 from core.log import import_log
 from core.settings import settings
-from fns.gar_xml import rows_from_xml
+from fns import gar_rows
+from fns.download import get_str_file_size
+from fns.gar_cache import MemberCache
+from fns.gar_index import ObjectIdIndex
+from fns.gar_pipeline import FileState, ImportPipeline
+from fns.gar_loader import get_loader, upsert_query
+from fns.gar_reader import ArchiveReader, ArchiveSet
+from fns.gar_rows import Row, TableMapping
+from fns.gar_scheduler import StepScheduler
+from fns.gar_shadow import ShadowDatabase, get_shadow
 from gar.models import Level, AddressObject, AddressType, ParamType, AdministrationHierarchy, AddressObjectParam, \
-    HouseType, House, ApartmentType, Apartment, MunHierarchy, Updates
+    HouseType, House, ApartmentType, Apartment, MunHierarchy, Updates, UpdateFile, ObjectRoute, OBJECT_TABLES
+
+
+class TableLoad:
+    """
+    Загрузка таблицы несколькими шагами (по шагу на регион): наличие записей до импорта проверяется
+    и индексы удаляются первым шагом, а создаются после завершения последнего
+    """
+    def __init__(self, table: sqlalchemy.Table) -> None:
+        self.table = table
+        self.steps = 0
+        self.lock = asyncio.Lock()
+        self.is_exist: Optional[bool] = None
+        self.defer_indexes = False
 
 
 class GarImportBase:
-    def __init__(self, archive: zipfile.ZipFile, region: Optional[int] = None) -> None:
+    def __init__(self, archive: Union[zipfile.ZipFile, ArchiveSet],
+                 region: Union[int, Sequence[int], None] = None) -> None:
         self.log = import_log
-        # Для sqlite размер загружаемого блока - 50, для остальных 1000
-        self.block_length = 50 if settings.database.driver_name == settings.database.DriverName.sqlite else 1000
-        assert region is None or 0 < region < 100, 'Не корректно указан регион'
+        # Способ записи в БД (COPY для PostgreSQL, ormar для остальных) и размер загружаемого блока
+        self.loader = get_loader()
+        self.block_length = self.loader.block_length
+        # Регион или список регионов (пустой - все регионы архива)
+        self.regions: List[int] = [region] if isinstance(region, int) else sorted(set(region or []))
+        assert all(0 < x < 100 for x in self.regions), 'Не корректно указан регион'
         self.archive = archive
-        self.region = region
         self._version: int = int(os.path.basename(self.archive.filename)[:8])
+        # Версии архивов. Несколько обновлений импортируются одним проходом: файлы читаются от новых к старым,
+        # а запись, уже записанная из более нового обновления, пропускается (первичные ключи записанных записей
+        # по таблицам)
+        archives = archive.archives if isinstance(archive, ArchiveSet) else [archive]
+        self.versions: List[int] = [int(os.path.basename(x.filename)[:8]) for x in archives]
+        self._seen: Optional[Dict[str, ObjectIdIndex]] = {} if len(archives) > 1 else None
+        # Полный архив (не обновление): 20220707_gar_xml.zip, обновление - 20220707_gar_delta_xml.zip
+        self.is_full = 'delta' not in os.path.basename(self.archive.filename).lower()
+        # Разбор XML в пуле процессов (0 - в текущем процессе) и кэш разобранных файлов
+        cache = MemberCache(settings.update.cache_dir, self._version) if settings.update.cache_dir else None
+        self.reader = ArchiveReader(archive, settings.update.workers, cache)
+        # Чтение файлов и запись блоков в БД с ограниченной очередью между ними
+        self.pipeline = ImportPipeline(self.reader, settings.update.readers, self.loader.writers,
+                                       settings.update.queue_size, self.block_length)
 
         # Модели, в которых будем проверять наличие object_id, для того, что бы не загружать лишние зависимости.
         self._checked_models = (AddressObject, House, Apartment, )
+        # Коды таблиц объектов в object_routes
+        self._route_codes = {y: x for x, y in OBJECT_TABLES.items()}
+        # Все импортируемые модели
+        self._models = (Level, AddressType, ParamType, HouseType, ApartmentType, AddressObject, House, Apartment,
+                        AdministrationHierarchy, MunHierarchy, AddressObjectParam, )
+        # object_id объектов, загруженных в этом импорте. Зависимости проверяются по нему без запросов к БД
+        self.object_ids = ObjectIdIndex()
+        # Были ли объекты в БД до импорта (None - не проверялось). Если были, то не найденные
+        # в индексе object_id дополнительно ищем в БД
+        self._objects_in_database: Optional[bool] = None
+        # Количество записанных записей и записей обновления без изменений (не перезаписываются) по таблицам
+        self.counts: Dict[str, int] = {}
+        self.unchanged: Dict[str, int] = {}
+        # Состояние файлов прерванного импорта этой версии: количество сохраненных записей XML, файл загружен
+        self._checkpoints: Dict[str, Tuple[int, bool]] = {}
+        # Подключение к рабочей БД при импорте в теневую: состояние файлов дублируется в рабочую БД
+        self._live: Optional[databases.Database] = None
+        # Загрузка таблиц шагами импорта и файлы шагов (заполняются при создании шагов)
+        self._tables: Dict[str, TableLoad] = {}
+        self._step_files: Dict[str, List[str]] = {}
 
         self._load_file_list()
 
@@ -33,380 +97,411 @@ class GarImportBase:
         return self._version
 
     def _load_file_list(self) -> None:
-        region = f'{self.region:0=2}' if self.region else ''
+        regions = {f'{x:0=2}' for x in self.regions}
 
         def get_files_by_mask(mask: str) -> List[str]:
             return [x for x in file_list if mask in x]
 
-        file_list = sorted(self.archive.namelist())
+        def get_region_files(mask: str) -> List[str]:
+            # Файлы регионов лежат в каталогах с номером региона: 77/AS_HOUSES_2022...
+            return [x for x in get_files_by_mask(f'/{mask}') if not regions or x.split('/')[0] in regions]
+
+        file_list = sorted(self.archive.namelist(), reverse=self._seen is not None)
         self._file_levels: str = get_files_by_mask('AS_OBJECT_LEVELS_202')[0]
         self._file_address_object_type: str = get_files_by_mask('AS_ADDR_OBJ_TYPES_202')[0]
         self._file_param_type: str = get_files_by_mask('AS_PARAM_TYPES_202')[0]
         self._file_house_type: str = get_files_by_mask('AS_HOUSE_TYPES_202')[0]
         self._file_apartment_type: str = get_files_by_mask('AS_APARTMENT_TYPES_202')[0]
-        self._file_address_object: List[str] = get_files_by_mask(f'{region}/AS_ADDR_OBJ_202')
-        self._file_house: List[str] = get_files_by_mask(f'{region}/AS_HOUSES_202')
-        self._file_apartment: List[str] = get_files_by_mask(f'{region}/AS_APARTMENTS_202')
-        self._file_adm_hierarchy: List[str] = get_files_by_mask(f'{region}/AS_ADM_HIERARCHY_202')
-        self._file_mun_hierarchy: List[str] = get_files_by_mask(f'{region}/AS_MUN_HIERARCHY_202')
-        self._file_object_param: List[str] = get_files_by_mask(f'{region}/AS_ADDR_OBJ_PARAMS_202')
-
-    async def _commit_updates(self, model, items, is_exist: bool, file: str, check_object_id: bool = False) -> None:
+        self._file_address_object: List[str] = get_region_files('AS_ADDR_OBJ_202')
+        self._file_house: List[str] = get_region_files('AS_HOUSES_202')
+        self._file_apartment: List[str] = get_region_files('AS_APARTMENTS_202')
+        self._file_adm_hierarchy: List[str] = get_region_files('AS_ADM_HIERARCHY_202')
+        self._file_mun_hierarchy: List[str] = get_region_files('AS_MUN_HIERARCHY_202')
+        self._file_object_param: List[str] = get_region_files('AS_ADDR_OBJ_PARAMS_202')
+        # Регионы архива, которые импортируем. Каждый регион импортируется отдельными шагами,
+        # большие регионы начинаются первыми - время импорта ближе ко времени самого большого региона
+        sizes: Dict[str, int] = {}
+        for file_name in (self._file_address_object + self._file_house + self._file_apartment
+                          + self._file_adm_hierarchy + self._file_mun_hierarchy + self._file_object_param):
+            region = file_name.split('/')[0]
+            sizes[region] = sizes.get(region, 0) + self.archive.getinfo(file_name).file_size
+        self._regions: List[str] = sorted(sizes, key=lambda x: (-sizes[x], x))
+
+    @staticmethod
+    def _region_files(file_names: List[str], region: Optional[str]) -> List[str]:
+        """ Файлы региона (None - всех выбранных регионов) """
+        return [x for x in file_names if region is None or x.split('/')[0] == region]
+
+    async def _commit_updates(self, model, rows: List[Row], is_exist: bool, file: str,
+                              check_object_id: bool = False) -> Tuple[int, int]:
+        """
+        Записать блок. Возвращает количество добавленных и обновленных записей
+        """
         if check_object_id:
-            checked_object_id_list = []
-            object_id_list = [x.object_id for x in items]
-            for i in self._checked_models:
+            object_id_index = list(model.Meta.table.columns.keys()).index('object_id')
+            object_ids = self.object_ids
+            missed = [x[object_id_index] for x in rows if x[object_id_index] not in object_ids]
+            if missed and self._objects_in_database is not False:
                 # Проверяем, если ли это у нас в базе на то что ссылаемся
-                checked_object_id_list.extend(
-                    await i.objects.filter(object_id__in=object_id_list).values_list('object_id', flatten=True)
-                )
+                for i in self._checked_models:
+                    object_ids.add(
+                        await i.objects.filter(object_id__in=missed).values_list('object_id', flatten=True)
+                    )
+            rows = [x for x in rows if x[object_id_index] in object_ids]
 
-            items = [x for x in items if x.object_id in checked_object_id_list]
+        if self._seen is not None:
+            seen = self._seen.setdefault(model.Meta.tablename, ObjectIdIndex())
+            pk_index = list(model.Meta.table.columns.keys()).index(model.Meta.pkname)
+            rows = [x for x in rows if x[pk_index] not in seen]
+            seen.add(x[pk_index] for x in rows)
 
-        if not items:
+        if not rows:
             # Выходим если нечего добавлять/обновлять
-            return
+            return 0, 0
 
         if not is_exist:
             # Если изначально таблица пустая - ничего проверять не будем, просто добавляем
-            await self._bulk_create(file, model, items)
+            counts = await self.loader.create(file, model, rows)
         else:
-            # Таблица не пустая, разбираемся что добавлять, а что обновлять
-            id_from_arch: set = {x.id for x in items}
-            id_from_db: list = await model.objects.filter(id__in=id_from_arch).values_list('id', flatten=True)
-
-            id_to_insert = id_from_arch - set(id_from_db)
-            id_to_update = id_from_arch - id_to_insert
-
-            if id_to_update:
-                await self._bulk_update(file, model, [x for x in items if x.id in id_to_update])
-            if id_to_insert:
-                await self._bulk_create(file, model, [x for x in items if x.id in id_to_insert])
-
-    async def _bulk_create(self, file: str, model: Any, items: List) -> None:
+            # Таблица не пустая, добавляем новые записи и обновляем измененные
+            counts = await self.loader.merge(file, model, rows)
+            name = model.Meta.tablename
+            self.unchanged[name] = self.unchanged.get(name, 0) + len(rows) - sum(counts)
+        if model in self._checked_models:
+            object_id_index = list(model.Meta.table.columns.keys()).index('object_id')
+            self.object_ids.add(x[object_id_index] for x in rows)
+            await self._write_routes(model, rows, is_exist, file)
+        return counts
+
+    @staticmethod
+    def _guid_bytes(value: Optional[str]) -> Optional[bytes]:
         try:
-            await model.objects.bulk_create(items)
-        except Exception as block_except:
-            # Ошибка при добавлении блока. Пробуем добавлять по одной записи
-            self.log.warning(f'Ошибка при добавлении блока. {file}. Добавляем по одной записи: {block_except}')
-            for i in items:
-                try:
-                    await model.objects.create(**i.dict())
-                except Exception as e:
-                    self.log.error(f'File {file}.\n\tItem: {i.dict()}\n{e}')
+            return uuid.UUID(value).bytes
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    async def _write_routes(self, model, rows: List[Row], is_exist: bool, file: str) -> None:
+        """
+        Записать таблицу объектов блока в object_routes. Вызывается внутри loader.transaction блока:
+        записи объектов и их маршруты фиксируются или откатываются вместе
+        """
+        columns = list(model.Meta.table.columns.keys())
+        object_id_index, guid_index = columns.index('object_id'), columns.index('object_guid')
+        code = self._route_codes[model]
+        routes = [(x[object_id_index], self._guid_bytes(x[guid_index]), code) for x in rows]
+        routes = [x for x in routes if x[1] is not None]
+        if not routes:
+            return
+        if is_exist:
+            await self.loader.merge(file, ObjectRoute, routes)
+        else:
+            await self.loader.create(file, ObjectRoute, routes)
+
+    async def _restore_indexes(self) -> None:
+        """ Создать индексы, которые могли остаться удаленными после прерванной загрузки """
+        if self.loader.defer_indexes:
+            for model in self._models:
+                await self.loader.create_indexes(model.Meta.table)
+
+    async def _check_objects_in_database(self) -> None:
+        """ Проверить наличие объектов в БД до импорта """
+        self._objects_in_database = any([await x.objects.exists() for x in self._checked_models])
+
+    async def _update_state(self, state: str) -> None:
+        """ Сохранить состояние обновления (всех объединенных обновлений): Выполняется, Выполнено, Ошибка """
+        for version in self.versions:
+            update = await Updates.objects.get_or_none(id=version)
+            if update:
+                await update.update(state=state, update_date=datetime.utcnow())
+            else:
+                await Updates.objects.create(id=version, state=state)
+
+    async def _load_checkpoints(self, resume: bool) -> None:
+        """
+        Загрузить состояние файлов прерванного импорта этой версии. Если продолжать нечего - удалить его
+        """
+        files = await UpdateFile.objects.filter(version=self.version).all()
+        if resume:
+            self._checkpoints = {x.file_name: (x.rows, x.done) for x in files}
+            if self._checkpoints:
+                self.log.info(f'Продолжение прерванного импорта: загружено файлов '
+                              f'{sum(x for _, x in self._checkpoints.values())} из {len(self._checkpoints)} начатых')
+        elif files:
+            await UpdateFile.objects.filter(version=self.version).delete()
+
+    async def _save_checkpoint(self, file_name: str, state: FileState) -> None:
+        """
+        Сохранить состояние файла: количество записей XML, сохраненных в БД, и показатели импорта.
+        По ним /api/import/status показывает ход импорта.
+        Сохраняется после фиксации транзакций блоков, поэтому не опережает записанные данные - при продолжении
+        импорта повторно записываются (upsert) только блоки после сохраненного смещения.
+        При импорте в теневую БД состояние записывается и в рабочую: API читает рабочую БД, и по ней же
+        продолжается импорт после прерывания. Копия в теневой БД после замены остается в рабочей
+        """
+        row = (
+            f'{self.version}/{file_name}', self.version, file_name, state.offset, state.done, datetime.utcnow(),
+            state.size, state.read_bytes, state.read_rows, state.kept_rows, state.inserted, state.updated,
+            state.parse_time, state.convert_time, state.write_time,
+        )
+        async with self.loader.transaction(file_name):
+            await self.loader.checkpoint(UpdateFile.Meta.table, row)
+        if self._live:
+            await self._live.execute(upsert_query(UpdateFile.Meta.table, [row]))
+
+    async def _register_files(self, file_names: List[str]) -> None:
+        """ Сохранить состояние еще не начатых файлов - по их размеру оценивается оставшееся время """
+        for file_name in file_names:
+            if file_name not in self._checkpoints:
+                await self._save_checkpoint(file_name, FileState(size=self.archive.getinfo(file_name).file_size))
+
+    async def _import_model(self, model, file_names: List[str], mapping: TableMapping,
+                            check_object_id: bool = False) -> None:
+        # Записи передаются кортежами в порядке колонок таблицы - сверяем описание с моделью
+        table = model.Meta.table
+        assert mapping.table == table.name and mapping.names == tuple(table.columns.keys()), \
+            f'Колонки {mapping.table} не совпадают с таблицей {table.name}'
+        # Наличие записей и удаление индексов определяет первый шаг таблицы. Вызов не из шагов импорта
+        # загружает таблицу одним шагом
+        load = self._tables.get(table.name)
+        if load is None:
+            load = self._tables[table.name] = TableLoad(table)
+            load.steps = 1
+        async with load.lock:
+            if load.is_exist is None:
+                # Определяем тип модели
+                load.is_exist = await model.objects.exists()
+                # В пустую таблицу загружаем без индексов и создаем их после загрузки всех ее шагов
+                load.defer_indexes = bool(not load.is_exist and self.loader.defer_indexes and table.indexes)
+                if load.defer_indexes:
+                    await self.loader.drop_indexes(table)
+        is_exist = load.is_exist
+        # Файлы, загруженные до прерывания импорта, пропускаем, начатые - продолжаем с сохраненной записи
+        for file_name in [x for x in file_names if self._checkpoints.get(x, (0, False))[1]]:
+            self.log.info(f'{file_name}: загружен ранее, пропущен')
+        file_names = [x for x in file_names if not self._checkpoints.get(x, (0, False))[1]]
+        skip = {x: self._checkpoints[x][0] for x in file_names if x in self._checkpoints}
+
+        async def write(file_name: str, rows: List[Row]) -> Tuple[int, int]:
+            async with self.loader.transaction(file_name):
+                return await self._commit_updates(model, rows, is_exist, file_name, check_object_id)
 
-    async def _bulk_update(self, file: str, model: Any, items: List) -> None:
         try:
-            await model.objects.bulk_update(items)
-        except Exception as block_except:
-            # Ошибка при изменении блока. Пробуем изменять по одной записи
-            self.log.warning(f'Ошибка при изменении блока. {file}. Изменяем по одной записи: {block_except}')
-            for i in items:
+            # Файлы объединенных обновлений записываются по очереди от новых к старым
+            for files in [file_names] if self._seen is None else [[x] for x in file_names]:
+                counts = await self.pipeline.run(files, mapping, write, skip, self._save_checkpoint)
+                self.counts[table.name] = self.counts.get(table.name, 0) + sum(x + y for x, y in counts.values())
+        finally:
+            load.steps -= 1
+            if not load.steps:
+                del self._tables[table.name]
+                if self.unchanged.get(table.name):
+                    self.log.info(f'{table.name}: записано {self.counts.get(table.name, 0)}, '
+                                  f'без изменений (не перезаписаны) {self.unchanged[table.name]}')
+                if load.defer_indexes:
+                    await self.loader.rebuild_indexes(table)
+
+    async def _rebuild_pending_indexes(self) -> None:
+        """ Создать индексы таблиц, загрузка которых прервана ошибкой другого шага """
+        for name, load in list(self._tables.items()):
+            if load.defer_indexes and load.is_exist is not None:
                 try:
-                    await model.objects.bulk_update([i])
+                    await self.loader.rebuild_indexes(load.table)
                 except Exception as e:
-                    self.log.error(f'File {file}.\n\tItem: {i.dict()}\n{e}')
-
-    async def _import_model(self, model, file_name: str, callback: Any, check_object_id: bool = False) -> None:
-        items = collections.deque()
-        # Определяем тип модели
-        is_exist = await model.objects.exists()
-        for idx, i in enumerate(rows_from_xml(self.archive, file_name)):
-            value = callback(i)
-            if value:
-                items.append(value)
-                # Добавляем/обновляем блоками по 1000 записей
-                if len(items) >= self.block_length:
-                    await self._commit_updates(model, items, is_exist, file_name, check_object_id)
-                    items.clear()
-        # Добавляем оставшееся
-        await self._commit_updates(model, items, is_exist, file_name, check_object_id)
+                    self.log.warning(f'{name}: индексы не созданы ({e})')
 
 
 class GarImport(GarImportBase):
-    def __init__(self, archive: zipfile.ZipFile, region: Optional[int] = None) -> None:
+    def __init__(self, archive: Union[zipfile.ZipFile, ArchiveSet],
+                 region: Union[int, Sequence[int], None] = None) -> None:
         super().__init__(archive, region)
 
     async def import_level(self):
         self.log.info(f'Импорт сведений по уровням адресных объектов (AS_OBJECT_LEVELS)...')
         file_name = self._file_levels
         assert 'AS_OBJECT_LEVELS_202' in file_name, f'{file_name} не OBJECT_LEVELS'
-
-        def parse(item) -> Level:
-            return Level(
-                id=item.get('@LEVEL'),
-                name=item.get('@NAME'),
-                # short_name=item.get('@SHORTNAME'),
-                start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                is_active=item.get('@ISACTIVE') == 'true'
-            )
-        await self._import_model(Level, file_name, parse)
+        await self._import_model(Level, [file_name], gar_rows.LEVEL)
 
     async def import_address_type(self):
         self.log.info(f'Импорт сведений по типам адресных объектов (AS_ADDR_OBJ_TYPES)...')
         file_name = self._file_address_object_type
         assert 'AS_ADDR_OBJ_TYPES_202' in file_name, f'{file_name} не ADDR_OBJ_TYPES'
-
-        def parse(item) -> AddressType:
-            return AddressType(
-                    id=item.get('@ID'),
-                    level_id=int(item.get('@LEVEL')),
-                    name=item.get('@NAME'),
-                    short_name=item.get('@SHORTNAME'),
-                    description=item.get('@DESC'),
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_active=item.get('@ISACTIVE') == 'true'
-                )
-        await self._import_model(AddressType, file_name, parse)
+        await self._import_model(AddressType, [file_name], gar_rows.ADDRESS_TYPE)
 
     async def import_param_types(self):
         self.log.info(f'Импорт сведений по типу параметра (AS_PARAM_TYPES)...')
         file_name = self._file_param_type
         assert 'AS_PARAM_TYPES_202' in file_name, f'{file_name} не PARAM_TYPES'
-
-        def parse(item) -> ParamType:
-            return ParamType(
-                id=item.get('@ID'),
-                name=item.get('@NAME'),
-                code=item.get('@CODE'),
-                description=item.get('@DESC') if item.get('@DESC') else None,
-                update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                is_active=item.get('@ISACTIVE') == 'true'
-            )
-        await self._import_model(ParamType, file_name, parse)
+        await self._import_model(ParamType, [file_name], gar_rows.PARAM_TYPE)
 
     async def import_house_types(self):
         self.log.info(f'Импорт сведений по признакам владения (AS_HOUSE_TYPES)...')
         file_name = self._file_house_type
         assert 'AS_HOUSE_TYPES_202' in file_name, f'{file_name} не HOUSE_TYPES'
-
-        def parse(item) -> HouseType:
-            return HouseType(
-                id=item.get('@ID'),
-                name=item.get('@NAME'),
-                short_name=item.get('@SHORTNAME'),
-                description=item.get('@DESC') if item.get('@DESC') else None,
-                update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                is_active=item.get('@ISACTIVE') == 'true'
-            )
-        await self._import_model(HouseType, file_name, parse)
+        await self._import_model(HouseType, [file_name], gar_rows.HOUSE_TYPE)
 
     async def import_apartment_types(self):
         self.log.info(f'Импорт сведений по типам помещений (AS_APARTMENT_TYPES)...')
         file_name = self._file_apartment_type
         assert 'AS_APARTMENT_TYPES_202' in file_name, f'{file_name} не AS_APARTMENT_TYPES'
-
-        def parse(item) -> ApartmentType:
-            return ApartmentType(
-                id=item.get('@ID'),
-                name=item.get('@NAME'),
-                short_name=item.get('@SHORTNAME'),
-                description=item.get('@DESC') if item.get('@DESC') else None,
-                update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                is_active=item.get('@ISACTIVE') == 'true'
-            )
-        await self._import_model(ApartmentType, file_name, parse)
-
-    async def import_address_object(self):
-        self.log.info(f'Импорт классификатора адресообразующих элементов: регионы, города, улицы (AS_ADDR_OBJ)...')
-
-        def parse(item) -> Optional[AddressObject]:
-            if int(item.get('@NEXTID', 0)) == 0 and item.get('@NAME'):
-                # Выбираем только актуальные записи
-                return AddressObject(
-                    id=item.get('@ID'),
-                    object_id=item.get('@OBJECTID'),
-                    object_guid=item.get('@OBJECTGUID'),
-                    name=item.get('@NAME'),
-                    type_name=item.get('@TYPENAME'),
-                    level_id=int(item.get('@LEVEL')),
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_actual=item.get('@ISACTUAL') == '1',
-                    is_active=item.get('@ISACTIVE') == '1',
-                )
-
-        tasks = [
-            asyncio.create_task(self._import_model(AddressObject, file_name, parse))
-            for file_name in self._file_address_object
-        ]
-        await asyncio.gather(*tasks)
-
-    async def import_houses(self):
-        self.log.info(f'Импорт сведений по номерам домов улиц городов и населенных пунктов (AS_HOUSE)...')
-
-        def parse(item: dict) -> Optional[House]:
-            if int(item.get('@NEXTID', 0)) == 0:
-                # Выбираем только актуальные записи
-                if int(item.get('@HOUSETYPE', 0)) < 0:
-                    # Пропускаем записи, нарушающие ограничения внешнего ключа
-                    return
-                return House(
-                    id=item.get('@ID'),
-                    object_id=item.get('@OBJECTID'),
-                    object_guid=item.get('@OBJECTGUID'),
-                    house_num=item.get('@HOUSENUM'),
-                    add_num1=item.get('@ADDNUM1'),
-                    add_num2=item.get('@ADDNUM2'),
-                    house_type=int(item.get('@HOUSETYPE')) if item.get('@HOUSETYPE') else None,
-                    add_type1=int(item.get('@ADDTYPE1')) if item.get('@ADDTYPE1') else None,
-                    add_type2=int(item.get('@ADDTYPE2')) if item.get('@ADDTYPE2') else None,
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_actual=item.get('@ISACTUAL') == '1',
-                    is_active=item.get('@ISACTIVE') == '1',
-                )
-
-        tasks = [
-            asyncio.create_task(self._import_model(House, file_name, parse))
-            for file_name in self._file_house
-        ]
-        await asyncio.gather(*tasks)
-
-    async def import_apartments(self):
-        self.log.info(f'Импорт сведений по помещениям (AS_APARTMENTS)...')
-
-        def parse(item) -> Optional[Apartment]:
-            if int(item.get('@NEXTID', 0)) == 0:
-                # Выбираем только актуальные записи
-                return Apartment(
-                    id=item.get('@ID'),
-                    object_id=int(item.get('@OBJECTID')),
-                    object_guid=item.get('@OBJECTGUID'),
-                    number=item.get('@NUMBER'),
-                    apartment_type_id=abs(int(item.get('@APARTTYPE'))),
-                    is_actual=item.get('@ISACTUAL') == '1',
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_active=item.get('@ISACTIVE') == '1'
-                )
-        tasks = [
-            asyncio.create_task(self._import_model(Apartment, file_name, parse))
-            for file_name in self._file_apartment
-        ]
-        await asyncio.gather(*tasks)
-
-    async def import_administration_hierarchy(self):
-        self.log.info(f'Импорт сведений по иерархии в административном делении (AS_ADM_HIERARCHY)...')
-
-        def parse(item) -> Optional[AdministrationHierarchy]:
-            if int(item.get('@NEXTID', 0)) == 0:
-                # Выбираем только актуальные записи
-                return AdministrationHierarchy(
-                    id=item.get('@ID'),
-                    object_id=int(item.get('@OBJECTID')),
-                    parent_object_id=None if item.get('@PARENTOBJID', '0') == '0' else int(item.get('@PARENTOBJID')),
-                    region_code=None if item.get('@REGIONCODE') == '0' else item.get('@REGIONCODE'),
-                    area_code=None if item.get('@AREACODE') == '0' else item.get('@AREACODE'),
-                    city_code=None if item.get('@CITYCODE') == '0' else item.get('@CITYCODE'),
-                    place_code=None if item.get('@PLACECODE') == '0' else item.get('@PLACECODE'),
-                    plan_code=None if item.get('@PLANCODE') == '0' else item.get('@PLANCODE'),
-                    street_code=None if item.get('@STREETCODE') == '0' else item.get('@STREETCODE'),
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_active=item.get('@ISACTIVE') == '1'
-                )
-        tasks = [
-            asyncio.create_task(self._import_model(AdministrationHierarchy, file_name, parse, True))
-            for file_name in self._file_adm_hierarchy
-        ]
-        await asyncio.gather(*tasks)
-
-    async def import_mun_hierarchy(self):
-        self.log.info(f'Импорт сведений по иерархии в муниципальном делении (AS_MUN_HIERARCHY)...')
-
-        def parse(item) -> Optional[MunHierarchy]:
-            if int(item.get('@NEXTID', 0)) == 0:
-                # Выбираем только актуальные записи
-                return MunHierarchy(
-                    id=item.get('@ID'),
-                    object_id=int(item.get('@OBJECTID')),
-                    parent_object_id=None if item.get('@PARENTOBJID', '0') == '0' else int(item.get('@PARENTOBJID')),
-                    oktmo=item.get('@OBJECTID'),
-                    path=item.get('@PATH'),
-                    update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                    start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                    end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    is_active=item.get('@ISACTIVE') == '1'
-                )
-        tasks = [
-            asyncio.create_task(self._import_model(MunHierarchy, file_name, parse, True))
-            for file_name in self._file_mun_hierarchy
-        ]
-        await asyncio.gather(*tasks)
-
-    async def import_address_object_param(self):
-        self.log.info(f'Импорт сведений по типу параметра (КЛАДР) (AS_ADDR_OBJ_PARAMS)...')
-
-        def parse(item) -> Optional[AddressObjectParam]:
-            type_id = int(item.get('@TYPEID'))
-            if type_id in {5, 10, 16} and int(item.get('@CHANGEIDEND', 0)) == 0:
-                # Читаем КЛАДР из списка с признаком актуальности и убираем этот признак.
-                # Можно было бы брать сразу из списка с TYPEID == 11, но он у них давно не обновлялся
-                return AddressObjectParam(
-                        id=item.get('@ID'),
-                        object_id=int(item.get('@OBJECTID')),
-                        param_type_id=11 if type_id == 10 else type_id,
-                        value=item.get('@VALUE')[:-2] if type_id == 10 else item.get('@VALUE')[:128],
-                        update_date=datetime.strptime(item.get('@UPDATEDATE'), "%Y-%m-%d").date(),
-                        start_date=datetime.strptime(item.get('@STARTDATE'), "%Y-%m-%d").date(),
-                        end_date=datetime.strptime(item.get('@ENDDATE'), "%Y-%m-%d").date(),
-                    )
-        tasks = [
-            asyncio.create_task(self._import_model(AddressObjectParam, file_name, parse, True))
-            for file_name in self._file_object_param
-        ]
-        await asyncio.gather(*tasks)
+        await self._import_model(ApartmentType, [file_name], gar_rows.APARTMENT_TYPE)
+
+    @staticmethod
+    def _region_text(region: Optional[str]) -> str:
+        return f' Регион {region}.' if region else ''
+
+    async def import_address_object(self, region: Optional[str] = None):
+        self.log.info(f'Импорт классификатора адресообразующих элементов: регионы, города, улицы (AS_ADDR_OBJ).'
+                      f'{self._region_text(region)}..')
+        await self._import_model(AddressObject, self._region_files(self._file_address_object, region),
+                                 gar_rows.ADDRESS_OBJECT)
+
+    async def import_houses(self, region: Optional[str] = None):
+        self.log.info(f'Импорт сведений по номерам домов улиц городов и населенных пунктов (AS_HOUSE).'
+                      f'{self._region_text(region)}..')
+        await self._import_model(House, self._region_files(self._file_house, region), gar_rows.HOUSE)
+
+    async def import_apartments(self, region: Optional[str] = None):
+        self.log.info(f'Импорт сведений по помещениям (AS_APARTMENTS).{self._region_text(region)}..')
+        await self._import_model(Apartment, self._region_files(self._file_apartment, region), gar_rows.APARTMENT)
+
+    async def import_administration_hierarchy(self, region: Optional[str] = None):
+        self.log.info(f'Импорт сведений по иерархии в административном делении (AS_ADM_HIERARCHY).'
+                      f'{self._region_text(region)}..')
+        await self._import_model(AdministrationHierarchy, self._region_files(self._file_adm_hierarchy, region),
+                                 gar_rows.ADMINISTRATION_HIERARCHY, True)
+
+    async def import_mun_hierarchy(self, region: Optional[str] = None):
+        self.log.info(f'Импорт сведений по иерархии в муниципальном делении (AS_MUN_HIERARCHY).'
+                      f'{self._region_text(region)}..')
+        await self._import_model(MunHierarchy, self._region_files(self._file_mun_hierarchy, region),
+                                 gar_rows.MUN_HIERARCHY, True)
+
+    async def import_address_object_param(self, region: Optional[str] = None):
+        self.log.info(f'Импорт сведений по типу параметра (КЛАДР) (AS_ADDR_OBJ_PARAMS).{self._region_text(region)}..')
+        await self._import_model(AddressObjectParam, self._region_files(self._file_object_param, region),
+                                 gar_rows.ADDRESS_OBJECT_PARAM, True)
+
+    async def _check_shadow(self, shadow: ShadowDatabase) -> None:
+        """
+        Проверить теневую БД перед заменой: в таблицах ровно столько записей, сколько записано при импорте
+        (ошибки записи отдельных записей только логируются), и есть адресные объекты.
+        После продолжения прерванного импорта в таблицах есть и записи прерванного - проверяется только,
+        что записанные сохранены
+        """
+        counts = await shadow.counts()
+        errors = [f'{name}: записано {count}, в таблице {counts.get(name)}'
+                  for name, count in self.counts.items()
+                  if (counts.get(name, 0) < count if self._checkpoints else counts.get(name) != count)]
+        if not counts.get(AddressObject.Meta.tablename):
+            errors.append(f'{AddressObject.Meta.tablename}: нет записей')
+        if errors:
+            raise RuntimeError(f'Теневая БД не прошла проверку: {"; ".join(errors)}')
+        self.log.info(f'Теневая БД проверена: {", ".join(f"{x} {y}" for x, y in self.counts.items())}')
+
+    def _scheduler(self) -> StepScheduler:
+        """
+        Шаги импорта и зависимости между ними: внешние ключи на справочники, а иерархии и параметры
+        фильтруются по индексу object_id, поэтому ждут таблицы объектов своего региона.
+        Регионы не зависят друг от друга и импортируются параллельно (не более settings.update.steps шагов)
+        """
+        scheduler = StepScheduler(self.loader.steps)
+        self._step_files = {}
+        self._tables = {}
+
+        def add(name: str, model, run, file_names: List[str], *depends: str) -> None:
+            scheduler.add(name, run, *depends)
+            self._step_files[name] = file_names
+            table = model.Meta.table
+            self._tables.setdefault(table.name, TableLoad(table)).steps += 1
+
+        add('levels', Level, self.import_level, [self._file_levels])
+        add('address_types', AddressType, self.import_address_type, [self._file_address_object_type], 'levels')
+        add('param_types', ParamType, self.import_param_types, [self._file_param_type])
+        add('house_types', HouseType, self.import_house_types, [self._file_house_type])
+        add('apartment_types', ApartmentType, self.import_apartment_types, [self._file_apartment_type])
+
+        update = settings.update
+        for region in self._regions:
+            def files(file_names: List[str]) -> List[str]:
+                return self._region_files(file_names, region)
+
+            add(f'address_objects_{region}', AddressObject, partial(self.import_address_object, region),
+                files(self._file_address_object), 'levels')
+            if update.level in (update.Level.home, update.Level.apartment):
+                add(f'houses_{region}', House, partial(self.import_houses, region), files(self._file_house),
+                    'house_types')
+            if update.level in (update.Level.apartment, ):
+                add(f'apartments_{region}', Apartment, partial(self.import_apartments, region),
+                    files(self._file_apartment), 'apartment_types')
+
+            objects = (f'address_objects_{region}', f'houses_{region}', f'apartments_{region}')
+            if update.hierarchy in (update.Hierarchy.administration, update.Hierarchy.all):
+                add(f'hierarchy_adm_{region}', AdministrationHierarchy,
+                    partial(self.import_administration_hierarchy, region), files(self._file_adm_hierarchy), *objects)
+            if update.hierarchy in (update.Hierarchy.municipal, update.Hierarchy.all):
+                add(f'hierarchy_mun_{region}', MunHierarchy, partial(self.import_mun_hierarchy, region),
+                    files(self._file_mun_hierarchy), *objects)
+            add(f'address_object_params_{region}', AddressObjectParam,
+                partial(self.import_address_object_param, region), files(self._file_object_param),
+                'param_types', *objects)
+        return scheduler
 
     async def import_all(self):
         """
         Импорт всех данных из архива
         """
-        str_region = f'Регион: {self.region:0=2}' if self.region else ''
-        self.log.info(f'Импорт ГАР/ФИАС. Файл {self.archive.filename}. {str_region}')
-
-        update = Updates(id=self.version, state='Выполняется')
-        await self._commit_updates(Updates, [update], True, 'updates')
+        str_region = f'Регион: {", ".join(f"{x:0=2}" for x in self.regions)}' if self.regions else ''
+        file_names = ', '.join(x.filename for x in self.archive.archives) if isinstance(self.archive, ArchiveSet) \
+            else self.archive.filename
+        self.log.info(f'Импорт ГАР/ФИАС. Файл {file_names}. {str_region}')
+
+        # Полный архив загружаем в теневую БД и заменяем ей рабочую только после проверки
+        shadow = get_shadow() if settings.update.shadow and self.is_full else None
+        # Прерванный импорт этой версии продолжаем с сохраненного состояния файлов.
+        # Теневая БД при ошибке удаляется, поэтому импорт в нее продолжается, только если она осталась
+        # после аварийного завершения. Объединенные обновления начинаются заново: записи, записанные
+        # до прерывания, неизвестны
+        update = await Updates.objects.get_or_none(id=self.version)
+        resume = update is not None and update.state != 'Выполнено' and self._seen is None
+        await self._load_checkpoints(resume and (not shadow or await shadow.exists()))
+        await self._update_state('Выполняется')
 
         try:
-            await self.import_level()
-            await self.import_address_type()
-            await self.import_param_types()
-            await self.import_house_types()
-            await self.import_apartment_types()
-
-            await self.import_address_object()
-            if settings.update.level in (settings.update.Level.home, settings.update.Level.apartment):
-                await self.import_houses()
-            if settings.update.level in (settings.update.Level.apartment, ):
-                await self.import_apartments()
-
-            if settings.update.hierarchy in (settings.update.Hierarchy.administration, settings.update.Hierarchy.all):
-                await self.import_administration_hierarchy()
-            if settings.update.hierarchy in (settings.update.Hierarchy.municipal, settings.update.Hierarchy.all):
-                await self.import_mun_hierarchy()
-            await self.import_address_object_param()
-
-            update = Updates(id=self.version, state='Выполнено')
-            await self._commit_updates(Updates, [update], True, 'updates')
+            if shadow:
+                self._live = databases.Database(get_connection_url())
+                await self._live.connect()
+                await shadow.open(bool(self._checkpoints))
+            try:
+                await self.loader.open()
+                await self._restore_indexes()
+                await self._check_objects_in_database()
+                scheduler = self._scheduler()
+                await self._register_files([x for step in scheduler.steps for x in self._step_files[step]])
+                try:
+                    await scheduler.run()
+                except Exception:
+                    await self._rebuild_pending_indexes()
+                    raise
+                self.log.info(f'Индекс object_id: {len(self.object_ids)} объектов, '
+                              f'{get_str_file_size(self.object_ids.memory)}')
+            finally:
+                await self.loader.close()
+
+            if shadow:
+                await self._check_shadow(shadow)
+            await self._update_state('Выполнено')
+            if shadow:
+                await shadow.swap()
         except Exception as e:
-            update = Updates(id=self.version, state='Ошибка')
-            await self._commit_updates(Updates, [update], True, 'updates')
+            if shadow:
+                # Рабочая БД не менялась
+                await shadow.discard()
+            await self._update_state('Ошибка')
             self.log.critical(f'{e}')
             raise e
         finally:
+            if self._live:
+                await self._live.disconnect()
+                self._live = None
+            await self.reader.close()
             self.log.info('Импорт завершен')
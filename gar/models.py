@@ -210,6 +210,9 @@ class AdministrationHierarchy(ormar.Model, DateModelMixin):
     """
     class Meta(BaseMeta):
         tablename = 'hierarchy_adm'
+        # Индекс пути для выборки потомков (path like '<путь>.%'), в PostgreSQL - с text_pattern_ops
+        constraints = [ormar.IndexColumns('path', name='ix_hierarchy_adm_path',
+                                          postgresql_ops={'path': 'text_pattern_ops'})]
 
     id: int = ormar.BigInteger(primary_key=True, autoincrement=False, comment='id')
     object_id: int = ormar.BigInteger(
@@ -227,6 +230,8 @@ class AdministrationHierarchy(ormar.Model, DateModelMixin):
     place_code: int = ormar.Integer(nullable=True, comment='Код населенного пункта')
     plan_code: int = ormar.Integer(nullable=True, comment='Код ЭПС')
     street_code: int = ormar.Integer(nullable=True, comment='Код улицы')
+    path: str = ormar.String(max_length=250, nullable=True,
+                             comment='Материализованный путь к объекту (полная иерархия)')
 
     ao_object_id: Union[AddressObject, Dict] = ormar.ForeignKey(AddressObject, name='object_id', virtual=True,
                                                                 related_name='address_object')
@@ -282,6 +287,25 @@ class AddressObjectParam(ormar.Model):
         return self.value
 
 
+class ObjectRoute(ormar.Model):
+    """
+    Таблица адресного объекта по object_id и object_guid: объект ищется одним запросом к одной таблице.
+    Заполняется при импорте
+    """
+    class Meta(BaseMeta):
+        tablename = 'object_routes'
+
+    object_id: int = ormar.BigInteger(primary_key=True, autoincrement=False,
+                                      comment='Глобальный уникальный идентификатор адресного объекта')
+    object_guid: bytes = ormar.LargeBinary(max_length=16, index=True,
+                                           comment='Идентификатор адресного объекта ФИАС (GUID, 16 байт)')
+    table_code: int = ormar.SmallInteger(comment='Таблица объекта: 1 - address_objects, 2 - houses, 3 - apartments')
+
+
+# Таблицы адресных объектов по коду в object_routes
+OBJECT_TABLES = {1: AddressObject, 2: House, 3: Apartment}
+
+
 class Updates(ormar.Model):
     """
     История обновлений
@@ -300,6 +324,36 @@ class Updates(ormar.Model):
         return f'id: {self.id} {self.state}'
 
 
+class UpdateFile(ormar.Model):
+    """
+    Состояние импорта файлов архива обновления. Позволяет продолжить прерванный импорт
+    """
+    class Meta(BaseMeta):
+        tablename = 'update_files'
+
+    # Версия и имя файла архива: 20220707/77/AS_HOUSES_20220707_....XML
+    id: str = ormar.String(primary_key=True, max_length=300, comment='Версия/файл')
+    version: int = ormar.Integer(index=True, comment='Версия обновления {updates -> id}')
+    file_name: str = ormar.String(max_length=255, comment='Файл архива')
+    rows: int = ormar.BigInteger(comment='Количество прочитанных записей файла, сохраненных в БД')
+    done: bool = ormar.Boolean(comment='Файл импортирован полностью')
+    update_date: datetime.datetime = ormar.DateTime(timezone=False, nullable=False, default=datetime.datetime.utcnow,
+                                                    comment='Дата и время сохранения состояния')
+    # Показатели импорта файла
+    size: int = ormar.BigInteger(default=0, comment='Размер распакованного файла')
+    read_bytes: int = ormar.BigInteger(default=0, comment='Распаковано байт')
+    read_rows: int = ormar.BigInteger(default=0, comment='Прочитано записей XML')
+    kept_rows: int = ormar.BigInteger(default=0, comment='Отобрано записей для загрузки')
+    inserted: int = ormar.BigInteger(default=0, comment='Добавлено записей')
+    updated: int = ormar.BigInteger(default=0, comment='Обновлено записей')
+    parse_time: float = ormar.Float(default=0, comment='Время распаковки и разбора XML, с')
+    convert_time: float = ormar.Float(default=0, comment='Время преобразования записей, с')
+    write_time: float = ormar.Float(default=0, comment='Время записи в БД, с')
+
+    def __str__(self):
+        return f'{self.id}: {self.rows}{" (загружен)" if self.done else ""}'
+
+
 class AlembicVersion(ormar.Model):
     """
     Версия миграции БД
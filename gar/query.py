@@ -1,19 +1,75 @@
+# Дочерние объекты: по ветке на таблицу объектов, каждая со своим отбором, сортировкой и LIMIT.
+# Ветки выполняются по очереди и общий LIMIT останавливает запрос, как только найдено достаточно объектов:
+# дома и помещения не ищутся, если хватило адресных объектов (find выбирает их первыми).
+# Пустые колонки веток - null без приведения типа: тип задает колонка объекта (cast в MySQL другой).
+# {parent_condition} - h.parent_object_id = :object_id или h.parent_object_id is null (поиск от корня)
 sql_find_child = """
-select
-    o1.object_id as address_objects,
-    o2.object_id as houses,
-    o3.object_id as apartments
-from {hierarchy_table} h
-    left join address_objects o1 on o1.object_id = h.object_id
-    left join houses o2 on o2.object_id = h.object_id and (:add_num1 is null or o2.add_num1 = :add_num1) and (:add_num2 is null or o2.add_num2 = :add_num2)
-    left join apartments o3 on o3.object_id = h.object_id
-where (h.parent_object_id = :object_id or (:object_id is null and h.parent_object_id is null))
-    and (o1.name like :text or o2.house_num like :text or o3.number like :text)
-order by h.is_active desc, 
-    o1.name, o2.house_num, o3.number,
-    h.start_date desc,
-    o1.is_active desc, o1.start_date desc, 
-    o2.is_active desc, o2.start_date desc, 
-    o3.is_active desc, o3.start_date desc
+select object_id as address_objects, null as houses, null as apartments from (
+    select o.object_id
+    from {hierarchy_table} h
+        join address_objects o on o.object_id = h.object_id
+    where {parent_condition} and o.name like :text
+    order by h.is_active desc, o.name, h.start_date desc, o.is_active desc, o.start_date desc
+    limit :limit
+) a
+union all
+select null, object_id, null from (
+    select o.object_id
+    from {hierarchy_table} h
+        join houses o on o.object_id = h.object_id
+    where {parent_condition} and o.house_num like :text
+        and (:add_num1 is null or o.add_num1 = :add_num1) and (:add_num2 is null or o.add_num2 = :add_num2)
+    order by h.is_active desc, o.house_num, h.start_date desc, o.is_active desc, o.start_date desc
+    limit :limit
+) b
+union all
+select null, null, object_id from (
+    select o.object_id
+    from {hierarchy_table} h
+        join apartments o on o.object_id = h.object_id
+    where {parent_condition} and o.number like :text
+    order by h.is_active desc, o.number, h.start_date desc, o.is_active desc, o.start_date desc
+    limit :limit
+) c
+limit :limit;
+"""
+
+# Объект иерархии и все его родители одним запросом (от корня к объекту).
+# На каждом уровне берется одна запись объекта: сначала активная, затем с последней датой начала действия.
+# Подъем останавливается на записи с материализованным путем (если {path_condition} не пустое) - остальные
+# родители известны из пути. depth ограничивает глубину на случай зацикливания иерархии
+sql_hierarchy = """
+with recursive chain (id, depth) as (
+    select (
+        select h.id from {hierarchy_table} h
+        where h.object_id = :object_id
+        order by h.is_active desc, h.start_date desc
+        limit 1
+    ), 0
+    union all
+    select (
+        select p.id from {hierarchy_table} p
+        where p.object_id = h.parent_object_id
+        order by p.is_active desc, p.start_date desc
+        limit 1
+    ), c.depth + 1
+    from chain c
+        join {hierarchy_table} h on h.id = c.id
+    where h.parent_object_id is not null and h.parent_object_id <> 0 and c.depth < 32 {path_condition}
+)
+select h.*
+from chain c
+    join {hierarchy_table} h on h.id = c.id
+order by c.depth desc;
+"""
+
+# Потомки объекта административной иерархии на всех уровнях по материализованному пути (индекс ix_hierarchy_adm_path).
+# {path_condition} - h.path like :path (PostgreSQL, MySQL) или h.path glob :path (SQLite: LIKE в SQLite без учета
+# регистра и обычный индекс не использует). :path - путь объекта и '.%' ('.*' для glob)
+sql_descendants = """
+select h.*
+from hierarchy_adm h
+where {path_condition} and h.is_active
+order by h.path
 limit :limit;
 """
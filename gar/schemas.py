@@ -1,4 +1,5 @@
 import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, validator
 
@@ -59,3 +60,29 @@ class UpdatesSchema(BaseModel):
             print(kwargs['update_date'].isoformat())
             kwargs['update_date'] = kwargs['update_date'].isoformat()
         super().__init__(**kwargs)
+
+
+class ImportFileSchema(BaseModel):
+    file_name: str
+    done: bool
+    update_date: datetime.datetime
+    size: int
+    read_bytes: int
+    read_rows: int
+    kept_rows: int
+    inserted: int
+    updated: int
+    parse_time: float
+    convert_time: float
+    write_time: float
+
+
+class ImportStatusSchema(BaseModel):
+    version: int
+    state: str
+    update_date: datetime.datetime
+    size: int
+    read_bytes: int
+    progress: float
+    eta: Optional[int]
+    files: List[ImportFileSchema]
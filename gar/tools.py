@@ -1,19 +1,61 @@
 import asyncio
+import datetime
+import uuid
 from typing import Union, Optional, List, Dict, Type
 
 from core.async_obj import AsyncObj
 from core.database import database
 from core.settings import settings
-from gar.models import AddressObject, House, Apartment, AdministrationHierarchy, MunHierarchy, AddressObjectParam
-from gar.query import sql_find_child
+from gar.models import AddressObject, House, Apartment, AdministrationHierarchy, MunHierarchy, AddressObjectParam, \
+    Updates, UpdateFile, ObjectRoute, OBJECT_TABLES
+from gar.query import sql_descendants, sql_find_child, sql_hierarchy
 
 AnyAddressObjectType = Union[AddressObject, House, Apartment]
 
 
+async def get_object_table(object_id: Optional[int] = None,
+                           object_guid: Optional[str] = None) -> Optional[Type[AnyAddressObjectType]]:
+    """
+    Таблица адресного объекта по object_routes. None - объекта в object_routes нет
+    """
+    if object_id is not None:
+        query = ObjectRoute.objects.filter(object_id=object_id)
+    else:
+        try:
+            query = ObjectRoute.objects.filter(object_guid=uuid.UUID(object_guid).bytes)
+        except (TypeError, ValueError, AttributeError):
+            return None
+    codes = await query.limit(1).values_list('table_code', flatten=True)
+    return OBJECT_TABLES.get(codes[0]) if codes else None
+
+
+async def get_address_objects(object_ids: List[int]) -> List[AnyAddressObjectType]:
+    """
+    Адресные объекты по списку object_id: запросы только к таблицам, в которых они есть по object_routes.
+    Объекты, которых нет в object_routes, ищутся во всех таблицах
+    """
+    if not object_ids:
+        return []
+    routes = dict(await ObjectRoute.objects.filter(object_id__in=object_ids).values_list(['object_id', 'table_code']))
+    missed = [x for x in object_ids if x not in routes]
+    tasks = []
+    for code, model in OBJECT_TABLES.items():
+        ids = [x for x in object_ids if routes.get(x) == code] + missed
+        if ids:
+            tasks.append(model.objects.filter(object_id__in=ids).select_all().all())
+    return [x for objects in await asyncio.gather(*tasks) for x in objects]
+
+
 async def get_address_object(**_filter) -> Optional[AnyAddressObjectType]:
     """
-    Получить адресный объект
+    Получить адресный объект (по object_id или object_guid). Запрос идет к таблице объекта по object_routes,
+    а если объекта там нет - ко всем таблицам адресных объектов
     """
+    model = await get_object_table(**_filter)
+    if model:
+        objects = await model.objects.filter(**_filter).select_all().all()
+        if objects:
+            return objects[0]
     tasks = [
         AddressObject.objects.filter(**_filter).select_all().all(),
         House.objects.filter(**_filter).select_all().all(),
@@ -25,6 +67,97 @@ async def get_address_object(**_filter) -> Optional[AnyAddressObjectType]:
     return None
 
 
+async def get_descendants(object_id: int, limit: int = 1000) -> List[AdministrationHierarchy]:
+    """
+    Потомки объекта в административной иерархии на всех уровнях (например, все объекты региона) по
+    материализованному пути. У объекта без пути (загружен до его появления) потомков не ищем
+    """
+    objects = await AdministrationHierarchy.objects.filter(object_id=object_id).order_by(
+        ['-is_active', '-start_date']).limit(1).all()
+    if not objects or not objects[0].path:
+        return []
+    if settings.database.driver_name == settings.database.DriverName.sqlite:
+        path_condition, path = 'h.path glob :path', f'{objects[0].path}.*'
+    else:
+        path_condition, path = 'h.path like :path', f'{objects[0].path}.%'
+    rows = await database.fetch_all(sql_descendants.format(path_condition=path_condition),
+                                    {'path': path, 'limit': limit})
+    columns = AdministrationHierarchy.Meta.table.columns.keys()
+    return [AdministrationHierarchy(**{x: row[x] for x in columns}) for row in rows]
+
+
+def import_status(update: Updates, files: List[UpdateFile], now: Optional[datetime.datetime] = None) -> Dict:
+    """
+    Ход импорта обновления по сохраненному состоянию файлов архива.
+    Оставшееся время оценивается по скорости распаковки файлов с начала текущего запуска импорта
+    (файлы, загруженные до прерывания импорта, в скорости не учитываются)
+    """
+    now = now or datetime.datetime.utcnow()
+    size = sum(x.size for x in files)
+    read = sum(x.size if x.done else min(x.read_bytes, x.size) for x in files)
+    elapsed = (now - update.update_date).total_seconds()
+    current = sum(x.read_bytes for x in files if x.update_date >= update.update_date)
+    eta = None
+    if update.state == 'Выполняется' and current and elapsed > 0:
+        eta = round((size - read) / (current / elapsed))
+    return {
+        'version': update.id,
+        'state': update.state,
+        'update_date': update.update_date,
+        'size': size,
+        'read_bytes': read,
+        'progress': round(read / size, 4) if size else 0,
+        'eta': eta,
+        'files': [x.dict() for x in files],
+    }
+
+
+async def get_import_status() -> Optional[Dict]:
+    """ Ход последнего запущенного импорта """
+    updates = await Updates.objects.order_by('-update_date').limit(1).all()
+    if not updates:
+        return None
+    files = await UpdateFile.objects.filter(version=updates[0].id).order_by('file_name').all()
+    return import_status(updates[0], files)
+
+
+def _label_value(value) -> str:
+    """ Значение метки Prometheus: экранируем обратную косую черту и кавычки """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def import_metrics(status: Optional[Dict]) -> str:
+    """
+    Ход импорта в текстовом формате Prometheus
+    """
+    lines = []
+
+    def metric(name: str, description: str, values: List) -> None:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in values:
+            text = ','.join(f'{x}="{_label_value(y)}"' for x, y in labels.items())
+            lines.append(f'{name}{{{text}}} {value}')
+
+    if status:
+        version = {'version': status['version']}
+        files = [({**version, 'file': x['file_name']}, x) for x in status['files']]
+        metric('gar_import_running', 'Импорт выполняется', [(version, int(status['state'] == 'Выполняется'))])
+        metric('gar_import_progress', 'Доля распакованных данных архива', [(version, status['progress'])])
+        if status['eta'] is not None:
+            metric('gar_import_eta_seconds', 'Оценка оставшегося времени импорта, с', [(version, status['eta'])])
+        metric('gar_import_file_bytes', 'Размер файла и объем распакованных данных, байт',
+               [({**x, 'kind': kind}, y[kind]) for x, y in files for kind in ('size', 'read_bytes')])
+        metric('gar_import_file_rows', 'Прочитано, отобрано, добавлено и обновлено записей',
+               [({**x, 'kind': kind}, y[kind])
+                for x, y in files for kind in ('read_rows', 'kept_rows', 'inserted', 'updated')])
+        metric('gar_import_file_seconds', 'Время разбора XML, преобразования записей и записи в БД, с',
+               [({**x, 'stage': stage}, y[f'{stage}_time'])
+                for x, y in files for stage in ('parse', 'convert', 'write')])
+        metric('gar_import_file_done', 'Файл загружен', [(x, int(y['done'])) for x, y in files])
+    return '\n'.join(lines) + '\n'
+
+
 class Hierarchy(AsyncObj):
     HierarchyModel = Union[Type[AdministrationHierarchy], Type[MunHierarchy]]
 
@@ -40,30 +173,26 @@ class Hierarchy(AsyncObj):
         self.model: Hierarchy.HierarchyModel = model
         self.object_id: int = obj.object_id if obj else None
 
-        obj = await self.get_hierarchy_object(self.object_id)
-        self.hierarchy = [obj] if obj else []
-        while obj and obj.parent_object_id:
-            obj = await self.get_hierarchy_object(obj.parent_object_id)
-            if obj:
-                self.hierarchy.insert(0, obj)
+        self.hierarchy: List[Union[AdministrationHierarchy, MunHierarchy]] = await self.get_hierarchy(self.object_id)
+        # Родители из материализованного пути читаются вместе с объектами
+        parents = self._path_parents(self.hierarchy[0]) if self.hierarchy else []
+        if parents is None:
+            self.hierarchy = await self.get_hierarchy(self.hierarchy[0].parent_object_id, False) + self.hierarchy
+            parents = []
 
-        hierarchy_list = [x.object_id for x in self.hierarchy]
+        hierarchy_list = parents + [x.object_id for x in self.hierarchy]
 
-        tasks = [
-            AddressObject.objects.filter(object_id__in=hierarchy_list).select_all().all(),
-            House.objects.filter(object_id__in=hierarchy_list).select_all().all(),
-            Apartment.objects.filter(object_id__in=hierarchy_list).select_all().all(),
+        objects, self.params, parents = await asyncio.gather(
+            get_address_objects(hierarchy_list),
             AddressObjectParam.objects.filter(object_id__in=hierarchy_list).all(),
-        ]
-
-        r = await asyncio.gather(*tasks)
-        self.params: List[AddressObjectParam] = r.pop(-1) if hasattr(r, 'pop') else r[:-1]
+            self.get_hierarchy_objects(parents),
+        )
+        self.hierarchy = parents + self.hierarchy
         self.objects: List[Union[AnyAddressObjectType, AddressObjectParam]] = []
 
         # Оставляем тот же порядок, что и при чтении иерархии
         for object_id in hierarchy_list:
-            for table in r:
-                _ = [self.objects.append(obj) for obj in table if obj.object_id == object_id]
+            _ = [self.objects.append(obj) for obj in objects if obj.object_id == object_id]
 
         # Выбираем имя региона
         region_names: List[str] = [x.value for x in self.params if x.param_type_id.id == 16]
@@ -85,7 +214,7 @@ class Hierarchy(AsyncObj):
     async def find(self, text: str = '', limit: int = 5) -> Optional[AnyAddressObjectType]:
         self.find_text = text
 
-        if settings.database.driver_name == settings.Database.DriverName.sqlite:
+        if settings.database.driver_name == settings.database.DriverName.sqlite:
             await database.execute("PRAGMA case_sensitive_like=OFF;")
 
         split_text: List[str] = text.split(';')
@@ -95,13 +224,19 @@ class Hierarchy(AsyncObj):
             text = split_text[0]
 
         params = {
-            'object_id': self.object_id,
             'text': f'{text}%',
             'add_num1': add_num1,
             'add_num2': add_num2,
             'limit': limit,
         }
-        objects = await database.fetch_all(sql_find_child.format(hierarchy_table=self.model.Meta.tablename), params)
+        # Условие без проверки параметра на null, чтобы использовался индекс parent_object_id
+        if self.object_id is None:
+            parent_condition = 'h.parent_object_id is null'
+        else:
+            parent_condition = 'h.parent_object_id = :object_id'
+            params['object_id'] = self.object_id
+        query = sql_find_child.format(hierarchy_table=self.model.Meta.tablename, parent_condition=parent_condition)
+        objects = await database.fetch_all(query, params)
     
         address_objects: List[int] = [x['address_objects'] for x in objects if x['address_objects']]
         houses: List[int] = [x['houses'] for x in objects if x['houses']]
@@ -126,6 +261,49 @@ class Hierarchy(AsyncObj):
             obj = await get_address_object(object_guid=object_id_or_guid)
         return obj
 
+    async def get_hierarchy(self, object_id: int,
+                            use_path: bool = True) -> List[Union[AdministrationHierarchy, MunHierarchy]]:
+        """
+        Объект иерархии и его родители (от корня к объекту) одним рекурсивным запросом.
+        use_path - остановиться на записи с материализованным путем
+        """
+        if not object_id:
+            return []
+        columns = self.model.Meta.table.columns.keys()
+        query = sql_hierarchy.format(hierarchy_table=self.model.Meta.tablename,
+                                     path_condition='and h.path is null' if use_path else '')
+        rows = await database.fetch_all(query, {'object_id': object_id})
+        return [self.model(**{x: row[x] for x in columns}) for row in rows]
+
+    @staticmethod
+    def _path_parents(obj: Union[AdministrationHierarchy, MunHierarchy]) -> Optional[List[int]]:
+        """
+        Родители записи по материализованному пути (от корня).
+        None - путь есть, но не согласуется с записью: родителей нужно читать по иерархии
+        """
+        if not obj.path or not obj.parent_object_id:
+            return []
+        try:
+            path = [int(x) for x in obj.path.split('.')]
+        except ValueError:
+            return None
+        if path[-2:] != [obj.parent_object_id, obj.object_id]:
+            return None
+        return path[:-1]
+
+    async def get_hierarchy_objects(self, object_ids: List[int]) -> List[Union[AdministrationHierarchy, MunHierarchy]]:
+        """
+        Записи иерархии объектов одним запросом, в порядке object_ids.
+        Для каждого объекта берется одна запись, как в get_hierarchy_object
+        """
+        if not object_ids:
+            return []
+        found = {}
+        for obj in await self.model.objects.filter(object_id__in=object_ids).order_by(
+                ['-is_active', '-start_date']).all():
+            found.setdefault(obj.object_id, obj)
+        return [found[x] for x in object_ids if x in found]
+
     async def get_hierarchy_object(self, object_id: int) -> Optional[HierarchyModel]:
         if not object_id:
             return None
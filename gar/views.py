@@ -2,11 +2,13 @@ from typing import List, Optional, Union
 
 from fastapi import APIRouter, HTTPException
 from starlette import status
+from starlette.responses import PlainTextResponse
 
 from gar.models import Level, AddressType, ParamType, HouseType, ApartmentType, Updates, AdministrationHierarchy, \
     MunHierarchy, AddressObjectParam
-from gar.schemas import LevelSchema, DirectorySchema, ParamTypeSchema, AddressTypeSchema, UpdatesSchema
-from gar.tools import get_address_object, Hierarchy
+from gar.schemas import LevelSchema, DirectorySchema, ParamTypeSchema, AddressTypeSchema, UpdatesSchema, \
+    ImportStatusSchema
+from gar.tools import get_address_object, get_descendants, Hierarchy, get_import_status, import_metrics
 
 router_types = APIRouter(prefix='/api', tags=['ГАР / ФИАС - Типы объектов'])
 router = APIRouter(prefix='/api', tags=['ГАР / ФИАС'])
@@ -65,6 +67,27 @@ async def updates():
     return await Updates.objects.all()
 
 
+@router.get("/import/status", response_model=ImportStatusSchema)
+async def import_status():
+    """
+    <strong>Ход последнего импорта</strong>
+
+    Состояние и показатели файлов архива, доля распакованных данных и оценка оставшегося времени (eta, с)
+    """
+    result = await get_import_status()
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return result
+
+
+@router.get("/import/metrics", response_class=PlainTextResponse)
+async def import_status_metrics():
+    """
+    Ход последнего импорта в текстовом формате Prometheus
+    """
+    return import_metrics(await get_import_status())
+
+
 @router.get("/objects/object/{object_id}")
 async def object_by_id(object_id: Union[int, str]):
     """
@@ -105,6 +128,16 @@ async def adm_hierarchy(object_id_or_guid: Union[int, str], objects: bool = Fals
     return o.dict(objects=objects, hierarchy=hierarchy)
 
 
+@router.get("/objects/adm_hierarchy/{object_id}/descendants")
+async def adm_descendants(object_id: int, limit: int = 1000):
+    """
+    <strong>Получить потомков объекта в административной иерархии на всех уровнях</strong>
+
+    Например, все объекты региона. Поиск по материализованному пути
+    """
+    return await get_descendants(object_id, limit)
+
+
 @router.get("/objects/mun_hierarchy/{object_id_or_guid}")
 async def mun_hierarchy(object_id_or_guid: Union[int, str], objects: bool = False, hierarchy: bool = False):
     """
@@ -0,0 +1,32 @@
+"""Object routes
+
+Revision ID: 4e8a1c5d7b92
+Revises: 9d4b6e2f1c73
+Create Date: 2022-07-27 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8a1c5d7b92'
+down_revision = '9d4b6e2f1c73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Таблица заполняется при импорте. Пока объекта в ней нет, он ищется во всех таблицах адресных объектов
+    op.create_table('object_routes',
+    sa.Column('object_id', sa.BigInteger(), nullable=False, comment='Глобальный уникальный идентификатор адресного объекта'),
+    sa.Column('object_guid', sa.LargeBinary(length=16), nullable=False, comment='Идентификатор адресного объекта ФИАС (GUID, 16 байт)'),
+    sa.Column('table_code', sa.SmallInteger(), nullable=False, comment='Таблица объекта: 1 - address_objects, 2 - houses, 3 - apartments'),
+    sa.PrimaryKeyConstraint('object_id')
+    )
+    op.create_index(op.f('ix_object_routes_object_guid'), 'object_routes', ['object_guid'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_object_routes_object_guid'), table_name='object_routes')
+    op.drop_table('object_routes')
@@ -0,0 +1,34 @@
+"""Update files
+
+Revision ID: 5b1d2a7c9e40
+Revises: 011e038fb4ce
+Create Date: 2022-07-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d2a7c9e40'
+down_revision = '011e038fb4ce'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('update_files',
+    sa.Column('id', sa.String(length=300), nullable=False, comment='Версия/файл'),
+    sa.Column('version', sa.Integer(), nullable=False, comment='Версия обновления {updates -> id}'),
+    sa.Column('file_name', sa.String(length=255), nullable=False, comment='Файл архива'),
+    sa.Column('rows', sa.BigInteger(), nullable=False, comment='Количество прочитанных записей файла, сохраненных в БД'),
+    sa.Column('done', sa.Boolean(), nullable=False, comment='Файл импортирован полностью'),
+    sa.Column('update_date', sa.DateTime(), nullable=False, comment='Дата и время сохранения состояния'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_update_files_version'), 'update_files', ['version'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_update_files_version'), table_name='update_files')
+    op.drop_table('update_files')
@@ -0,0 +1,40 @@
+"""Update file metrics
+
+Revision ID: 7c3e9f1a2b58
+Revises: 5b1d2a7c9e40
+Create Date: 2022-07-21 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3e9f1a2b58'
+down_revision = '5b1d2a7c9e40'
+branch_labels = None
+depends_on = None
+
+columns = (
+    ('size', sa.BigInteger(), 'Размер распакованного файла'),
+    ('read_bytes', sa.BigInteger(), 'Распаковано байт'),
+    ('read_rows', sa.BigInteger(), 'Прочитано записей XML'),
+    ('kept_rows', sa.BigInteger(), 'Отобрано записей для загрузки'),
+    ('inserted', sa.BigInteger(), 'Добавлено записей'),
+    ('updated', sa.BigInteger(), 'Обновлено записей'),
+    ('parse_time', sa.Float(), 'Время распаковки и разбора XML, с'),
+    ('convert_time', sa.Float(), 'Время преобразования записей, с'),
+    ('write_time', sa.Float(), 'Время записи в БД, с'),
+)
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('update_files') as batch_op:
+        for name, column_type, comment in columns:
+            batch_op.add_column(sa.Column(name, column_type, nullable=False, server_default='0', comment=comment))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('update_files') as batch_op:
+        for name, _, _ in columns:
+            batch_op.drop_column(name)
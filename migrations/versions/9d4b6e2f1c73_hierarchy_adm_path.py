@@ -0,0 +1,28 @@
+"""Hierarchy adm path
+
+Revision ID: 9d4b6e2f1c73
+Revises: 7c3e9f1a2b58
+Create Date: 2022-07-25 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4b6e2f1c73'
+down_revision = '7c3e9f1a2b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Путь заполняется при импорте: у записей, загруженных раньше, он появится с обновлением или новым импортом
+    with op.batch_alter_table('hierarchy_adm') as batch_op:
+        batch_op.add_column(sa.Column('path', sa.String(length=250), nullable=True,
+                                      comment='Материализованный путь к объекту (полная иерархия)'))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('hierarchy_adm') as batch_op:
+        batch_op.drop_column('path')
@@ -0,0 +1,25 @@
+"""Hierarchy adm path index
+
+Revision ID: c2d7f4a9e815
+Revises: 4e8a1c5d7b92
+Create Date: 2022-07-29 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d7f4a9e815'
+down_revision = '4e8a1c5d7b92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Выборка потомков по префиксу пути. В PostgreSQL like использует индекс только с text_pattern_ops
+    op.create_index(op.f('ix_hierarchy_adm_path'), 'hierarchy_adm', ['path'], unique=False,
+                    postgresql_ops={'path': 'text_pattern_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_hierarchy_adm_path'), table_name='hierarchy_adm')
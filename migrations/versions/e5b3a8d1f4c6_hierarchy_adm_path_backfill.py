@@ -0,0 +1,54 @@
+"""Hierarchy adm path backfill
+
+Revision ID: e5b3a8d1f4c6
+Revises: c2d7f4a9e815
+Create Date: 2022-08-01 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b3a8d1f4c6'
+down_revision = 'c2d7f4a9e815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Путь записей, загруженных до его появления: object_id предков через точку, как в PATH ГАР.
+    # Пути строятся от корней по действующим записям и сохраняются во вспомогательную таблицу,
+    # чтобы обновление искало путь записи по ключу, а не вычисляло рекурсивный запрос для каждой записи
+    if op.get_bind().dialect.name == 'mysql':
+        root_path, child_path = 'cast(h.object_id as char(250))', "concat(p.path, '.', h.object_id)"
+    else:
+        root_path, child_path = 'cast(h.object_id as text)', "p.path || '.' || cast(h.object_id as text)"
+    op.create_table('hierarchy_adm_paths',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('path', sa.String(length=250), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.execute(f"""
+        insert into hierarchy_adm_paths (id, path)
+        with recursive paths (id, object_id, path, depth) as (
+            select h.id, h.object_id, {root_path}, 0
+            from hierarchy_adm h
+            where h.is_active and (h.parent_object_id is null or h.parent_object_id = 0)
+            union all
+            select h.id, h.object_id, {child_path}, p.depth + 1
+            from paths p
+                join hierarchy_adm h on h.parent_object_id = p.object_id
+            where h.is_active and p.depth < 32
+        )
+        select id, min(path) from paths group by id
+    """)
+    op.execute("""
+        update hierarchy_adm set path = (select p.path from hierarchy_adm_paths p where p.id = hierarchy_adm.id)
+        where path is null and id in (select id from hierarchy_adm_paths)
+    """)
+    op.drop_table('hierarchy_adm_paths')
+
+
+def downgrade() -> None:
+    # Заполненные пути не мешают прежней версии
+    pass
@@ -0,0 +1,60 @@
+"""Object routes backfill
+
+Revision ID: f1c9e2b7a3d4
+Revises: e5b3a8d1f4c6
+Create Date: 2022-08-01 11:00:00.000000
+
+"""
+import uuid
+from typing import Optional
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c9e2b7a3d4'
+down_revision = 'e5b3a8d1f4c6'
+branch_labels = None
+depends_on = None
+
+# Таблицы адресных объектов и их коды в object_routes
+OBJECT_TABLES = {1: 'address_objects', 2: 'houses', 3: 'apartments'}
+
+
+def _guid_bytes(value: Optional[str]) -> Optional[bytes]:
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def upgrade() -> None:
+    # Маршруты объектов, загруженных до появления object_routes: без них каждый поиск объекта идет
+    # во все таблицы. GUID хранится 16 байтами, строки с неверным GUID пропускаются (как при импорте)
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        guid = "case when {0} ~* '^[0-9a-f]{{8}}-([0-9a-f]{{4}}-){{3}}[0-9a-f]{{12}}$' " \
+               "then decode(replace({0}, '-', ''), 'hex') end"
+    elif bind.dialect.name == 'mysql':
+        guid = "case when length({0}) = 36 then unhex(replace({0}, '-', '')) end"
+    else:
+        # unhex в SQLite только с версии 3.41
+        bind.connection.create_function('guid_bytes', 1, _guid_bytes, deterministic=True)
+        guid = 'guid_bytes({0})'
+    for code, table in OBJECT_TABLES.items():
+        op.execute(f"""
+            insert into object_routes (object_id, object_guid, table_code)
+            select g.object_id, {guid.format('g.object_guid')}, {code}
+            from (
+                select t.object_id, min(t.object_guid) as object_guid
+                from {table} t
+                where not exists (select 1 from object_routes r where r.object_id = t.object_id)
+                group by t.object_id
+            ) g
+            where {guid.format('g.object_guid')} is not null
+        """)
+
+
+def downgrade() -> None:
+    # Маршруты нужны и прежней версии, она заполняет их при импорте
+    pass
@@ -1,9 +1,41 @@
+import asyncio
+import hashlib
+import io
+import os
+import pickle
+import re
+import sqlite3
+import tempfile
+import threading
 import unittest
+import zipfile
+from unittest import mock
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import List, Dict
 
+import sqlalchemy
 from starlette import status
 from starlette.testclient import TestClient
 
+import bench
+from core.database import database, get_connection_url, metadata, replace_database
+from core.settings import settings
+from fns import gar_rows
+from fns.download import Downloader, UpdateDownloads
+from fns.gar_cache import MemberCache, signature
+from fns.gar_index import ObjectIdIndex
+from fns.gar_loader import OrmarLoader, PostgresLoader, SqliteLoader, create_index_query
+from fns.gar_pipeline import FileState
+from fns.gar_reader import ArchiveReader, ArchiveSet, cached_batches, read_batches
+from fns.gar_scheduler import StepScheduler
+from fns.gar_shadow import get_shadow
+from fns.gar_xml import rows_from_xml
+from fns.import_gar import GarImport
+from gar.models import AddressObjectParam, AdministrationHierarchy, House, ObjectRoute, Updates, UpdateFile
+from gar.query import sql_descendants, sql_find_child, sql_hierarchy
+from gar.tools import import_metrics, import_status
+import update
 from main import app
 
 
@@ -79,3 +111,753 @@ class ApiTest(unittest.TestCase):
         response = self.client.get('/api/objects/find/mun_hierarchy')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.json(), dict)
+
+
+class GarXmlTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = io.BytesIO()
+        with zipfile.ZipFile(self.buffer, 'w') as archive:
+            rows = ''.join(f'<HOUSE ID="{i}" HOUSENUM="{i}&amp;1" NEXTID="0" />' for i in range(100000))
+            archive.writestr('77/AS_HOUSES.XML', f'<?xml version="1.0" encoding="utf-8"?><HOUSES>{rows}</HOUSES>')
+            archive.writestr('AS_OBJECT_LEVELS.XML', '<?xml version="1.0" encoding="utf-8"?>'
+                                                     '<OBJECTLEVELS><OBJECTLEVEL LEVEL="1" NAME="Субъект РФ" />'
+                                                     '</OBJECTLEVELS>')
+
+    def test_rows(self):
+        with zipfile.ZipFile(self.buffer) as archive:
+            rows = list(rows_from_xml(archive, '77/AS_HOUSES.XML'))
+            self.assertEqual(len(rows), 100000)
+            self.assertEqual(rows[-1], {'@ID': '99999', '@HOUSENUM': '99999&1', '@NEXTID': '0'})
+
+            rows = list(rows_from_xml(archive, 'AS_OBJECT_LEVELS.XML'))
+            self.assertEqual(rows, [{'@LEVEL': '1', '@NAME': 'Субъект РФ'}])
+
+    def test_select(self):
+        params = ''.join(f'<PARAM ID="{i}" OBJECTID="2" CHANGEID="1" CHANGEIDEND="{i % 2}" TYPEID="{i % 20}" '
+                         f'VALUE="770000000000051" UPDATEDATE="2022-07-07" STARTDATE="2022-07-07" '
+                         f'ENDDATE="2079-06-06" />' for i in range(40))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('AS_ADDR_OBJ_PARAMS.XML',
+                             f'<?xml version="1.0" encoding="utf-8"?><PARAMS>{params}</PARAMS>')
+        with zipfile.ZipFile(buffer) as archive:
+            mapping = gar_rows.ADDRESS_OBJECT_PARAM
+            items = list(rows_from_xml(archive, 'AS_ADDR_OBJ_PARAMS.XML', select=mapping.select))
+            # Отброшенные при разборе записи сохраняют нумерацию
+            self.assertEqual(len(items), 40)
+            self.assertEqual([i for i, x in enumerate(items) if x], [10, 16, 30, 36])
+            self.assertNotIn('@CHANGEID', items[10])
+            expected = [mapping(x) for x in rows_from_xml(archive, 'AS_ADDR_OBJ_PARAMS.XML')]
+            self.assertEqual([mapping(x) for x in items if x], [x for x in expected if x])
+
+    def test_batches(self):
+        def parser(item):
+            return (int(item['@ID']), ) if int(item['@ID']) % 2 else None
+
+        with zipfile.ZipFile(self.buffer) as archive:
+            batches = list(read_batches(archive, '77/AS_HOUSES.XML', parser, 20000))
+            self.assertEqual([x.offset for x in batches], [40000, 80000, 100000])
+            self.assertEqual(sum(x.size for x in batches), archive.getinfo('77/AS_HOUSES.XML').file_size)
+            # Продолжение с сохраненного смещения
+            batches = list(read_batches(archive, '77/AS_HOUSES.XML', parser, 20000, skip=80000))
+            self.assertEqual([x.offset for x in batches], [100000])
+            self.assertEqual(batches[0].rows, [(x, ) for x in range(80001, 100000, 2)])
+
+
+class MemberCacheTest(unittest.TestCase):
+    def test_cache(self):
+        def house(i: int) -> str:
+            # Пустые значения, строки не ASCII, даты и логические значения, исторические записи
+            add_num = f'ADDNUM1="{i}" ' if i % 4 else ''
+            return (f'<HOUSE ID="{i}" OBJECTID="{i}" OBJECTGUID="g{i}" HOUSENUM="{i}к«{i % 3}»" {add_num}'
+                    f'HOUSETYPE="{i % 3}" UPDATEDATE="2022-07-07" STARTDATE="2022-07-0{i % 9 + 1}" '
+                    f'ENDDATE="2079-06-06" NEXTID="{i + 1 if i % 5 == 0 else 0}" ISACTUAL="{i % 2}" ISACTIVE="1" />')
+
+        houses = ''.join(house(i) for i in range(1000))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('77/AS_HOUSES.XML', f'<?xml version="1.0" encoding="utf-8"?><HOUSES>{houses}</HOUSES>')
+        with zipfile.ZipFile(buffer) as archive, tempfile.TemporaryDirectory() as path:
+            cache = MemberCache(path, 20220707)
+            expected = list(read_batches(archive, '77/AS_HOUSES.XML', gar_rows.HOUSE, 300, cache=cache))
+            reader = cache.reader('77/AS_HOUSES.XML', gar_rows.HOUSE)
+            self.assertIsNotNone(reader)
+            # Кэш, созданный другим описанием таблицы, не используется
+            self.assertIsNone(cache.reader('77/AS_HOUSES.XML', gar_rows.APARTMENT))
+
+            batches = list(cached_batches(reader, archive.getinfo('77/AS_HOUSES.XML').file_size, 300))
+            self.assertEqual([x.rows for x in batches], [x.rows for x in expected])
+            self.assertEqual([x.offset for x in batches], [x.offset for x in expected])
+            # Продолжение с сохраненного смещения
+            offset = expected[0].offset
+            batches = cached_batches(cache.reader('77/AS_HOUSES.XML', gar_rows.HOUSE), 0, 300, offset)
+            self.assertEqual([x for batch in batches for x in batch.rows],
+                             [x for batch in expected[1:] for x in batch.rows])
+
+    def test_signature(self):
+        def mapping(convert) -> gar_rows.TableMapping:
+            return gar_rows.TableMapping('houses', [gar_rows.Column('id', '@ID', convert)])
+
+        def to_id(value):
+            return int(value)
+
+        first = signature(mapping(to_id))
+        self.assertEqual(signature(mapping(to_id)), first)
+
+        def to_id(value):
+            return int(value) + 1
+
+        # Функция с тем же именем, но другим телом: кэш, созданный прежней функцией, не используется
+        self.assertNotEqual(signature(mapping(to_id)), first)
+
+
+class FileStateTest(unittest.TestCase):
+    def test_offset(self):
+        state = FileState(100)
+        blocks = [state.add_block() for _ in range(3)]
+        # Блоки записаны не по порядку: смещение растет только по непрерывно записанным блокам
+        self.assertFalse(state.block_written(blocks[1], 300))
+        self.assertEqual(state.offset, 100)
+        self.assertTrue(state.block_written(blocks[0], 200))
+        self.assertEqual(state.offset, 300)
+        state.read = True
+        self.assertTrue(state.block_written(blocks[2], 400))
+        self.assertEqual(state.offset, 400)
+        self.assertTrue(state.done)
+
+
+class GarRowsTest(unittest.TestCase):
+    def test_columns(self):
+        self.assertEqual(gar_rows.HOUSE.names, tuple(House.Meta.table.columns.keys()))
+        self.assertEqual(gar_rows.ADDRESS_OBJECT_PARAM.names, tuple(AddressObjectParam.Meta.table.columns.keys()))
+        self.assertEqual(gar_rows.ADMINISTRATION_HIERARCHY.names,
+                         tuple(AdministrationHierarchy.Meta.table.columns.keys()))
+
+    def test_house(self):
+        item = {'@ID': '1', '@OBJECTID': '2', '@OBJECTGUID': 'guid', '@HOUSENUM': '1', '@HOUSETYPE': '2',
+                '@UPDATEDATE': '2022-07-07', '@STARTDATE': '2022-07-07', '@ENDDATE': '2079-06-06',
+                '@ISACTUAL': '1', '@ISACTIVE': '1'}
+        d1, d2 = date(2022, 7, 7), date(2079, 6, 6)
+        self.assertEqual(gar_rows.HOUSE(item), (d1, d1, d2, True, 1, 2, 'guid', '1', None, None, 2, None, None, True))
+        self.assertIsNone(gar_rows.HOUSE({**item, '@NEXTID': '3'}))
+        self.assertIsNone(gar_rows.HOUSE({**item, '@HOUSETYPE': '-1'}))
+
+    def test_param(self):
+        item = {'@ID': '1', '@OBJECTID': '2', '@TYPEID': '10', '@VALUE': '770000000000051',
+                '@UPDATEDATE': '2022-07-07', '@STARTDATE': '2022-07-07', '@ENDDATE': '2079-06-06'}
+        # Описание передается в процессы пула без собранной функции
+        mapping = pickle.loads(pickle.dumps(gar_rows.ADDRESS_OBJECT_PARAM))
+        self.assertEqual(mapping(item)[:4], (1, 2, 11, '7700000000000'))
+        self.assertIsNone(mapping({**item, '@TYPEID': '6'}))
+
+
+class UpsertTest(unittest.TestCase):
+    def test_unchanged(self):
+        table = AddressObjectParam.Meta.table
+        connection = sqlite3.connect(':memory:')
+        connection.execute(f'create table {table.name} (id integer primary key, '
+                           f'{", ".join(x for x in table.columns.keys() if x != "id")})')
+        rows = [(1, 2, 11, '77', '2022-07-07', '2022-07-07', '2079-06-06'),
+                (2, 2, 12, None, '2022-07-07', '2022-07-07', '2079-06-06')]
+        connection.executemany(SqliteLoader._insert_query(table, False), rows)
+        changes = connection.total_changes
+        # Перезаписывается только измененная запись (в том числе при сравнении с пустым значением) и новая
+        update = [rows[0], (2, 2, 12, '50', '2022-07-08', '2022-07-07', '2079-06-06'),
+                  (3, 3, 11, '77', '2022-07-07', '2022-07-07', '2079-06-06')]
+        connection.executemany(SqliteLoader._insert_query(table, True, True), update)
+        self.assertEqual(connection.total_changes - changes, 2)
+        self.assertEqual(connection.execute(f'select value from {table.name} order by id').fetchall(),
+                         [('77',), ('50',), ('77',)])
+        connection.executemany(SqliteLoader._insert_query(table, True, True), update)
+        self.assertEqual(connection.total_changes - changes, 2)
+
+    def test_primary_key(self):
+        # У object_routes первичный ключ - object_id
+        query = SqliteLoader._insert_query(ObjectRoute.Meta.table, True, True)
+        self.assertIn('on conflict (object_id) do update set object_guid = excluded.object_guid', query)
+        self.assertIn('(object_routes.object_guid, object_routes.table_code) is not', query)
+
+    def test_postgres(self):
+        driver_name = settings.database.driver_name
+        settings.database.driver_name = settings.database.DriverName.postgresql
+        try:
+            query = PostgresLoader._merge_query(ObjectRoute.Meta.table, '_gar_object_routes')
+            index = create_index_query([x for x in AdministrationHierarchy.Meta.table.indexes
+                                        if x.name == 'ix_hierarchy_adm_path'][0])
+        finally:
+            settings.database.driver_name = driver_name
+        self.assertEqual(query, 'insert into object_routes (object_id, object_guid, table_code) '
+                                'select object_id, object_guid, table_code from _gar_object_routes '
+                                'on conflict (object_id) do update set object_guid = excluded.object_guid, '
+                                'table_code = excluded.table_code '
+                                'where (object_routes.object_guid, object_routes.table_code) is distinct from '
+                                '(excluded.object_guid, excluded.table_code) returning (xmax = 0) as inserted')
+        self.assertEqual(index, 'CREATE INDEX IF NOT EXISTS ix_hierarchy_adm_path ON hierarchy_adm '
+                                '(path text_pattern_ops)')
+
+
+class HierarchyQueryTest(unittest.TestCase):
+    def test_chain(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('create table h (id, object_id, parent_object_id, is_active, start_date, path)')
+        connection.executemany('insert into h values (?, ?, ?, ?, ?, ?)', [
+            (1, 10, None, 1, '2022-01-01', None),
+            # У объекта 20 три записи: берется активная, а среди активных - с последней датой начала
+            (2, 20, 99, 0, '2022-05-01', None),
+            (3, 20, 10, 1, '2022-01-01', None),
+            (4, 20, 99, 1, '2021-01-01', None),
+            (5, 30, 20, 1, '2022-01-01', None),
+            (8, 60, 30, 1, '2022-01-01', '10.20.30.60'),
+            # Зацикленная иерархия
+            (6, 40, 50, 1, '2022-01-01', None),
+            (7, 50, 40, 1, '2022-01-01', None),
+        ])
+        query = sql_hierarchy.format(hierarchy_table='h', path_condition='')
+        self.assertEqual([x[0] for x in connection.execute(query, {'object_id': 30})], [1, 3, 5])
+        self.assertEqual([x[0] for x in connection.execute(query, {'object_id': 60})], [1, 3, 5, 8])
+        self.assertEqual(connection.execute(query, {'object_id': 1}).fetchall(), [])
+        self.assertEqual(len(connection.execute(query, {'object_id': 40}).fetchall()), 33)
+        # Подъем останавливается на записи с путем
+        query = sql_hierarchy.format(hierarchy_table='h', path_condition='and h.path is null')
+        self.assertEqual([x[0] for x in connection.execute(query, {'object_id': 60})], [8])
+        self.assertEqual([x[0] for x in connection.execute(query, {'object_id': 30})], [1, 3, 5])
+
+    def test_descendants(self):
+        connection = sqlite3.connect(':memory:')
+        metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=lambda: connection))
+        connection.executemany('insert into hierarchy_adm (id, object_id, parent_object_id, update_date, start_date, '
+                               'end_date, is_active, path) values (?, ?, ?, ?, ?, ?, ?, ?)', [
+                                   (x, y, None, '2022-07-07', '2022-07-07', '2079-06-06', z, w) for x, y, z, w in [
+                                       (1, 1, 1, '1'), (2, 2, 1, '1.2'), (3, 3, 1, '1.2.3'), (4, 12, 1, '1.12'),
+                                       (5, 13, 1, '13'), (6, 4, 0, '1.2.4'), (7, 5, 1, '1.22'),
+                                   ]
+                               ])
+        connection.row_factory = sqlite3.Row
+        query = sql_descendants.format(path_condition='h.path glob :path')
+        params = {'path': '1.2.*', 'limit': 10}
+        self.assertEqual([x['object_id'] for x in connection.execute(query, params)], [3])
+        # Все уровни, без неактивных записей и объектов с похожим началом пути (13)
+        params = {'path': '1.*', 'limit': 10}
+        self.assertEqual([x['object_id'] for x in connection.execute(query, params)], [12, 2, 3, 5])
+        plan = [x[3] for x in connection.execute(f'explain query plan {query}', params)]
+        self.assertTrue([x for x in plan if 'USING INDEX ix_hierarchy_adm_path ' in x], plan)
+
+
+class FindChildQueryTest(unittest.TestCase):
+    def test_plan(self):
+        connection = sqlite3.connect(':memory:')
+        metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=lambda: connection))
+        params = {'object_id': 1, 'text': 'Лен%', 'add_num1': None, 'add_num2': None, 'limit': 5}
+        for table in ('hierarchy_adm', 'hierarchy_mun'):
+            for condition in ('h.parent_object_id = :object_id', 'h.parent_object_id is null'):
+                query = sql_find_child.format(hierarchy_table=table, parent_condition=condition)
+                plan = [x[3] for x in connection.execute(f'explain query plan {query}', params)]
+                # Каждая ветка ищет потомков по индексу parent_object_id, а объекты - по индексу object_id,
+                # полного просмотра таблиц нет
+                self.assertFalse([x for x in plan if re.match(r'SCAN [ho]\b', x)], plan)
+                for index in (f'ix_{table}_parent_object_id', 'ix_address_objects_object_id',
+                              'ix_houses_object_id', 'ix_apartments_object_id'):
+                    self.assertTrue([x for x in plan if f'USING INDEX {index} ' in x], (index, plan))
+
+
+class ObjectIdIndexTest(unittest.TestCase):
+    def test_index(self):
+        index = ObjectIdIndex()
+        index.add([1, 7, 8, 1000, 7])
+        self.assertEqual(len(index), 4)
+        self.assertEqual([x for x in range(1002) if x in index], [1, 7, 8, 1000])
+        self.assertNotIn(10 ** 9, index)
+        # Далекие идентификаторы занимают только свою страницу
+        index.add([10 ** 9])
+        self.assertIn(10 ** 9, index)
+        self.assertEqual(index.memory, 2 * 8192)
+
+
+class StepSchedulerTest(unittest.TestCase):
+    def test_order(self):
+        events = []
+        running = []
+
+        def step(name: str):
+            async def run():
+                running.append(name)
+                events.append((name, len(running)))
+                await asyncio.sleep(0.01)
+                running.remove(name)
+            return run
+
+        async def main():
+            scheduler = StepScheduler(2)
+            scheduler.add('levels', step('levels'))
+            scheduler.add('house_types', step('house_types'))
+            scheduler.add('objects', step('objects'), 'levels')
+            scheduler.add('houses', step('houses'), 'house_types', 'apartments')
+            scheduler.add('hierarchy', step('hierarchy'), 'objects', 'houses')
+            await scheduler.run()
+            return [x.name for x in scheduler.critical_path()]
+
+        path = asyncio.run(main())
+        order = [x for x, _ in events]
+        self.assertLess(order.index('levels'), order.index('objects'))
+        self.assertEqual(order[-1], 'hierarchy')
+        self.assertLessEqual(max(x for _, x in events), 2)
+        self.assertEqual(path[-1], 'hierarchy')
+
+    def test_connections(self):
+        # Шаги выполняются с разными подключениями к БД и не делят стек транзакций
+        connections = []
+
+        async def run():
+            connections.append(database.connection())
+
+        async def main():
+            scheduler = StepScheduler(2)
+            scheduler.add('levels', run)
+            scheduler.add('house_types', run)
+            # Подключение импорта, от которого запускаются шаги
+            parent = database.connection()
+            await scheduler.run()
+            return parent
+
+        parent = asyncio.run(main())
+        self.assertNotIn(parent, connections)
+        self.assertIsNot(*connections)
+
+
+class RegionTest(unittest.TestCase):
+    def test_regions(self):
+        with tempfile.TemporaryDirectory() as path:
+            with zipfile.ZipFile(f'{path}/20220707_gar_xml.zip', 'w') as archive:
+                for name in ('OBJECT_LEVELS', 'ADDR_OBJ_TYPES', 'PARAM_TYPES', 'HOUSE_TYPES', 'APARTMENT_TYPES'):
+                    archive.writestr(f'AS_{name}_20220707.XML', '')
+                for region, size in (('01', 10), ('50', 20), ('77', 30)):
+                    for name in ('ADDR_OBJ', 'HOUSES', 'ADM_HIERARCHY'):
+                        archive.writestr(f'{region}/AS_{name}_20220707.XML', ' ' * size)
+            with zipfile.ZipFile(f'{path}/20220707_gar_xml.zip') as archive:
+                gar = GarImport(archive, [1, 77])
+                # Большой регион первым
+                self.assertEqual(gar._regions, ['77', '01'])
+                self.assertEqual(gar._file_house, ['01/AS_HOUSES_20220707.XML', '77/AS_HOUSES_20220707.XML'])
+                scheduler = gar._scheduler()
+                self.assertEqual(gar._step_files['houses_77'], ['77/AS_HOUSES_20220707.XML'])
+                self.assertEqual(scheduler.steps['hierarchy_adm_01'].depends[0], 'address_objects_01')
+                self.assertEqual(gar._tables['houses'].steps, 2)
+                self.assertEqual(GarImport(archive, 50)._regions, ['50'])
+                self.assertEqual(GarImport(archive)._regions, ['77', '50', '01'])
+
+
+class ArchiveSetTest(unittest.TestCase):
+    def test_members(self):
+        with tempfile.TemporaryDirectory() as path:
+            for version in (20220708, 20220709):
+                with zipfile.ZipFile(f'{path}/{version}_delta_xml.zip', 'w') as archive:
+                    archive.writestr(f'77/AS_HOUSES_{version}.XML', str(version))
+            archives = [zipfile.ZipFile(f'{path}/{x}_delta_xml.zip') for x in (20220708, 20220709)]
+            archive_set = ArchiveSet(archives)
+            self.assertEqual(archive_set.filename, f'{path}/20220709_delta_xml.zip')
+            self.assertEqual(archive_set.namelist(), ['77/AS_HOUSES_20220708.XML', '77/AS_HOUSES_20220709.XML'])
+            with archive_set.open('77/AS_HOUSES_20220708.XML') as file:
+                self.assertEqual(file.read(), b'20220708')
+            self.assertEqual(archive_set.archive_name('77/AS_HOUSES_20220708.XML'), f'{path}/20220708_delta_xml.zip')
+            for archive in archives:
+                archive.close()
+
+
+class ArchiveReaderTest(unittest.TestCase):
+    def test_pool_error(self):
+        async def main(archive: zipfile.ZipFile):
+            reader = ArchiveReader(archive, workers=1)
+            try:
+                # lambda не передается в процесс пула: задача пула завершается с ошибкой до начала чтения
+                return [x async for x in reader.batches(archive.namelist()[0], lambda x: x)]
+            finally:
+                await reader.close()
+
+        with tempfile.TemporaryDirectory() as path:
+            with zipfile.ZipFile(bench.make_archive(f'{path}/20220707_gar_xml.zip', streets=1)) as archive:
+                with self.assertRaises(RuntimeError):
+                    asyncio.run(asyncio.wait_for(main(archive), 60))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Файл server.data с поддержкой Range. Первый ответ обрывается после server.fail_after байт,
+    каждый - после server.fail_every байт
+    """
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self.send(False)
+
+    def do_GET(self) -> None:
+        self.send(True)
+
+    def send(self, body: bool) -> None:
+        data = self.server.data
+        start, end = 0, len(data) - 1
+        if self.headers.get('Range'):
+            start, end = (int(x) for x in self.headers['Range'][len('bytes='):].split('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"20220707"')
+        self.end_headers()
+        if body:
+            data = data[start:end + 1]
+            with self.server.lock:
+                if self.server.fail_after is not None:
+                    data, self.server.fail_after = data[:self.server.fail_after], None
+                    self.close_connection = True
+                elif self.server.fail_every and len(data) > self.server.fail_every:
+                    data = data[:self.server.fail_every]
+                    self.close_connection = True
+                self.server.served += len(data)
+            self.wfile.write(data)
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.data = bytes(range(256)) * 1200
+        self.server.fail_after = 50000
+        self.server.fail_every = None
+        self.server.served = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/20220707_gar_xml.zip'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as path:
+            downloader = Downloader(self.url, f'{path}/gar.zip', 3, chunk_size=16384, min_segment_size=1024)
+            stats = downloader.download()
+            with open(f'{path}/gar.zip', 'rb') as file:
+                self.assertEqual(file.read(), self.server.data)
+            # Оборванная часть продолжена с места обрыва
+            self.assertEqual(self.server.served, len(self.server.data))
+            self.assertEqual(stats.size, len(self.server.data))
+            self.assertEqual(os.listdir(path), ['gar.zip'])
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            with self.assertRaises(Exception):
+                Downloader(self.url, f'{path}/gar.zip', retries=0, chunk_size=16384).download()
+            self.assertEqual(sorted(os.listdir(path)), ['gar.zip.part', 'gar.zip.part.json'])
+
+            stats = Downloader(self.url, f'{path}/gar.zip', chunk_size=16384).download()
+            with open(f'{path}/gar.zip', 'rb') as file:
+                self.assertEqual(file.read(), self.server.data)
+            self.assertEqual(stats.received, len(self.server.data) - 50000)
+            self.assertEqual(self.server.served, len(self.server.data))
+
+    def test_retry_progress(self):
+        # Обрывается каждый ответ, но после части данных: попытки считаются заново и не заканчиваются
+        self.server.fail_after = None
+        self.server.fail_every = 100000
+        with tempfile.TemporaryDirectory() as path:
+            Downloader(self.url, f'{path}/gar.zip', retries=1, chunk_size=16384).download()
+            with open(f'{path}/gar.zip', 'rb') as file:
+                self.assertEqual(file.read(), self.server.data)
+
+    def test_members(self):
+        def data(seed: str, size: int) -> bytes:
+            # Не сжимаемые данные
+            return b''.join(hashlib.sha256(f'{seed}{i}'.encode()).digest() for i in range(size // 32))
+
+        members = {
+            'AS_OBJECT_LEVELS.XML': b'<OBJECTLEVELS />' * 100,
+            '01/AS_HOUSES.XML': data('01', 200000),
+            '50/AS_HOUSES.XML': data('50', 200000),
+            '50/AS_APARTMENTS.XML': data('50a', 100000),
+            '77/AS_HOUSES.XML': data('77', 100000),
+        }
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, value in members.items():
+                archive.writestr(name, value)
+        self.server.data = buffer.getvalue()
+        self.server.fail_after = None
+
+        with tempfile.TemporaryDirectory() as path:
+            downloader = Downloader(self.url, f'{path}/gar.zip', 2, chunk_size=16384, min_segment_size=1024)
+            downloader.download_members(lambda x: '/' not in x or x.startswith('50/'), 4096)
+            with zipfile.ZipFile(f'{path}/gar.zip') as archive:
+                self.assertEqual(archive.namelist(), list(members))
+                for name in ('AS_OBJECT_LEVELS.XML', '50/AS_HOUSES.XML', '50/AS_APARTMENTS.XML'):
+                    self.assertEqual(archive.read(name), members[name])
+            # Файлы 01 и 77 (300000 байт) не загружались
+            self.assertLess(self.server.served, len(self.server.data) - 290000)
+
+
+class UpdateDownloadsTest(unittest.TestCase):
+    def run_updates(self, prefetch: int, budget=None) -> List[str]:
+        events = []
+
+        with tempfile.TemporaryDirectory() as path:
+            def download(file_obj: Dict, _delta: bool, _cancel: threading.Event) -> Dict:
+                events.append(f'download {file_obj["VersionId"]}')
+                file_name = f'{path}/{file_obj["VersionId"]}.zip'
+                with open(file_name, 'wb') as file:
+                    file.write(b' ' * 100)
+                return dict(file_obj, File=file_name)
+
+            async def main():
+                downloads = UpdateDownloads([{'VersionId': x} for x in range(3)], True, prefetch, budget, download)
+                downloads.start()
+                try:
+                    for _ in range(3):
+                        file_info = await downloads.next()
+                        await asyncio.sleep(0.05)
+                        await downloads.remove(file_info)
+                        events.append(f'imported {file_info["VersionId"]}')
+                finally:
+                    await downloads.stop()
+                self.assertEqual(os.listdir(path), [])
+
+            asyncio.run(main())
+        return events
+
+    def test_prefetch(self):
+        # Следующий архив загружается во время импорта текущего, но не дальше prefetch архивов вперед
+        events = self.run_updates(1)
+        self.assertLess(events.index('download 1'), events.index('imported 0'))
+        self.assertLess(events.index('imported 0'), events.index('download 2'))
+        self.assertLess(events.index('download 2'), events.index('imported 1'))
+        events = self.run_updates(2)
+        self.assertLess(events.index('download 2'), events.index('imported 0'))
+        # Без предварительной загрузки и если место на диске занято текущим архивом - загрузка после импорта
+        for events in (self.run_updates(0), self.run_updates(2, 100)):
+            self.assertEqual(events, ['download 0', 'imported 0', 'download 1', 'imported 1', 'download 2',
+                                      'imported 2'])
+
+
+class SqliteImportTest(unittest.TestCase):
+    """ Импорт синтетического архива в файл SQLite """
+    def setUp(self):
+        self.settings = settings.database.dict(), settings.update.dict()
+        self.dir = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.dir.name, 'gar.sqlite')
+        self.archive = bench.make_archive(os.path.join(self.dir.name, '20220707_gar_xml.zip'),
+                                          streets=5, houses=2, apartments=2)
+
+    def tearDown(self):
+        for section, values in zip((settings.database, settings.update), self.settings):
+            for name, value in values.items():
+                setattr(section, name, value)
+        asyncio.run(replace_database(get_connection_url()))
+        self.dir.cleanup()
+
+    def import_archive(self, fresh: bool = True) -> Dict[str, int]:
+        """ Импортировать архив (fresh - в новую БД), возвращает количество записей по таблицам """
+        async def main():
+            if fresh:
+                await bench.use_sqlite(self.base)
+            else:
+                await database.connect()
+            with zipfile.ZipFile(self.archive) as archive:
+                self.gar = GarImport(archive)
+                await self.gar.import_all()
+            counts = {x.name: await database.fetch_val(f'select count(*) from {x.name}')
+                      for x in metadata.sorted_tables}
+            await database.disconnect()
+            return counts
+
+        return asyncio.run(main())
+
+    def test_workers(self):
+        counts = self.import_archive()
+        self.assertTrue(counts['houses'])
+        # Разбор XML в пуле процессов загружает те же записи
+        settings.update.workers = 1
+        self.assertEqual(self.import_archive(), counts)
+
+    def test_unchanged(self):
+        # Повторный импорт того же архива через OrmarLoader: записи не перезаписываются
+        settings.database.fast_import = False
+        self.import_archive()
+        self.assertTrue(sum(self.gar.counts.values()))
+        self.import_archive(False)
+        self.assertFalse(sum(self.gar.counts.values()))
+        self.assertTrue(sum(self.gar.unchanged.values()))
+
+    def test_shadow(self):
+        settings.update.shadow = True
+        self.assertTrue(self.import_archive()['houses'])
+        self.assertEqual(settings.database.base, self.base)
+        self.assertFalse(os.path.exists(f'{self.base}.shadow'))
+
+        async def rollback():
+            await update.rollback()
+            count = await database.fetch_val('select count(*) from houses')
+            await database.disconnect()
+            return count
+
+        # update.py --rollback возвращает БД, замененную импортом (пустую)
+        self.assertEqual(asyncio.run(rollback()), 0)
+
+        async def swap_error():
+            await database.connect()
+            shadow = get_shadow()
+            await shadow.open()
+            with mock.patch('fns.gar_shadow.os.replace', side_effect=OSError('replace')):
+                with self.assertRaises(OSError):
+                    await shadow.swap()
+            # Ошибка замены: подключение возвращается к рабочей БД
+            base = settings.database.base
+            await shadow.discard()
+            await database.disconnect()
+            return base
+
+        self.assertEqual(asyncio.run(swap_error()), self.base)
+        self.assertFalse(os.path.exists(f'{self.base}.shadow'))
+
+    def test_shadow_resume(self):
+        expected = self.import_archive()
+        settings.update.shadow = True
+        # Аварийное завершение: шаг параметров падает, а теневая БД не удаляется
+        with mock.patch.object(GarImport, 'import_address_object_param', side_effect=RuntimeError('crash')), \
+                mock.patch('fns.gar_shadow.SqliteShadow.discard', mock.AsyncMock()):
+            with self.assertRaises(RuntimeError):
+                self.import_archive()
+        self.assertTrue(os.path.exists(f'{self.base}.shadow'))
+        # Ход импорта в теневую БД виден в рабочей (по ней работает /api/import/status)
+        connection = sqlite3.connect(self.base)
+        done = connection.execute('select count(*) from update_files where done').fetchone()[0]
+        connection.close()
+        self.assertTrue(done)
+
+        settings.database.base = self.base
+        asyncio.run(replace_database(get_connection_url()))
+        # Импорт продолжается в оставшейся теневой БД с сохраненного состояния файлов
+        self.assertEqual(self.import_archive(False), expected)
+        self.assertEqual(sum(x for _, x in self.gar._checkpoints.values()), done)
+        self.assertFalse(os.path.exists(f'{self.base}.shadow'))
+
+    def test_indexes(self):
+        query = "select tbl_name, name, sql from sqlite_master where type = 'index' order by name"
+
+        async def main():
+            await bench.use_sqlite(self.base)
+            before = [tuple(x) for x in await database.fetch_all(query)]
+            with zipfile.ZipFile(self.archive) as archive:
+                gar = GarImport(archive)
+                await gar.import_all()
+            after = [tuple(x) for x in await database.fetch_all(query)]
+            await database.disconnect()
+            return before, after, gar.loader.defer_indexes
+
+        # Индексы, удаленные на время полной загрузки, создаются заново такими же
+        for fast_import in (True, False):
+            settings.database.fast_import = fast_import
+            before, after, defer_indexes = asyncio.run(main())
+            self.assertTrue(defer_indexes)
+            self.assertIn('ix_hierarchy_adm_path', [x[1] for x in before])
+            self.assertEqual(after, before)
+
+    def test_pragmas(self):
+        async def main():
+            await bench.use_sqlite(self.base)
+            await database.disconnect()
+            loader = SqliteLoader()
+            await loader.open()
+            with self.assertRaises(ZeroDivisionError):
+                async with loader.transaction('test'):
+                    await loader.create('test', ObjectRoute, [(1, b'1' * 16, 1)])
+                    1 / 0
+            # Импорт прерван внутри транзакции блока
+            await loader._execute('begin')
+            await loader.create('test', ObjectRoute, [(2, b'2' * 16, 1)])
+            await loader.close()
+
+        asyncio.run(main())
+        connection = sqlite3.connect(self.base)
+        self.assertEqual(connection.execute('pragma journal_mode').fetchone()[0], 'delete')
+        # synchronous действует только для подключения загрузчика: у нового подключения - FULL
+        self.assertEqual(connection.execute('pragma synchronous').fetchone()[0], 2)
+        self.assertEqual(connection.execute('select count(*) from object_routes').fetchone()[0], 0)
+        self.assertFalse(os.path.exists(f'{self.base}-wal'))
+        connection.close()
+
+    def test_merge(self):
+        settings.database.fast_import = False
+        routes = [(1, b'1' * 16, 1), (2, b'2' * 16, 2)]
+
+        async def main():
+            await bench.use_sqlite(self.base)
+            await database.execute('create table updated (object_id)')
+            await database.execute('create trigger object_routes_updated after update on object_routes '
+                                   'begin insert into updated values (new.object_id); end')
+            loader = OrmarLoader()
+            await loader.merge('test', ObjectRoute, routes)
+            # Блок записывается одним запросом без чтения существующих записей
+            with mock.patch.object(database, 'fetch_all', side_effect=AssertionError('select')):
+                await loader.merge('test', ObjectRoute, [routes[0], (2, b'2' * 16, 3), (3, b'3' * 16, 1)])
+            result = [[tuple(x) for x in await database.fetch_all(query)] for query in (
+                'select object_id from updated', 'select object_id, table_code from object_routes order by object_id'
+            )]
+            await database.disconnect()
+            return result
+
+        updated, rows = asyncio.run(main())
+        # Запись без изменений не перезаписывается
+        self.assertEqual(updated, [(2, )])
+        self.assertEqual(rows, [(1, 1), (2, 3), (3, 1)])
+
+    def test_transaction(self):
+        settings.database.fast_import = False
+        routes = [(1, b'1' * 16, 1), (2, b'2' * 16, 2)]
+
+        async def main():
+            await bench.use_sqlite(self.base)
+            loader = OrmarLoader()
+            # Блок и состояние файла откатываются вместе
+            with self.assertRaises(ZeroDivisionError):
+                async with loader.transaction('test'):
+                    await loader.create('test', ObjectRoute, routes)
+                    await loader.checkpoint(UpdateFile.Meta.table, (
+                        '20220707/test', 20220707, 'test', 2, False, datetime.utcnow(), 0, 0, 0, 0, 2, 0, 0, 0, 0
+                    ))
+                    1 / 0
+            counts = [await ObjectRoute.objects.count(), await UpdateFile.objects.count()]
+            # Ошибочный блок откатывается до точки сохранения и записывается по одной записи
+            async with loader.transaction('test'):
+                await loader.create('test', ObjectRoute, routes[:1])
+                await loader.create('test', ObjectRoute, routes)
+            counts.append(await ObjectRoute.objects.count())
+            await database.disconnect()
+            return counts
+
+        self.assertEqual(asyncio.run(main()), [0, 0, 2])
+
+
+class ImportStatusTest(unittest.TestCase):
+    def test_status(self):
+        start = datetime(2022, 7, 7, 10)
+        update = Updates(id=20220707, state='Выполняется', update_date=start)
+
+        def file(name: str, size: int, read_bytes: int, done: bool, update_date: datetime) -> UpdateFile:
+            return UpdateFile(id=f'20220707/{name}', version=20220707, file_name=name, rows=0, done=done,
+                              update_date=update_date, size=size, read_bytes=read_bytes)
+
+        files = [
+            # Загружен до прерывания импорта - в скорости не учитывается
+            file('AS_OBJECT_LEVELS.XML', 100, 100, True, datetime(2022, 7, 7, 9)),
+            file('77/AS_HOUSES.XML', 1000, 600, False, datetime(2022, 7, 7, 10, 1)),
+            file('77/AS_APARTMENTS.XML', 900, 0, False, start),
+        ]
+        result = import_status(update, files, datetime(2022, 7, 7, 10, 1))
+        self.assertEqual(result['progress'], 0.35)
+        # 600 байт за 60 с, осталось 1300 байт
+        self.assertEqual(result['eta'], 130)
+
+        metrics = import_metrics(result)
+        self.assertIn('gar_import_progress{version="20220707"} 0.35', metrics)
+        self.assertIn('gar_import_file_bytes{version="20220707",file="77/AS_HOUSES.XML",kind="read_bytes"} 600',
+                      metrics)
@@ -1,5 +1,7 @@
 import asyncio
+import contextlib
 import os.path
+import sys
 import time
 import zipfile
 
@@ -8,7 +10,9 @@ import schedule
 from core.database import database
 from core.log import get_logger
 from core.settings import settings
-from fns.download import get_updates_file_list, download_update
+from fns.download import get_updates_file_list, UpdateDownloads
+from fns.gar_reader import ArchiveSet
+from fns.gar_shadow import get_shadow
 from fns.import_gar import GarImport
 from gar.models import AlembicVersion, Updates
 
@@ -23,18 +27,47 @@ async def update():
     version: int = await Updates.objects.filter(state='Выполнено').max(columns=["id"])
 
     update_list = get_updates_file_list(version)
-    for url_obj in update_list:
-        update_file = download_update(url_obj, version is not None)
-        zip_name = update_file['File']
+    # Следующие архивы загружаются во время импорта текущего, импорт - строго по порядку версий
+    budget = settings.update.prefetch_budget
+    downloads = UpdateDownloads(update_list, version is not None, settings.update.prefetch,
+                                budget * 1024 * 1024 if budget is not None else None)
+    downloads.start()
+    # Несколько обновлений можно импортировать одним проходом: каждая запись записывается один раз
+    coalesce = max(settings.update.coalesce, 1) if version is not None else 1
+    try:
+        remaining = len(update_list)
+        while remaining:
+            update_files = []
+            for _ in range(min(coalesce, remaining)):
+                update_file = await downloads.next()
+                if not update_file:
+                    raise RuntimeError('Не удалось загрузить архив обновления')
+                update_files.append(update_file)
+            remaining -= len(update_files)
+
+            with contextlib.ExitStack() as stack:
+                archives = [stack.enter_context(zipfile.ZipFile(x['File'], mode='r', allowZip64=True))
+                            for x in update_files]
+                archive = archives[0] if len(archives) == 1 else ArchiveSet(archives)
+                gar = GarImport(archive, settings.update.region)
+                await gar.import_all()
+
+            for update_file in update_files:
+                await downloads.remove(update_file)
+    finally:
+        await downloads.stop()
 
-        with zipfile.ZipFile(zip_name, mode='r', allowZip64=True) as archive:
-            gar = GarImport(archive, settings.update.region)
-            await gar.import_all()
 
-        try:
-            os.remove(zip_name)
-        except OSError:
-            pass
+async def rollback():
+    """
+    Вернуть БД, замененную последним импортом в теневую БД
+    """
+    if not database.is_connected:
+        await database.connect()
+    shadow = get_shadow()
+    if not shadow:
+        raise ValueError('Теневая БД не поддерживается для этого драйвера')
+    await shadow.rollback()
 
 
 def main():
@@ -57,6 +90,9 @@ if __name__ == '__main__':
         raise e
 
     try:
-        main()
+        if '--rollback' in sys.argv:
+            asyncio.run(rollback())
+        else:
+            main()
     except KeyboardInterrupt:
         exit(1)